@@ -1,8 +1,8 @@
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
+from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, Response
 from sqlalchemy.orm import Session, joinedload
 
-from typing import List
-from app.schemas.product import Product as ProductSchema, ProductDetail, PriceHistoryEntry, MergeProductRequest, MergeProductResponse, PriceVariation
+from typing import List, Optional
+from app.schemas.product import Product as ProductSchema, ProductDetail, PriceHistoryEntry, MergeProductRequest, MergeProductResponse
 from app.schemas.invoice import InvoiceListItem, InvoiceImportResponse, DashboardSummary, InvoiceDetail, InvoiceLineDetail, SupplierInfo
 from app.db.models import Invoice, InvoiceLine, Product, Supplier, ProductPriceHistory
 from datetime import date
@@ -11,15 +11,33 @@ from app.schemas.confirm_invoice import (
     ConfirmInvoiceResponse,
 )
 from app.deps import get_db
-from app.services.matching import (
-    get_or_create_supplier,
-    deterministic_match_all_lines,
-    find_matching_product,
-)
-from sqlalchemy import func
+from app.services.matching import find_matching_product
+from app.services.match_index import product_match_index, IndexedProduct
+from app.services.aliases import product_alias_cache, record_aliases, repoint_aliases
+from app.services.layout_templates import learn_supplier_layout
+from app.services.import_pipeline import import_invoice_bytes, stream_import_events
+from app.services.import_jobs import import_job_manager, FINAL_STAGES
+from app.services.batch_import import collect_batch_items, run_batch_import
+from app.services.fatturapa import is_structured_invoice
+from app.services.upload_preprocessing import read_upload
+from app.services.invoice_listing import InvoiceFilters, count_invoices, list_invoice_page
+from app.services.product_listing import count_products, list_product_page
+from app.services.price_stats import load_price_stats, record_prices, refresh_price_stats, remove_price_stats
+from app.services.dashboard import dashboard_summary_cache
+from app.services.llm_resilience import LLMUnavailableError
+from app.schemas.import_job import ImportJobStatus
+from app.schemas.extraction import ExtractionMetricsSummary
+from app.services.extraction_metrics import summarize_extraction_metrics
+from app.config import settings
+from sse_starlette.sse import EventSourceResponse
+from fastapi.responses import StreamingResponse
+import asyncio
+import json
+import logging
 
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Lazy import per evitare errori se datapizza non è installato
 extractor = None
@@ -47,41 +65,135 @@ def health_check():
 @router.post("/invoices/import", response_model=InvoiceImportResponse)
 async def import_invoice(
     file: UploadFile = File(...),
+    no_cache: bool = False,
     db: Session = Depends(get_db),
 ):
     """
-    1) Riceve una fattura (PDF/immagine)
-    2) Usa Datapizza per estrarre dati strutturati
+    1) Riceve una fattura (PDF/immagine, oppure fattura elettronica FatturaPA .xml/.xml.p7m)
+    2) Usa Datapizza per estrarre dati strutturati (l'XML FatturaPA viene letto direttamente)
+       (risultato in cache per hash del file; no_cache=true forza una nuova estrazione)
     3) Fa un primo matching deterministico con i prodotti a DB
     4) Ritorna al frontend i dati + info di match
     """
-    file_bytes = await file.read()
-    # estensione dal nome file, es "fattura.pdf" -> "pdf"
-    mime_ext = file.filename.split(".")[-1].lower()
-
-    # 2) Estrazione AI
-    extractor_instance = get_extractor()
-    extraction = extractor_instance.extract_from_bytes(file_bytes, mime_ext)
-
-    # 3) Fornitore
-    supplier = get_or_create_supplier(db, extraction.supplier.name)
-
-    # 4) Matching deterministico sulle righe
-    lines_with_match = deterministic_match_all_lines(db, extraction)
-
-    # 5) Costruisci risposta
-    response = InvoiceImportResponse(
-        invoice_id=None,  # in futuro potrai salvare subito un draft
-        supplier_id=supplier.id,  # ID del fornitore creato/trovato
-        supplier=extraction.supplier,
-        invoice_number=extraction.invoice_number,
-        invoice_date=extraction.invoice_date,
-        currency=extraction.currency,
-        total_amount=extraction.total_amount,  # Totale documento dall'estrazione
-        lines=lines_with_match,
-    )
+    # Upload letto dal file temporaneo; immagini ridotte e ricompresse
+    file_bytes, mime_ext = await read_upload(file)
+
+    # 2) Estrazione AI (async, con limite di concorrenza); FatturaPA xml/p7m lette senza AI
+    # 3-4) Fornitore e matching deterministico nel thread pool
+    extractor_instance = None if is_structured_invoice(mime_ext) else get_extractor()
+    try:
+        return await import_invoice_bytes(db, extractor_instance, file_bytes, mime_ext, use_cache=not no_cache)
+    except LLMUnavailableError as e:
+        # Provider degradato (circuito aperto o tentativi esauriti): il client può riprovare più tardi
+        retry_after = e.retry_after if e.retry_after is not None else settings.LLM_BREAKER_RESET_SECONDS
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(max(1, round(retry_after)))})
+
+@router.post("/invoices/import/stream")
+async def import_invoice_stream(
+    file: UploadFile = File(...),
+    no_cache: bool = False,
+):
+    """
+    Import in streaming (SSE): il modello produce le righe una alla volta e ognuna
+    viene matchata e inviata subito. Eventi: "supplier", "line" ({"index", "line"}),
+    "done" (stessa risposta di /invoices/import) oppure "error" ({"detail"}).
+    """
+    file_bytes, mime_ext = await read_upload(file)
+    extractor_instance = None if is_structured_invoice(mime_ext) else get_extractor()
+
+    async def event_stream():
+        try:
+            async for event, payload in stream_import_events(
+                extractor_instance, file_bytes, mime_ext, use_cache=not no_cache
+            ):
+                yield {"event": event, "data": json.dumps(payload, ensure_ascii=False)}
+        except Exception as e:
+            logger.warning(f"⚠️ Streaming import failed: {e}")
+            yield {"event": "error", "data": json.dumps({"detail": str(e)}, ensure_ascii=False)}
+
+    return EventSourceResponse(event_stream())
+
+
+@router.post("/invoices/import/batch")
+async def import_invoices_batch(
+    files: List[UploadFile] = File(...),
+    no_cache: bool = False,
+):
+    """
+    Import multiplo: più fatture e/o archivi ZIP in una sola richiesta.
+    I file vengono elaborati in parallelo (BATCH_IMPORT_CONCURRENCY) e la risposta è
+    NDJSON: una riga per file appena pronto ({"index", "filename", "status": "ok"|"error",
+    "result" | "error"}), poi una riga di riepilogo ({"summary": true, "total", "ok", "errors"}).
+    """
+    items = collect_batch_items(files)
+    needs_ai = any(not is_structured_invoice(item.mime_ext) for item in items)
+    extractor_instance = get_extractor() if needs_ai else None
+
+    async def ndjson():
+        async for result in run_batch_import(extractor_instance, items, use_cache=not no_cache):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@router.post("/invoices/import/jobs", response_model=ImportJobStatus, status_code=202)
+async def create_import_job(
+    file: UploadFile = File(...),
+    no_cache: bool = False,
+):
+    """
+    Import asincrono: salva il file, mette in coda il job e risponde subito con il job_id.
+    Stato con GET /invoices/import/{job_id}, avanzamento via SSE su /invoices/import/{job_id}/events.
+    """
+    file_bytes, mime_ext = await read_upload(file)
+
+    await import_job_manager.start(get_extractor)
+    job = await import_job_manager.submit(file.filename, mime_ext, file_bytes, use_cache=not no_cache)
+    return job.to_status()
+
+
+@router.get("/invoices/import/{job_id}", response_model=ImportJobStatus)
+async def get_import_job(job_id: str):
+    """Stato di un job di import; con stage "done" contiene il risultato dell'import"""
+    job = await import_job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job.to_status()
+
+
+@router.get("/invoices/import/{job_id}/events")
+async def import_job_events(job_id: str):
+    """
+    Stream SSE degli stage del job (uploaded, extracting, matching, done/failed).
+    Ogni evento "stage" contiene lo stato completo del job; lo stream si chiude a job concluso.
+    """
+    job = await import_job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+
+    async def event_stream():
+        queue = import_job_manager.subscribe(job_id)
+        try:
+            current = await import_job_manager.get(job_id)
+            sent = None
+            while True:
+                # Aggiornamenti in coda e riletture dal DB possono arrivare fuori ordine:
+                # si inviano solo stati più recenti dell'ultimo inviato e con uno stage diverso
+                if sent is None or (current.is_newer_than(sent) and current.stage != sent.stage):
+                    yield {"event": "stage", "data": current.to_status().model_dump_json()}
+                    sent = current
+                    if current.stage in FINAL_STAGES:
+                        return
+                try:
+                    current = await asyncio.wait_for(queue.get(), timeout=settings.IMPORT_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    # Il job può essere elaborato da un altro processo: rilegge lo stato
+                    current = await import_job_manager.get(job_id) or current
+        finally:
+            import_job_manager.unsubscribe(job_id, queue)
+
+    return EventSourceResponse(event_stream())
 
-    return response
 
 @router.post("/invoices/confirm", response_model=ConfirmInvoiceResponse)
 def confirm_invoice(
@@ -106,6 +218,13 @@ def confirm_invoice(
     db.add(inv)
     db.flush()  # così otteniamo inv.id senza commit
 
+    # Prodotti creati/aggiornati, da riportare nell'indice di matching dopo il commit
+    touched_products: list[Product] = []
+    # Decisioni confermate (codice, descrizione, prodotto) da ricordare come alias
+    confirmed_matches: list[tuple] = []
+    # Nuove voci di storico, per aggiornare le statistiche prezzi nella stessa transazione
+    price_entries: list[ProductPriceHistory] = []
+
     for line in payload.lines:
         # Estrai il product_code dalla riga (se presente)
         product_code = line.product_code
@@ -120,13 +239,18 @@ def confirm_invoice(
                 # Aggiorna il product_code se presente nella riga fattura e mancante nel prodotto
                 if product_code and (not existing_prod.product_code or existing_prod.product_code.strip() == ""):
                     existing_prod.product_code = product_code
+                    if existing_prod.supplier_id is None:
+                        existing_prod.supplier_id = payload.supplier_id
                     db.flush()
+                    touched_products.append(existing_prod)
         
         # Se non c'è product_id, cerca un prodotto esistente con matching intelligente
         # Questo evita la creazione di duplicati quando le descrizioni sono simili
         if final_product_id is None and line.raw_description:
             # Usa product_code se disponibile per un match più affidabile
-            existing_prod = find_matching_product(db, line.raw_description, product_code=product_code)
+            existing_prod = find_matching_product(
+                db, line.raw_description, product_code=product_code, supplier_id=payload.supplier_id
+            )
             if existing_prod:
                 # Trovato un prodotto esistente che matcha
                 final_product_id = existing_prod.id
@@ -134,12 +258,16 @@ def confirm_invoice(
                 # Questo assicura che i prodotti esistenti vengano arricchiti con il codice quando disponibile
                 if product_code and (not existing_prod.product_code or existing_prod.product_code.strip() == ""):
                     existing_prod.product_code = product_code
+                    if existing_prod.supplier_id is None:
+                        existing_prod.supplier_id = payload.supplier_id
                     db.flush()
+                    touched_products.append(existing_prod)
                 # Opzionale: aggiorna prezzo/UM se mancanti? Per ora no.
             else:
                 # Nessun match trovato, crea un nuovo prodotto
                 new_prod = Product(
                     product_code=product_code,
+                    supplier_id=payload.supplier_id,
                     name=line.raw_description,
                     unit_price=line.unit_price,
                     unit_measure=line.unit_measure,
@@ -147,6 +275,7 @@ def confirm_invoice(
                 db.add(new_prod)
                 db.flush()
                 final_product_id = new_prod.id
+                touched_products.append(new_prod)
 
         db_line = InvoiceLine(
             invoice_id=inv.id,
@@ -161,6 +290,8 @@ def confirm_invoice(
             cost_center_id=line.cost_center_id,
         )
         db.add(db_line)
+        if final_product_id is not None:
+            confirmed_matches.append((product_code, line.raw_description, final_product_id))
 
         # Salva lo storico dei prezzi se il prodotto è stato matchato
         if final_product_id is not None and line.unit_price is not None:
@@ -175,134 +306,148 @@ def confirm_invoice(
                 currency=inv.currency,
             )
             db.add(price_history)
+            price_entries.append(price_history)
+
+    record_prices(db, price_entries)
+
+    # Snapshot prima del commit: dopo il commit gli attributi scadono e
+    # leggerli richiederebbe una query per prodotto
+    index_updates = [
+        IndexedProduct(p.id, p.name, p.product_code, p.normalized_name, p.supplier_id)
+        for p in touched_products
+    ]
 
     db.commit()
+    dashboard_summary_cache.invalidate()
     db.refresh(inv)
+    invoice_id = inv.id
 
-    return ConfirmInvoiceResponse(invoice_id=inv.id)
+    for product in index_updates:
+        product_match_index.upsert(product)
+
+    # Gli alias sono salvati in una transazione separata (upsert, senza conflitti
+    # tra conferme concorrenti): un errore non deve far fallire la fattura già salvata
+    try:
+        record_aliases(db, payload.supplier_id, confirmed_matches)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not record product aliases for supplier {payload.supplier_id}: {e}")
+    product_alias_cache.invalidate(payload.supplier_id)
+
+    # Layout del fornitore appreso dal PDF importato (stesso principio degli alias)
+    if payload.layout_sample_id and settings.LAYOUT_TEMPLATES_ENABLED:
+        try:
+            learn_supplier_layout(
+                db, payload.supplier_id, payload.layout_sample_id,
+                payload.invoice_number, payload.invoice_date, payload.currency, payload.lines,
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Could not learn invoice layout for supplier {payload.supplier_id}: {e}")
+
+    return ConfirmInvoiceResponse(invoice_id=invoice_id)
 
 @router.get("/invoices", response_model=List[InvoiceListItem])
-def list_invoices(db: Session = Depends(get_db)):
+def list_invoices(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    supplier_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    include_total: bool = False,
+    db: Session = Depends(get_db),
+):
     """
-    Ritorna la lista delle fatture salvate, per la dashboard.
+    Ritorna le fatture salvate per la dashboard, dalla più recente, una pagina alla volta.
+    Header X-Next-Cursor: da passare come cursor per la pagina successiva (assente sull'ultima).
+    include_total=true: header X-Total-Count con i filtri applicati (solo sulla prima pagina).
     """
-    rows = (
-        db.query(Invoice, Supplier)
-        .join(Supplier, Invoice.supplier_id == Supplier.id)
-        .order_by(Invoice.invoice_date.desc().nullslast(), Invoice.id.desc())
-        .all()
+    filters = InvoiceFilters(
+        supplier_id=supplier_id,
+        date_from=date_from,
+        date_to=date_to,
+        min_amount=min_amount,
+        max_amount=max_amount,
     )
+    page_size = min(max(1, limit or settings.INVOICE_LIST_PAGE_SIZE), settings.INVOICE_LIST_MAX_PAGE_SIZE)
+    try:
+        items, next_cursor = list_invoice_page(db, filters, cursor, page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    result: list[InvoiceListItem] = []
-    for inv, sup in rows:
-        result.append(
-            InvoiceListItem(
-                id=inv.id,
-                supplier_name=sup.name,
-                invoice_number=inv.invoice_number,
-                invoice_date=inv.invoice_date.isoformat() if inv.invoice_date else None,
-                currency=inv.currency,
-                total_amount=inv.total_amount,
-            )
-        )
-
-    return result
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if include_total and cursor is None:
+        response.headers["X-Total-Count"] = str(count_invoices(db, filters))
+    return items
 
 @router.get("/dashboard/summary", response_model=DashboardSummary)
 def dashboard_summary(db: Session = Depends(get_db)):
     """
-    Stats base per la dashboard.
+    Stats base per la dashboard, con il confronto mese corrente / mese precedente.
+    Una sola query, in cache finché non cambiano i dati (o per DASHBOARD_CACHE_TTL_SECONDS).
     """
-    total_invoices = db.query(func.count(Invoice.id)).scalar() or 0
-    total_amount = db.query(func.coalesce(func.sum(Invoice.total_amount), 0)).scalar() or 0.0
-    total_products = db.query(func.count(Product.id)).scalar() or 0
+    return dashboard_summary_cache.get(db)
 
-    return DashboardSummary(
-        total_invoices=total_invoices,
-        total_amount=total_amount,
-        total_products=total_products,
-    )
+@router.get("/extraction/metrics", response_model=ExtractionMetricsSummary)
+def extraction_metrics(days: int = 30, db: Session = Depends(get_db)):
+    """
+    Token e latenza delle chiamate di estrazione per tier/modello, per tarare
+    le soglie del routing (EXTRACTION_* in config).
+    """
+    return summarize_extraction_metrics(db, days=days)
 
 @router.get("/products", response_model=List[ProductSchema])
-def list_products(db: Session = Depends(get_db)):
+def list_products(
+    response: Response,
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    db: Session = Depends(get_db),
+):
     """
-    Ritorna la lista completa di tutti i prodotti registrati.
-    Include l'ultima variazione di prezzo se presente.
+    Ritorna i prodotti registrati una pagina alla volta, con l'ultima variazione di prezzo
+    se presente (calcolata dal DB sui soli prodotti della pagina).
+    search: nome (anche parziale) o codice articolo. Paginazione come GET /invoices:
+    header X-Next-Cursor e, con include_total=true, X-Total-Count sulla prima pagina.
     """
-    products = (
-        db.query(Product)
-        .options(joinedload(Product.price_history))
-        .order_by(Product.id)
-        .all()
-    )
-    
-    result: list[ProductSchema] = []
-    for product in products:
-        # Calcola la variazione di prezzo se ci sono almeno 2 prezzi nello storico
-        variazione = None
-        if product.price_history and len(product.price_history) >= 2:
-            # Ordina lo storico per data (più recente prima)
-            sorted_history = sorted(
-                product.price_history,
-                key=lambda x: x.price_date if x.price_date else date.min,
-                reverse=True
-            )
-            
-            # Prendi gli ultimi due prezzi
-            current_price_entry = sorted_history[0]
-            previous_price_entry = sorted_history[1]
-            
-            current_price = current_price_entry.unit_price
-            previous_price = previous_price_entry.unit_price
-            
-            if current_price is not None and previous_price is not None and previous_price != 0:
-                absolute_change = current_price - previous_price
-                percentage_change = (absolute_change / previous_price) * 100
-                
-                variazione = PriceVariation(
-                    previous_price=previous_price,
-                    current_price=current_price,
-                    absolute_change=absolute_change,
-                    percentage_change=percentage_change,
-                    variation_date=current_price_entry.price_date.isoformat() if current_price_entry.price_date else ""
-                )
-        
-        result.append(
-            ProductSchema(
-                id=product.id,
-                product_code=product.product_code,
-                name=product.name,
-                unit_price=product.unit_price,
-                variazione=variazione
-            )
-        )
-    
-    return result
+    page_size = min(max(1, limit or settings.PRODUCT_LIST_PAGE_SIZE), settings.PRODUCT_LIST_MAX_PAGE_SIZE)
+    try:
+        items, next_cursor = list_product_page(db, search, cursor, page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if include_total and cursor is None:
+        response.headers["X-Total-Count"] = str(count_products(db, search))
+    return items
 
 
 @router.get("/products/{product_id}", response_model=ProductDetail)
 def get_product_detail(product_id: int, db: Session = Depends(get_db)):
     """
     Recupera i dettagli completi di un prodotto specifico, inclusa la storia dei prezzi.
-    Mostra l'andamento del prezzo nel tempo per permettere l'analisi delle variazioni.
+    Mostra l'andamento del prezzo nel tempo per permettere l'analisi delle variazioni;
+    price_stats (corrente, precedente, min, max, media, acquisti) è precalcolato.
     """
-    product = (
-        db.query(Product)
-        .options(
-            joinedload(Product.price_history)
-        )
-        .filter(Product.id == product_id)
-        .first()
-    )
+    product = db.query(Product).filter(Product.id == product_id).first()
 
     if not product:
         raise HTTPException(status_code=404, detail="Prodotto non trovato")
 
-    # Ordina lo storico per data (più recente prima)
-    price_history = sorted(
-        product.price_history,
-        key=lambda x: x.price_date if x.price_date else date.min,
-        reverse=True
+    # Storico ordinato dal DB (più recente prima)
+    price_history = (
+        db.query(ProductPriceHistory)
+        .filter(ProductPriceHistory.product_id == product_id)
+        .order_by(ProductPriceHistory.price_date.desc(), ProductPriceHistory.id.desc())
+        .all()
     )
 
     # Converti lo storico in schema Pydantic
@@ -325,6 +470,7 @@ def get_product_detail(product_id: int, db: Session = Depends(get_db)):
         name=product.name,
         unit_price=product.unit_price,
         unit_measure=product.unit_measure,
+        price_stats=load_price_stats(db, [product.id]).get(product.id),
         price_history=history_entries,
     )
 
@@ -416,8 +562,15 @@ def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Fattura non trovata")
 
     try:
+        # Lo storico prezzi della fattura va eliminato con lei, poi si ricalcolano
+        # le statistiche dei prodotti coinvolti (stessa transazione)
+        history = db.query(ProductPriceHistory).filter(ProductPriceHistory.invoice_id == invoice_id)
+        product_ids = [product_id for (product_id,) in history.with_entities(ProductPriceHistory.product_id).distinct()]
+        history.delete(synchronize_session=False)
         db.delete(invoice)
+        refresh_price_stats(db, product_ids)
         db.commit()
+        dashboard_summary_cache.invalidate()
         return {"success": True}
     except Exception as e:
         db.rollback()
@@ -434,6 +587,7 @@ def merge_products(
     Unisce un prodotto sorgente con un prodotto destinazione.
     - Aggiorna tutte le invoice_lines che puntano al prodotto sorgente
     - Sposta lo storico prezzi dal prodotto sorgente a quello destinazione
+    - Sposta gli alias appresi sul prodotto destinazione
     - Elimina il prodotto sorgente
     
     L'operazione è atomica: se qualsiasi parte fallisce, tutte le modifiche vengono annullate.
@@ -479,13 +633,24 @@ def merge_products(
             .update({"product_id": target_product_id}, synchronize_session=False)
         )
 
-        # 3. Elimina il prodotto sorgente
+        # 3. Gli alias appresi puntano ora al prodotto destinazione
+        repoint_aliases(db, source_product_id, target_product_id)
+
+        # 3b. Statistiche prezzi: quelle della sorgente spariscono, la destinazione
+        # le ricalcola sullo storico unito (e aggiorna il prezzo corrente)
+        remove_price_stats(db, [source_product_id])
+        refresh_price_stats(db, [target_product_id])
+
+        # 4. Elimina il prodotto sorgente
         # Le relazioni con invoice_lines e price_history sono già state aggiornate,
         # quindi possiamo eliminare il prodotto in sicurezza
         db.delete(source_product)
 
         # Commit della transazione
         db.commit()
+        product_match_index.remove(source_product_id)
+        product_alias_cache.invalidate()
+        dashboard_summary_cache.invalidate()
 
         return MergeProductResponse(
             success=True,
@@ -12,6 +12,137 @@ class Settings(BaseSettings):
     # OpenAI / Datapizza
     OPENAI_API_KEY: str = "CHANGE_ME"
 
+    # Matching prodotti
+    # Strategia per le righe di una fattura: "index" (memoria), "batch" (query set-based), "per_line"
+    MATCHING_STRATEGY: str = "index"
+    # Indice in memoria del catalogo (per processo), ricostruito dopo il TTL
+    MATCH_INDEX_ENABLED: bool = True
+    MATCH_INDEX_TTL_SECONDS: int = 600
+    # Indice n-gram per il match per contenimento: "auto" (DB se disponibile), "db", "memory"
+    NGRAM_INDEX_BACKEND: str = "auto"
+    # Alias appresi dalle conferme (fornitore, codice, descrizione) -> prodotto
+    ALIAS_MATCHING_ENABLED: bool = True
+    ALIAS_CACHE_TTL_SECONDS: int = 600
+    # Suggerimenti fuzzy (top-k) per le righe non matchate
+    SUGGESTIONS_ENABLED: bool = True
+    SUGGESTIONS_TOP_K: int = 5
+    SUGGESTIONS_MIN_SCORE: float = 0.3
+
+    # Cache delle estrazioni AI (chiave: SHA-256 del file + versione modello/prompt)
+    # Backend: "disk", "db" oppure "none" (disabilitata)
+    EXTRACTION_CACHE_BACKEND: str = "disk"
+    # Cartella per il backend "disk" (vuoto = cartella temporanea di sistema)
+    EXTRACTION_CACHE_DIR: str = ""
+    EXTRACTION_CACHE_TTL_SECONDS: int = 30 * 24 * 3600
+    EXTRACTION_CACHE_MAX_ENTRIES: int = 1000
+    # Da incrementare per invalidare la cache quando cambia la logica di estrazione
+    EXTRACTION_CACHE_VERSION: str = "1"
+
+    # Estrazioni AI contemporanee per processo (le altre richieste attendono)
+    EXTRACTION_MAX_CONCURRENCY: int = 8
+
+    # Routing del modello: prima della chiamata si stima la complessità del documento
+    # (pagine, dimensione, righe delle fatture precedenti del fornitore) e si scelgono
+    # modello e max_tokens. Documenti piccoli -> modello "fast", gli altri -> EXTRACTION_MODEL
+    EXTRACTION_ROUTING_ENABLED: bool = True
+    EXTRACTION_MODEL: str = "gpt-4.1-mini"
+    EXTRACTION_MODEL_FAST: str = "gpt-4.1-nano"
+    # Budget di output: token fissi (intestazione) + token per riga stimata, con margine
+    EXTRACTION_BASE_TOKENS: int = 400
+    EXTRACTION_TOKENS_PER_LINE: int = 90
+    EXTRACTION_TOKEN_MARGIN: float = 1.3
+    EXTRACTION_MIN_TOKENS: int = 1500
+    EXTRACTION_MAX_TOKENS: int = 8000
+    # Righe stimate per pagina quando il documento non ha testo né storico del fornitore
+    EXTRACTION_LINES_PER_PAGE: int = 25
+    # Modello fast solo per documenti di una pagina, fino a questa dimensione e budget
+    EXTRACTION_FAST_MAX_BYTES: int = 2 * 1024 * 1024
+    EXTRACTION_FAST_MAX_TOKENS: int = 2500
+    # Fatture recenti del fornitore usate per stimare le righe
+    EXTRACTION_HISTORY_INVOICES: int = 10
+    # Token e latenza di ogni chiamata salvati in extraction_metrics (per tarare le soglie)
+    EXTRACTION_METRICS_ENABLED: bool = True
+
+    # Resilienza delle chiamate al modello: scadenza per chiamata, retry con backoff e jitter
+    # su timeout/429/5xx, circuit breaker per modello (fallisce subito mentre il provider è giù)
+    LLM_RESILIENCE_ENABLED: bool = True
+    LLM_CALL_TIMEOUT_SECONDS: float = 120.0
+    LLM_MAX_RETRIES: int = 2
+    LLM_RETRY_BASE_SECONDS: float = 0.5
+    LLM_RETRY_MAX_SECONDS: float = 8.0
+    LLM_BREAKER_FAILURES: int = 5
+    LLM_BREAKER_RESET_SECONDS: float = 30.0
+    # Richiesta duplicata se la prima supera il p95 delle latenze recenti (costo doppio sulle lente)
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    LLM_HEDGE_MIN_DELAY_SECONDS: float = 2.0
+
+    # Backend delle chiamate al modello: "datapizza" (OpenAI), "record" (OpenAI + risposte salvate
+    # in EXTRACTION_RECORDINGS_DIR), "replay" (risposte salvate, nessuna chiamata) oppure
+    # "synthetic" (fatture generate); replay e synthetic servono per i benchmark senza costi
+    EXTRACTION_BACKEND: str = "datapizza"
+    EXTRACTION_RECORDINGS_DIR: str = "recordings"
+    # Latenza simulata (replay/synthetic): base + jitter casuale + secondi per 1000 token di output;
+    # in replay si aggiunge la latenza registrata x EXTRACTION_REPLAY_LATENCY_SCALE (1.0 = reale)
+    EXTRACTION_FAKE_LATENCY_SECONDS: float = 0.0
+    EXTRACTION_FAKE_JITTER_SECONDS: float = 0.0
+    EXTRACTION_FAKE_SECONDS_PER_1K_TOKENS: float = 0.0
+    EXTRACTION_REPLAY_LATENCY_SCALE: float = 0.0
+    # Righe delle fatture sintetiche (numero scelto per documento, deterministico)
+    SYNTHETIC_MIN_LINES: int = 5
+    SYNTHETIC_MAX_LINES: int = 40
+
+    # Estrazione a blocchi dei PDF lunghi (richiede pypdf): pagine minime (0 = disattivata),
+    # pagine per blocco, tentativi extra per blocco fallito, token massimi per blocco
+    PDF_CHUNK_MIN_PAGES: int = 4
+    PDF_CHUNK_PAGES: int = 2
+    PDF_CHUNK_MAX_RETRIES: int = 1
+    PDF_CHUNK_MAX_TOKENS: int = 4000
+    # PDF digitali: al modello va il testo estratto (layout) invece del file, se ce n'è
+    # almeno PDF_TEXT_MIN_CHARS_PER_PAGE caratteri per pagina; scansioni -> file come Media
+    PDF_TEXT_LAYER_ENABLED: bool = True
+    PDF_TEXT_MIN_CHARS_PER_PAGE: int = 200
+
+    # Template di layout per fornitore, appresi dalle fatture confermate (solo PDF con testo):
+    # usati senza chiamata AI dopo LAYOUT_TEMPLATE_MIN_SAMPLES conferme coerenti e se la
+    # lettura ha confidenza >= LAYOUT_TEMPLATE_MIN_CONFIDENCE, altrimenti si usa il modello
+    LAYOUT_TEMPLATES_ENABLED: bool = True
+    LAYOUT_TEMPLATE_MIN_SAMPLES: int = 2
+    LAYOUT_TEMPLATE_MIN_CONFIDENCE: float = 0.9
+    LAYOUT_CACHE_TTL_SECONDS: int = 600
+    # Testi dei PDF importati tenuti in attesa della conferma
+    LAYOUT_SAMPLE_TTL_HOURS: int = 72
+
+    # Immagini caricate: ridotte (lato lungo in pixel) e ricompresse in JPEG senza metadati
+    IMAGE_PREPROCESSING_ENABLED: bool = True
+    IMAGE_MAX_SIDE: int = 2048
+    IMAGE_JPEG_QUALITY: int = 85
+
+    # Import asincrono a job: "db" (persistente) oppure "memory" (solo per test/sviluppo)
+    IMPORT_JOB_BACKEND: str = "db"
+    # Worker che elaborano i job in parallelo, per processo
+    IMPORT_JOB_WORKERS: int = 4
+    # Ogni quanto lo stream SSE rilegge lo stato (job elaborati da altri processi)
+    IMPORT_JOB_POLL_SECONDS: float = 2.0
+    # Durata del lease di un job in elaborazione (rinnovato mentre il worker lavora):
+    # scaduto, il job viene ripreso da un altro processo
+    IMPORT_JOB_LEASE_SECONDS: float = 120.0
+
+    # Import multiplo (più file o archivio ZIP): file elaborati in parallelo per richiesta
+    BATCH_IMPORT_CONCURRENCY: int = 4
+    # Dimensione massima (non compressa) di un singolo file del batch
+    BATCH_IMPORT_MAX_FILE_BYTES: int = 25 * 1024 * 1024
+
+    # Elenco fatture (GET /invoices): righe per pagina di default e massime
+    INVOICE_LIST_PAGE_SIZE: int = 50
+    INVOICE_LIST_MAX_PAGE_SIZE: int = 500
+    # Elenco prodotti (GET /products), stessa paginazione
+    PRODUCT_LIST_PAGE_SIZE: int = 100
+    PRODUCT_LIST_MAX_PAGE_SIZE: int = 1000
+
+    # Riepilogo della dashboard in cache per processo (invalidato dalle scritture di questo processo)
+    DASHBOARD_CACHE_TTL_SECONDS: int = 30
+
     class Config:
         env_file = ".env"
 
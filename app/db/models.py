@@ -1,7 +1,10 @@
 # app/db/models.py
-from sqlalchemy import Column, Integer, String, Date, Float, ForeignKey, Text
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, LargeBinary, ForeignKey, Text, Index, UniqueConstraint, event
 from sqlalchemy.orm import relationship
 from app.db.session import Base
+from app.services.normalization import description_hash, normalize_description
 
 
 class Supplier(Base):
@@ -13,6 +16,7 @@ class Supplier(Base):
     address = Column(Text, nullable=True)
 
     invoices = relationship("Invoice", back_populates="supplier")
+    products = relationship("Product", back_populates="supplier")
 
 
 class Product(Base):
@@ -20,13 +24,28 @@ class Product(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     product_code = Column(String(100), nullable=True, index=True)  # Codice articolo/fornitore per matching deterministico
+    supplier_id = Column(Integer, ForeignKey("suppliers.id"), nullable=True)  # fornitore a cui appartiene il codice
     name = Column(String(255), nullable=False)
+    normalized_name = Column(String(255), nullable=True)  # normalize_description(name), per lookup esatti/prefisso indicizzati
     unit_price = Column(Float, nullable=True)
     unit_measure = Column(String(50), nullable=True)  # Mantenuto per retrocompatibilità ma non più esposto nell'API
+    updated_at = Column(DateTime, nullable=True, index=True)  # ultima modifica via ORM, per la freschezza dell'indice di matching
 
+    supplier = relationship("Supplier", back_populates="products")
     invoice_lines = relationship("InvoiceLine", back_populates="product")
     price_history = relationship("ProductPriceHistory", back_populates="product", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # I codici articolo sono univoci solo all'interno dello stesso fornitore
+        Index("ix_products_supplier_code", "supplier_id", "product_code"),
+        # text_pattern_ops: permette a PostgreSQL di usare l'indice anche per LIKE 'prefisso%'
+        Index(
+            "ix_products_normalized_name",
+            "normalized_name",
+            postgresql_ops={"normalized_name": "text_pattern_ops"},
+        ),
+    )
+
 
 class Invoice(Base):
     __tablename__ = "invoices"
@@ -42,6 +61,12 @@ class Invoice(Base):
     supplier = relationship("Supplier", back_populates="invoices")
     lines = relationship("InvoiceLine", back_populates="invoice", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Paginazione keyset dell'elenco fatture: (invoice_date DESC, id DESC), anche per fornitore
+        Index("ix_invoices_date_id", "invoice_date", "id"),
+        Index("ix_invoices_supplier_date_id", "supplier_id", "invoice_date", "id"),
+    )
+
 
 class InvoiceLine(Base):
     __tablename__ = "invoice_lines"
@@ -78,3 +103,162 @@ class ProductPriceHistory(Base):
 
     product = relationship("Product", back_populates="price_history")
     invoice = relationship("Invoice")
+
+    __table_args__ = (
+        # Ultimi prezzi per prodotto (window function su product_id ordinata per data)
+        Index("ix_price_history_product_date_id", "product_id", "price_date", "id"),
+    )
+
+
+class ProductPriceStats(Base):
+    """
+    Riepilogo dello storico prezzi di un prodotto, aggiornato nella stessa transazione
+    di ogni scrittura dello storico (conferma, eliminazione fattura, unione prodotti).
+    Prezzo corrente/precedente = ultime due voci per (price_date, id).
+    """
+    __tablename__ = "product_price_stats"
+
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    current_price = Column(Float, nullable=False)
+    current_price_date = Column(Date, nullable=False)
+    current_history_id = Column(Integer, nullable=False)
+    previous_price = Column(Float, nullable=True)
+    previous_price_date = Column(Date, nullable=True)
+    previous_history_id = Column(Integer, nullable=True)
+    min_price = Column(Float, nullable=False)
+    max_price = Column(Float, nullable=False)
+    price_sum = Column(Float, nullable=False)  # media = price_sum / purchase_count
+    purchase_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ProductAlias(Base):
+    """
+    Decisione di matching confermata dall'utente:
+    (fornitore, codice articolo, descrizione normalizzata) -> prodotto.
+    """
+    __tablename__ = "product_aliases"
+
+    id = Column(Integer, primary_key=True, index=True)
+    supplier_id = Column(Integer, ForeignKey("suppliers.id"), nullable=False)
+    product_code = Column(String(100), nullable=False, default="")  # "" se la riga non ha codice
+    normalized_description = Column(Text, nullable=False)
+    description_hash = Column(String(64), nullable=False)  # description_hash(normalized_description), per l'indice univoco
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+
+    product = relationship("Product")
+
+    __table_args__ = (
+        UniqueConstraint("supplier_id", "product_code", "description_hash", name="uq_product_aliases_key"),
+    )
+
+
+class ExtractionCacheEntry(Base):
+    """
+    Risultato di un'estrazione AI (InvoiceExtraction serializzata in JSON),
+    indicizzato per hash del file + versione di modello/prompt.
+    Usato quando EXTRACTION_CACHE_BACKEND="db".
+    """
+    __tablename__ = "extraction_cache"
+
+    key = Column(String(128), primary_key=True)
+    data = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    last_accessed_at = Column(DateTime, nullable=False, index=True)
+
+
+class ImportJob(Base):
+    """
+    Import asincrono di una fattura: il file resta a DB finché il job non è
+    concluso, così un riavvio del worker non perde i job in coda.
+    """
+    __tablename__ = "import_jobs"
+
+    id = Column(String(36), primary_key=True)  # uuid4
+    filename = Column(String(255), nullable=True)
+    mime_ext = Column(String(20), nullable=False)
+    use_cache = Column(Boolean, nullable=False, default=True)
+    stage = Column(String(20), nullable=False, index=True)  # vedi ImportJobStage
+    file_data = Column(LargeBinary, nullable=True)  # svuotato a job concluso
+    result = Column(Text, nullable=True)  # InvoiceImportResponse in JSON
+    error = Column(Text, nullable=True)
+    claimed_by = Column(String(64), nullable=True)  # processo che sta elaborando il job
+    lease_until = Column(DateTime, nullable=True)  # scaduto: il job può essere ripreso da un altro processo
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ExtractionMetric(Base):
+    """
+    Una chiamata al modello di estrazione: stima fatta dal routing prima della
+    chiamata e consumo reale (token, latenza), per tarare le soglie del routing.
+    """
+    __tablename__ = "extraction_metrics"
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    tier = Column(String(20), nullable=False)  # fast / standard / chunk / escalated
+    model = Column(String(100), nullable=False)
+    mime_ext = Column(String(20), nullable=True)
+    input_kind = Column(String(10), nullable=True)  # "text" (text layer) o "media"
+    file_size = Column(Integer, nullable=True)
+    page_count = Column(Integer, nullable=True)
+    estimated_lines = Column(Integer, nullable=True)
+    max_tokens = Column(Integer, nullable=False)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    latency_ms = Column(Integer, nullable=False)
+    lines_extracted = Column(Integer, nullable=True)
+    truncated = Column(Boolean, nullable=False, default=False)
+    error = Column(Text, nullable=True)
+
+
+class LayoutSample(Base):
+    """
+    Text layer di un PDF importato, in attesa della conferma: alla conferma
+    (layout_sample_id nella richiesta) serve per imparare il layout del fornitore.
+    """
+    __tablename__ = "layout_samples"
+
+    id = Column(String(64), primary_key=True)  # SHA-256 del file
+    text = Column(Text, nullable=False)
+    extraction = Column(Text, nullable=False)  # campi di testata estratti (JSON), es. total_amount
+    created_at = Column(DateTime, nullable=False, index=True)
+
+
+class SupplierLayout(Base):
+    """
+    Layout appreso di un fornitore (ancore del testo, colonne delle righe, etichette
+    dei campi di testata): i PDF che lo rispettano vengono letti senza chiamata AI.
+    """
+    __tablename__ = "supplier_layouts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    supplier_id = Column(Integer, ForeignKey("suppliers.id"), nullable=False, index=True)
+    fingerprint = Column(String(64), nullable=False)  # hash di intestazione tabella + ancora fornitore
+    template = Column(Text, nullable=False)  # LayoutTemplate in JSON
+    samples = Column(Integer, nullable=False, default=1)  # fatture confermate coerenti con il template
+    hits = Column(Integer, nullable=False, default=0)
+    fallbacks = Column(Integer, nullable=False, default=0)  # documenti riconosciuti ma con confidenza bassa
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    supplier = relationship("Supplier")
+
+    __table_args__ = (
+        UniqueConstraint("supplier_id", "fingerprint", name="uq_supplier_layouts_fingerprint"),
+    )
+
+
+# Mantiene le colonne derivate (nome normalizzato, hash della descrizione) allineate a ogni insert/update via ORM
+@event.listens_for(Product, "before_insert")
+@event.listens_for(Product, "before_update")
+def _set_product_normalized_name(mapper, connection, target):
+    target.normalized_name = normalize_description(target.name)
+    target.updated_at = datetime.utcnow()
+
+
+@event.listens_for(ProductAlias, "before_insert")
+@event.listens_for(ProductAlias, "before_update")
+def _set_product_alias_description_hash(mapper, connection, target):
+    target.description_hash = description_hash(target.normalized_description)
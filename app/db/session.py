@@ -44,3 +44,15 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Base per i modelli ORM
 Base = declarative_base()
+
+
+def dialect_insert(db):
+    """
+    insert() del dialetto della sessione (PostgreSQL o SQLite): espone
+    on_conflict_do_nothing / on_conflict_do_update per gli upsert.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
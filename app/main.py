@@ -5,8 +5,10 @@ from fastapi.responses import JSONResponse
 import logging
 
 from app.db.session import engine, Base
-from app.api.routes import router as api_router
+from app.api.routes import router as api_router, get_extractor
 from app.config import settings
+from app.services.ngram_index import setup_db_ngram_index
+from app.services.import_jobs import import_job_manager
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +32,12 @@ except Exception as e:
         logger.warning(f"⚠️ Could not create database tables: {e}")
         logger.warning("Tables may already exist or database may need initialization")
 
+# Indice n-gram persistente per il matching (pg_trgm su PostgreSQL, FTS5 su SQLite)
+if settings.NGRAM_INDEX_BACKEND in ("auto", "db"):
+    backend = setup_db_ngram_index(engine)
+    if backend:
+        logger.info(f"✅ N-gram product index ready ({backend})")
+
 app = FastAPI(
     title="Reorder Backend",
     version="0.1.1",
@@ -49,6 +57,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permette tutti i metodi
     allow_headers=["*"],  # Permette tutti gli header
+    # Header di risposta leggibili dal frontend (paginazione elenco fatture, retry dopo un 503)
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "Retry-After"],
 )
 
 
@@ -63,6 +73,20 @@ async def log_requests(request: Request, call_next):
 app.include_router(api_router, prefix="/api")
 
 
+@app.on_event("startup")
+async def start_import_workers():
+    """Avvia i worker degli import a job e riprende quelli rimasti a metà"""
+    try:
+        await import_job_manager.start(get_extractor)
+    except Exception as e:
+        logger.warning(f"⚠️ Import job workers not started: {e}")
+
+
+@app.on_event("shutdown")
+async def stop_import_workers():
+    await import_job_manager.stop()
+
+
 @app.get("/")
 def root():
     """Endpoint root per verificare che l'applicazione sia attiva"""
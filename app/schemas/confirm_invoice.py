@@ -22,6 +22,7 @@ class ConfirmInvoiceRequest(BaseModel):
     currency: str = "EUR"
     lines: List[ConfirmInvoiceLine]
     file_path: Optional[str] = None  # se salvi il pdf da qualche parte
+    layout_sample_id: Optional[str] = None  # dalla risposta di import: impara il layout del fornitore
 
 
 class ConfirmInvoiceResponse(BaseModel):
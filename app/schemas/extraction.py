@@ -0,0 +1,24 @@
+# app/schemas/extraction.py
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class ExtractionTierStats(BaseModel):
+    tier: str
+    model: str
+    calls: int
+    errors: int
+    truncated: int
+    latency_p50_ms: Optional[int] = None
+    latency_p95_ms: Optional[int] = None
+    avg_prompt_tokens: Optional[float] = None
+    avg_completion_tokens: Optional[float] = None
+    avg_budget_used: Optional[float] = None  # completion_tokens / max_tokens
+    avg_estimated_lines: Optional[float] = None
+    avg_lines_extracted: Optional[float] = None
+
+
+class ExtractionMetricsSummary(BaseModel):
+    days: int
+    total_calls: int
+    tiers: List[ExtractionTierStats]
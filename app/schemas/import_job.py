@@ -0,0 +1,26 @@
+# app/schemas/import_job.py
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+from app.schemas.invoice import InvoiceImportResponse
+
+
+class ImportJobStage(str, Enum):
+    uploaded = "uploaded"
+    extracting = "extracting"
+    matching = "matching"
+    done = "done"
+    failed = "failed"
+
+
+class ImportJobStatus(BaseModel):
+    job_id: str
+    stage: ImportJobStage
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    result: Optional[InvoiceImportResponse] = None  # presente solo con stage "done"
+    created_at: datetime
+    updated_at: datetime
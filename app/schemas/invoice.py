@@ -3,6 +3,7 @@ from typing import List, Optional
 from enum import Enum
 
 from pydantic import BaseModel, Field
+from pydantic.json_schema import SkipJsonSchema
 
 
 class InvoiceLineBase(BaseModel):
@@ -22,6 +23,13 @@ class SupplierInfo(BaseModel):
     address: Optional[str] = None
 
 
+class DroppedLine(BaseModel):
+    """Riga della risposta AI scartata perché troncata o non valida"""
+    index: int  # posizione nell'array "lines" della risposta
+    reason: str
+    fragment: Optional[str] = None
+
+
 class InvoiceExtraction(BaseModel):
     supplier: SupplierInfo
     invoice_number: Optional[str] = None
@@ -35,6 +43,9 @@ class InvoiceExtraction(BaseModel):
         None,
         description="Testo completo AI (json raw) per debug / rielaborazioni"
     )
+    # Non fanno parte dello schema inviato al modello
+    dropped_lines: SkipJsonSchema[List[DroppedLine]] = Field(default_factory=list)
+    layout_sample_id: SkipJsonSchema[Optional[str]] = None
 
 
 # === Modelli per risposta API di import ===
@@ -44,10 +55,18 @@ class LineMatchStatus(str, Enum):
     unmatched = "unmatched"
 
 
+class ProductSuggestion(BaseModel):
+    """Prodotto candidato per una riga non matchata, con score di similarità (0-1)"""
+    product_id: int
+    label: str
+    score: float
+
+
 class InvoiceLineWithMatch(InvoiceLineBase):
     deterministic_product_id: Optional[int] = None
     deterministic_product_label: Optional[str] = None
     match_status: LineMatchStatus = LineMatchStatus.unmatched
+    suggestions: List[ProductSuggestion] = []  # top-k prodotti simili per le righe non matchate
 
 
 class InvoiceImportResponse(BaseModel):
@@ -59,6 +78,8 @@ class InvoiceImportResponse(BaseModel):
     currency: Optional[str]
     total_amount: Optional[float] = None  # Totale documento comprensivo di IVA
     lines: List[InvoiceLineWithMatch]
+    dropped_lines: List[DroppedLine] = []  # righe perse per risposta AI troncata/malformata
+    layout_sample_id: Optional[str] = None  # da rimandare alla conferma per imparare il layout del fornitore
 
 class InvoiceListItem(BaseModel):
     id: int
@@ -68,10 +89,18 @@ class InvoiceListItem(BaseModel):
     currency: Optional[str]
     total_amount: Optional[float]
 
+class PeriodSummary(BaseModel):
+    period_start: str  # primo giorno del mese (YYYY-MM-DD), per data fattura
+    invoice_count: int
+    total_amount: float
+
+
 class DashboardSummary(BaseModel):
     total_invoices: int
     total_amount: float
     total_products: int
+    this_month: Optional[PeriodSummary] = None
+    last_month: Optional[PeriodSummary] = None
 
 
 # === Modelli per dettaglio fattura ===
@@ -14,6 +14,18 @@ class PriceVariation(BaseModel):
         from_attributes = True
 
 
+class PriceStats(BaseModel):
+    """Statistiche precalcolate dello storico prezzi (tabella product_price_stats)"""
+    current_price: float
+    current_price_date: str  # formato ISO (YYYY-MM-DD)
+    previous_price: Optional[float] = None
+    previous_price_date: Optional[str] = None
+    min_price: float
+    max_price: float
+    avg_price: float
+    purchase_count: int
+
+
 class Product(BaseModel):
     id: int
     product_code: Optional[str] = None  # Codice articolo/fornitore
@@ -46,6 +58,7 @@ class ProductDetail(BaseModel):
     name: str
     unit_price: Optional[float] = None
     unit_measure: Optional[str] = None
+    price_stats: Optional[PriceStats] = None  # None se il prodotto non è mai stato acquistato
     price_history: List[PriceHistoryEntry] = []
 
     class Config:
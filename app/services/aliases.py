@@ -0,0 +1,118 @@
+# app/services/aliases.py
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db.models import Product, ProductAlias
+from app.db.session import dialect_insert
+from app.services.ngram_index import ProductRef
+from app.services.normalization import description_hash, normalize_description
+
+AliasKey = Tuple[str, str]
+
+
+def alias_key(product_code: Optional[str], raw_description: Optional[str]) -> AliasKey:
+    """Chiave di un alias: (codice articolo o "", descrizione normalizzata)"""
+    return ((product_code or "").strip(), normalize_description(raw_description or ""))
+
+
+class ProductAliasCache:
+    """
+    Cache in memoria della tabella product_aliases, per fornitore.
+    Le decisioni confermate (fornitore, codice, descrizione) -> prodotto vengono
+    caricate con una query per fornitore e poi risolte con un lookup per chiave.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_supplier: Dict[int, Tuple[float, Dict[AliasKey, ProductRef]]] = {}
+
+    def _load(self, db: Session, supplier_id: int) -> Dict[AliasKey, ProductRef]:
+        with self._lock:
+            cached = self._by_supplier.get(supplier_id)
+        if cached and time.monotonic() - cached[0] < settings.ALIAS_CACHE_TTL_SECONDS:
+            return cached[1]
+
+        rows = (
+            db.query(ProductAlias.product_code, ProductAlias.normalized_description, Product.id, Product.name)
+            .join(Product, ProductAlias.product_id == Product.id)
+            .filter(ProductAlias.supplier_id == supplier_id)
+            .all()
+        )
+        aliases = {(code, description): ProductRef(product_id, name) for code, description, product_id, name in rows}
+        with self._lock:
+            self._by_supplier[supplier_id] = (time.monotonic(), aliases)
+        return aliases
+
+    def lookup(
+        self,
+        db: Session,
+        supplier_id: Optional[int],
+        product_code: Optional[str],
+        raw_description: Optional[str],
+    ) -> Optional[ProductRef]:
+        if not supplier_id or not settings.ALIAS_MATCHING_ENABLED:
+            return None
+        key = alias_key(product_code, raw_description)
+        if not key[0] and not key[1]:
+            return None
+        return self._load(db, supplier_id).get(key)
+
+    def invalidate(self, supplier_id: Optional[int] = None) -> None:
+        with self._lock:
+            if supplier_id is None:
+                self._by_supplier.clear()
+            else:
+                self._by_supplier.pop(supplier_id, None)
+
+
+# Istanza condivisa a livello di processo
+product_alias_cache = ProductAliasCache()
+
+
+def record_aliases(db: Session, supplier_id: int, entries: Iterable[Tuple[Optional[str], str, int]]) -> int:
+    """
+    Salva (nella transazione corrente) le decisioni confermate
+    (codice, descrizione, product_id) di un fornitore con un solo upsert:
+    inserisce le chiavi nuove e aggiorna quelle che ora puntano a un prodotto
+    diverso. Conferme concorrenti dello stesso fornitore non vanno in conflitto
+    sulla chiave univoca. Ritorna il numero di alias inseriti/aggiornati.
+    """
+    wanted: Dict[AliasKey, int] = {}
+    for product_code, raw_description, product_id in entries:
+        key = alias_key(product_code, raw_description)
+        if product_id and (key[0] or key[1]):
+            wanted[key] = product_id
+    if not wanted:
+        return 0
+
+    insert = dialect_insert(db)
+    statement = insert(ProductAlias.__table__).values([
+        dict(
+            supplier_id=supplier_id,
+            product_code=product_code,
+            normalized_description=description,
+            description_hash=description_hash(description),
+            product_id=product_id,
+        )
+        for (product_code, description), product_id in wanted.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=["supplier_id", "product_code", "description_hash"],
+        set_={"product_id": statement.excluded.product_id},
+        # Chiavi che puntano già allo stesso prodotto: nessuna scrittura
+        where=ProductAlias.__table__.c.product_id != statement.excluded.product_id,
+    ).returning(ProductAlias.__table__.c.id)
+    return len(db.execute(statement).all())
+
+
+def repoint_aliases(db: Session, source_product_id: int, target_product_id: int) -> int:
+    """Sposta gli alias di un prodotto unito (merge) sul prodotto destinazione"""
+    return (
+        db.query(ProductAlias)
+        .filter(ProductAlias.product_id == source_product_id)
+        .update({"product_id": target_product_id}, synchronize_session=False)
+    )
@@ -0,0 +1,125 @@
+# app/services/batch_import.py
+import asyncio
+import zipfile
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.services.import_pipeline import build_import_response, extract_invoice
+from app.services.upload_preprocessing import prepare_upload
+
+
+@dataclass
+class BatchItem:
+    """
+    Un file del batch: i byte vengono letti (e le immagini preprocessate) solo
+    quando tocca a lui. read è sincrona e ritorna (bytes, estensione effettiva).
+    """
+    filename: str
+    mime_ext: str
+    read: Callable[[], Tuple[bytes, str]]
+    size: Optional[int] = None
+
+
+def _mime_ext(filename: str) -> str:
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+
+def _zip_items(archive: zipfile.ZipFile) -> List[BatchItem]:
+    """
+    Membri dell'archivio, letti uno alla volta dal file caricato (già su disco
+    se grande): l'archivio non viene mai caricato in memoria per intero.
+    """
+    items = []
+    for info in archive.infolist():
+        name = info.filename
+        basename = name.rsplit("/", 1)[-1]
+        if info.is_dir() or name.startswith("__MACOSX/") or basename.startswith("."):
+            continue
+        mime_ext = _mime_ext(basename)
+        items.append(BatchItem(
+            filename=name,
+            mime_ext=mime_ext,
+            read=lambda name=name, mime_ext=mime_ext: _read_member(archive, name, mime_ext),
+            size=info.file_size,
+        ))
+    return items
+
+
+def collect_batch_items(files: List[UploadFile]) -> List[BatchItem]:
+    """File caricati singolarmente + contenuto degli eventuali archivi ZIP"""
+    items: List[BatchItem] = []
+    for upload in files:
+        filename = upload.filename or ""
+        if _mime_ext(filename) == "zip":
+            try:
+                items.extend(_zip_items(zipfile.ZipFile(upload.file)))
+            except zipfile.BadZipFile as e:
+                items.append(BatchItem(filename=filename, mime_ext="zip", read=_raise(ValueError(f"Archivio ZIP non valido: {e}"))))
+            continue
+        items.append(BatchItem(
+            filename=filename,
+            mime_ext=_mime_ext(filename),
+            read=lambda upload=upload: prepare_upload(upload.file, _mime_ext(upload.filename or "")),
+            size=upload.size,
+        ))
+    return items
+
+
+def _read_member(archive: zipfile.ZipFile, name: str, mime_ext: str) -> Tuple[bytes, str]:
+    with archive.open(name) as member:
+        return prepare_upload(member, mime_ext)
+
+
+def _raise(error: Exception) -> Callable[[], Tuple[bytes, str]]:
+    def read() -> Tuple[bytes, str]:
+        raise error
+    return read
+
+
+async def run_batch_import(extractor, items: List[BatchItem], use_cache: bool = True) -> AsyncIterator[dict]:
+    """
+    Estrae e matcha i file del batch in parallelo (al massimo BATCH_IMPORT_CONCURRENCY
+    per richiesta) e produce un risultato per file appena è pronto, più un riepilogo finale.
+    Fornitori risolti una volta per nome e una sola sessione DB per tutto il batch.
+    """
+    from app.db.session import SessionLocal
+
+    semaphore = asyncio.Semaphore(max(1, settings.BATCH_IMPORT_CONCURRENCY))
+    db_lock = asyncio.Lock()  # la sessione non è thread-safe: matching un file alla volta
+    db = SessionLocal()
+    supplier_ids: Dict[str, int] = {}
+
+    async def process(position: int, item: BatchItem) -> dict:
+        result = {"index": position, "filename": item.filename}
+        async with semaphore:
+            try:
+                if item.size is not None and item.size > settings.BATCH_IMPORT_MAX_FILE_BYTES:
+                    raise ValueError(f"File troppo grande ({item.size} byte)")
+                file_bytes, mime_ext = await run_in_threadpool(item.read)
+                extraction = await extract_invoice(extractor, file_bytes, mime_ext, use_cache=use_cache)
+                del file_bytes
+                async with db_lock:
+                    response = await run_in_threadpool(build_import_response, db, extraction, supplier_ids)
+            except Exception as e:
+                async with db_lock:
+                    await run_in_threadpool(db.rollback)
+                return {**result, "status": "error", "error": str(e)}
+        return {**result, "status": "ok", "result": response.model_dump(mode="json")}
+
+    tasks = [asyncio.create_task(process(position, item)) for position, item in enumerate(items)]
+    succeeded = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            succeeded += result["status"] == "ok"
+            yield result
+        yield {"summary": True, "total": len(items), "ok": succeeded, "errors": len(items) - succeeded}
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        db.close()
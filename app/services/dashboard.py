@@ -0,0 +1,93 @@
+# app/services/dashboard.py
+import threading
+import time
+from datetime import date
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db.models import Invoice, Product
+from app.schemas.invoice import DashboardSummary, PeriodSummary
+
+
+def month_bounds(today: date) -> Tuple[date, date, date]:
+    """Primo giorno del mese corrente, del precedente e del successivo"""
+    this_month = today.replace(day=1)
+    last_month = date(this_month.year - 1, 12, 1) if this_month.month == 1 else this_month.replace(month=this_month.month - 1)
+    next_month = date(this_month.year + 1, 1, 1) if this_month.month == 12 else this_month.replace(month=this_month.month + 1)
+    return this_month, last_month, next_month
+
+
+def compute_dashboard_summary(db: Session, today: date) -> DashboardSummary:
+    """
+    Tutti i numeri della dashboard con una sola query: aggregazione condizionale
+    sulle fatture (totali, mese corrente e precedente per data fattura) e conteggio
+    dei prodotti come sottoquery scalare.
+    """
+    this_month, last_month, next_month = month_bounds(today)
+    in_this_month = and_(Invoice.invoice_date >= this_month, Invoice.invoice_date < next_month)
+    in_last_month = and_(Invoice.invoice_date >= last_month, Invoice.invoice_date < this_month)
+
+    row = db.execute(
+        select(
+            func.count(Invoice.id),
+            func.coalesce(func.sum(Invoice.total_amount), 0),
+            func.coalesce(func.sum(case((in_this_month, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((in_this_month, Invoice.total_amount), else_=0)), 0),
+            func.coalesce(func.sum(case((in_last_month, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((in_last_month, Invoice.total_amount), else_=0)), 0),
+            select(func.count(Product.id)).scalar_subquery(),
+        )
+    ).one()
+    total_invoices, total_amount, this_count, this_amount, last_count, last_amount, total_products = row
+
+    return DashboardSummary(
+        total_invoices=total_invoices or 0,
+        total_amount=total_amount or 0.0,
+        total_products=total_products or 0,
+        this_month=PeriodSummary(period_start=this_month.isoformat(), invoice_count=this_count, total_amount=this_amount),
+        last_month=PeriodSummary(period_start=last_month.isoformat(), invoice_count=last_count, total_amount=last_amount),
+    )
+
+
+class DashboardSummaryCache:
+    """
+    Riepilogo della dashboard in memoria (per processo), per TTL e versione dei dati:
+    le scritture (conferma, eliminazione, unione prodotti) incrementano la versione
+    e il riepilogo viene ricalcolato alla lettura successiva. Un calcolo iniziato
+    prima di una scrittura resta marcato con la versione vecchia, quindi non viene
+    riusato. Le scritture di altri processi si vedono entro DASHBOARD_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._entry: Optional[Tuple[int, float, date, DashboardSummary]] = None
+
+    def get(self, db: Session) -> DashboardSummary:
+        today = date.today()
+        with self._lock:
+            version = self._version
+            entry = self._entry
+        if (
+            entry is not None
+            and entry[0] == version
+            and entry[2] == today  # al cambio di giorno (e di mese) si ricalcola
+            and time.monotonic() - entry[1] < settings.DASHBOARD_CACHE_TTL_SECONDS
+        ):
+            return entry[3]
+
+        summary = compute_dashboard_summary(db, today)
+        with self._lock:
+            self._entry = (version, time.monotonic(), today, summary)
+        return summary
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+
+
+# Istanza condivisa a livello di processo
+dashboard_summary_cache = DashboardSummaryCache()
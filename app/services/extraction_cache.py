@@ -0,0 +1,166 @@
+# app/services/extraction_cache.py
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(file_bytes: bytes) -> str:
+    """SHA-256 del contenuto del file caricato"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def extraction_cache_key(file_bytes: bytes, extractor_version: str) -> str:
+    """
+    Chiave di cache: hash del file + versione di modello/prompt.
+    Se cambiano modello o prompt la chiave cambia e le vecchie voci scadono da sole.
+    """
+    return f"{file_hash(file_bytes)}-{extractor_version}"
+
+
+class ExtractionCache(ABC):
+    """Interfaccia comune dei backend di cache delle estrazioni (dati = InvoiceExtraction serializzata)"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, data: dict) -> None:
+        ...
+
+
+class DiskExtractionCache(ExtractionCache):
+    """
+    Un file JSON per voce. Il mtime del file è l'ultimo accesso (politica LRU),
+    la data di creazione è salvata nel file (TTL).
+    """
+
+    def __init__(self, directory: str, ttl_seconds: int, max_entries: int):
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # aggiorna l'ultimo accesso
+        return entry.get("data")
+
+    def set(self, key: str, data: dict) -> None:
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "data": data}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for path in entries[:max(0, len(entries) - self.max_entries)]:
+            path.unlink(missing_ok=True)
+
+
+class DatabaseExtractionCache(ExtractionCache):
+    """Voci salvate nella tabella extraction_cache (condivisa tra processi/istanze)"""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    def get(self, key: str) -> Optional[dict]:
+        from app.db.models import ExtractionCacheEntry
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            entry = db.get(ExtractionCacheEntry, key)
+            if entry is None:
+                return None
+            now = datetime.utcnow()
+            if entry.created_at < now - timedelta(seconds=self.ttl_seconds):
+                db.delete(entry)
+                db.commit()
+                return None
+            entry.last_accessed_at = now
+            data = json.loads(entry.data)
+            db.commit()
+            return data
+        finally:
+            db.close()
+
+    def set(self, key: str, data: dict) -> None:
+        from app.db.models import ExtractionCacheEntry
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.merge(ExtractionCacheEntry(
+                key=key,
+                data=json.dumps(data, ensure_ascii=False),
+                created_at=now,
+                last_accessed_at=now,
+            ))
+            db.flush()
+
+            # Eviction: voci scadute e, oltre il limite, quelle usate meno di recente
+            db.query(ExtractionCacheEntry).filter(
+                ExtractionCacheEntry.created_at < now - timedelta(seconds=self.ttl_seconds)
+            ).delete(synchronize_session=False)
+            overflow = db.query(ExtractionCacheEntry.key).order_by(
+                ExtractionCacheEntry.last_accessed_at.desc()
+            ).offset(self.max_entries).all()
+            if overflow:
+                db.query(ExtractionCacheEntry).filter(
+                    ExtractionCacheEntry.key.in_([k for (k,) in overflow])
+                ).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+def get_extraction_cache() -> Optional[ExtractionCache]:
+    """Backend configurato (EXTRACTION_CACHE_BACKEND: "disk", "db" o "none")"""
+    backend = settings.EXTRACTION_CACHE_BACKEND
+    if backend == "disk":
+        directory = settings.EXTRACTION_CACHE_DIR or os.path.join(tempfile.gettempdir(), "reorder-extraction-cache")
+        try:
+            return DiskExtractionCache(
+                directory,
+                ttl_seconds=settings.EXTRACTION_CACHE_TTL_SECONDS,
+                max_entries=settings.EXTRACTION_CACHE_MAX_ENTRIES,
+            )
+        except OSError as e:
+            logger.warning(f"⚠️ Extraction cache directory not available, cache disabled: {e}")
+            return None
+    if backend == "db":
+        return DatabaseExtractionCache(
+            ttl_seconds=settings.EXTRACTION_CACHE_TTL_SECONDS,
+            max_entries=settings.EXTRACTION_CACHE_MAX_ENTRIES,
+        )
+    return None
@@ -0,0 +1,88 @@
+# app/services/extraction_metrics.py
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.schemas.extraction import ExtractionMetricsSummary, ExtractionTierStats
+
+logger = logging.getLogger(__name__)
+
+
+def record_extraction_call(**values) -> None:
+    """
+    Salva una chiamata al modello in extraction_metrics (campi di ExtractionMetric).
+    Sincrona, da chiamare nel thread pool; un errore non fa fallire l'import.
+    """
+    if not settings.EXTRACTION_METRICS_ENABLED:
+        return
+
+    from app.db.models import ExtractionMetric
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.add(ExtractionMetric(created_at=datetime.utcnow(), **values))
+        db.commit()
+    except Exception as e:
+        logger.warning(f"⚠️ Extraction metric not recorded: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _percentile(sorted_values: List[int], fraction: float) -> Optional[int]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _average(values: List[float]) -> Optional[float]:
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def summarize_extraction_metrics(db: Session, days: int = 30) -> ExtractionMetricsSummary:
+    """Statistiche per tier e modello delle chiamate degli ultimi `days` giorni"""
+    from app.db.models import ExtractionMetric
+
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = (
+        db.query(
+            ExtractionMetric.tier, ExtractionMetric.model, ExtractionMetric.max_tokens,
+            ExtractionMetric.prompt_tokens, ExtractionMetric.completion_tokens, ExtractionMetric.latency_ms,
+            ExtractionMetric.estimated_lines, ExtractionMetric.lines_extracted,
+            ExtractionMetric.truncated, ExtractionMetric.error,
+        )
+        .filter(ExtractionMetric.created_at >= since)
+        .all()
+    )
+
+    groups: Dict[tuple, list] = {}
+    for row in rows:
+        groups.setdefault((row.tier, row.model), []).append(row)
+
+    tiers = []
+    for (tier, model), calls in sorted(groups.items()):
+        latencies = sorted(call.latency_ms for call in calls)
+        succeeded = [call for call in calls if call.error is None]
+        tiers.append(ExtractionTierStats(
+            tier=tier,
+            model=model,
+            calls=len(calls),
+            errors=len(calls) - len(succeeded),
+            truncated=sum(1 for call in calls if call.truncated),
+            latency_p50_ms=_percentile(latencies, 0.50),
+            latency_p95_ms=_percentile(latencies, 0.95),
+            avg_prompt_tokens=_average([call.prompt_tokens for call in succeeded if call.prompt_tokens]),
+            avg_completion_tokens=_average([call.completion_tokens for call in succeeded if call.completion_tokens]),
+            # Quota del budget effettivamente usata: vicino a 1 -> soglie troppo strette
+            avg_budget_used=_average([
+                call.completion_tokens / call.max_tokens
+                for call in succeeded if call.completion_tokens and call.max_tokens
+            ]),
+            avg_estimated_lines=_average([call.estimated_lines for call in calls if call.estimated_lines is not None]),
+            avg_lines_extracted=_average([call.lines_extracted for call in succeeded if call.lines_extracted is not None]),
+        ))
+    return ExtractionMetricsSummary(days=days, total_calls=len(rows), tiers=tiers)
@@ -0,0 +1,134 @@
+# app/services/extraction_routing.py
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Partita IVA italiana (11 cifre, eventualmente con prefisso IT)
+_VAT_NUMBER = re.compile(r"\b(?:IT)?(\d{11})\b")
+# Riga di tabella con almeno un importo (es "12,50" o "1.234.00")
+_AMOUNT = re.compile(r"\d[.,]\d{2}\b")
+
+
+@dataclass(frozen=True)
+class DocumentProfile:
+    """Quello che si sa del documento prima di chiamare il modello"""
+    mime_ext: str
+    file_size: int
+    page_count: int
+    input_kind: str  # "text" se al modello va il text layer, altrimenti "media"
+    estimated_lines: int
+    supplier_lines: Optional[int] = None  # righe massime delle fatture recenti del fornitore
+
+
+@dataclass(frozen=True)
+class ExtractionRoute:
+    tier: str  # "fast" o "standard"
+    model: str
+    max_tokens: int
+
+
+def count_amount_rows(text: str) -> int:
+    """Righe del text layer che contengono almeno un importo: stima per eccesso delle righe fattura"""
+    return sum(1 for row in text.splitlines() if _AMOUNT.search(row))
+
+
+def supplier_line_history(text: str) -> Optional[int]:
+    """
+    Righe della fattura più lunga tra le ultime EXTRACTION_HISTORY_INVOICES del fornitore,
+    riconosciuto dalla partita IVA presente nel testo. Disponibile solo con il text layer:
+    per immagini e scansioni il fornitore si conosce solo dopo l'estrazione.
+    """
+    candidates = set(_VAT_NUMBER.findall(text))
+    if not candidates:
+        return None
+
+    from sqlalchemy import func
+
+    from app.db.models import Invoice, InvoiceLine, Supplier
+    from app.db.session import SessionLocal
+
+    vat_numbers = list(candidates) + [f"IT{vat}" for vat in candidates]
+    db = SessionLocal()
+    try:
+        supplier_ids = [
+            supplier_id for (supplier_id,) in
+            db.query(Supplier.id).filter(Supplier.vat_number.in_(vat_numbers)).all()
+        ]
+        if not supplier_ids:
+            return None
+        recent = (
+            db.query(Invoice.id)
+            .filter(Invoice.supplier_id.in_(supplier_ids))
+            .order_by(Invoice.id.desc())
+            .limit(max(1, settings.EXTRACTION_HISTORY_INVOICES))
+            .subquery()
+        )
+        counts = (
+            db.query(func.count(InvoiceLine.id))
+            .filter(InvoiceLine.invoice_id.in_(db.query(recent.c.id)))
+            .group_by(InvoiceLine.invoice_id)
+            .all()
+        )
+        return max((count for (count,) in counts), default=None)
+    except Exception as e:
+        logger.warning(f"⚠️ Supplier history lookup failed: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def profile_document(
+    file_bytes: bytes, mime_ext: str, page_count: Optional[int], text: Optional[str], use_history: bool = True
+) -> DocumentProfile:
+    """
+    Stima delle righe: storico del fornitore se riconosciuto, altrimenti righe del
+    text layer con importi, altrimenti EXTRACTION_LINES_PER_PAGE per pagina.
+    """
+    pages = max(1, page_count or 1)
+    supplier_lines = supplier_line_history(text) if text and use_history else None
+    if supplier_lines is not None:
+        estimated_lines = supplier_lines
+    elif text is not None:
+        estimated_lines = count_amount_rows(text)
+    else:
+        estimated_lines = pages * settings.EXTRACTION_LINES_PER_PAGE
+
+    return DocumentProfile(
+        mime_ext=mime_ext.lower(),
+        file_size=len(file_bytes),
+        page_count=pages,
+        input_kind="text" if text is not None else "media",
+        estimated_lines=estimated_lines,
+        supplier_lines=supplier_lines,
+    )
+
+
+def token_budget(estimated_lines: int) -> int:
+    """max_tokens per il numero di righe stimato, entro EXTRACTION_MIN_TOKENS..EXTRACTION_MAX_TOKENS"""
+    budget = (settings.EXTRACTION_BASE_TOKENS + estimated_lines * settings.EXTRACTION_TOKENS_PER_LINE) * settings.EXTRACTION_TOKEN_MARGIN
+    return int(min(settings.EXTRACTION_MAX_TOKENS, max(settings.EXTRACTION_MIN_TOKENS, budget)))
+
+
+def choose_route(profile: DocumentProfile) -> ExtractionRoute:
+    """Modello e budget per il documento (routing disattivato: modello standard e budget massimo)"""
+    if not settings.EXTRACTION_ROUTING_ENABLED:
+        return full_route()
+
+    max_tokens = token_budget(profile.estimated_lines)
+    if (
+        profile.page_count == 1
+        and profile.file_size <= settings.EXTRACTION_FAST_MAX_BYTES
+        and max_tokens <= settings.EXTRACTION_FAST_MAX_TOKENS
+    ):
+        return ExtractionRoute(tier="fast", model=settings.EXTRACTION_MODEL_FAST, max_tokens=max_tokens)
+    return ExtractionRoute(tier="standard", model=settings.EXTRACTION_MODEL, max_tokens=max_tokens)
+
+
+def full_route(tier: str = "standard") -> ExtractionRoute:
+    """Modello standard con il budget massimo (routing disattivato o nuovo tentativo dopo troncamento)"""
+    return ExtractionRoute(tier=tier, model=settings.EXTRACTION_MODEL, max_tokens=settings.EXTRACTION_MAX_TOKENS)
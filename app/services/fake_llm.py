@@ -0,0 +1,142 @@
+# app/services/fake_llm.py
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple, Union
+
+from datapizza.core.clients.models import ClientResponse, TokenUsage
+from datapizza.type import TextBlock
+
+
+class FakeProviderError(Exception):
+    """Errore HTTP simulato del provider (status_code come gli errori del client OpenAI)"""
+
+    def __init__(self, status_code: int, message: str = "errore simulato"):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+
+
+def _default_response(**_) -> str:
+    return json.dumps({
+        "supplier": {"name": "Fornitore di prova"},
+        "invoice_number": "TEST-1",
+        "invoice_date": "2025-01-15",
+        "currency": "EUR",
+        "total_amount": 12.2,
+        "lines": [{"raw_description": "Articolo di prova", "quantity": 1, "unit_price": 10.0, "total": 10.0, "vat_rate": 22}],
+    })
+
+
+class FakeLLMClient:
+    """
+    Client locale con la stessa interfaccia di OpenAIClient (invoke, a_invoke,
+    a_stream_invoke) che inietta latenza e guasti, per provare retry, scadenze,
+    hedging e circuit breaker senza chiamare il provider.
+
+    latency / jitter: secondi di latenza base + variazione casuale
+    seconds_per_1k_tokens: tempo di generazione aggiunto per 1000 token di output
+    slow_rate / slow_latency: quota di chiamate lente (coda della latenza) e loro durata
+    error_rate / error_status: quota di chiamate che falliscono con FakeProviderError
+    hang_rate: quota di chiamate che non rispondono mai (scatta la scadenza)
+    response: testo della risposta, o funzione che lo produce dagli argomenti della chiamata
+    """
+
+    def __init__(
+        self,
+        response: Union[str, Callable[..., str], None] = None,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        seconds_per_1k_tokens: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 10.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        hang_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.response = response if response is not None else _default_response
+        self.latency = latency
+        self.jitter = jitter
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _plan(self) -> tuple:
+        """(latenza, errore da sollevare o None) per la prossima chiamata"""
+        with self._lock:
+            self.calls += 1
+            roll = self._random.random()
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if roll < self.hang_rate:
+                return float("inf"), None
+            if roll < self.hang_rate + self.error_rate:
+                return delay, FakeProviderError(self.error_status)
+            if self._random.random() < self.slow_rate:
+                delay = self.slow_latency
+            return delay, None
+
+    def _reply(self, kwargs: dict) -> Tuple[ClientResponse, float]:
+        """
+        (risposta, secondi di generazione) per gli argomenti della chiamata;
+        le sottoclassi cercano la risposta tra quelle registrate o la generano.
+        """
+        text = self.response(**kwargs) if callable(self.response) else self.response
+        response = self._response(text)
+        return response, self._generation_seconds(response)
+
+    def _generation_seconds(self, response: ClientResponse) -> float:
+        return response.usage.completion_tokens / 1000 * self.seconds_per_1k_tokens
+
+    def _response(self, text: str, stop_reason: str = "completed", prompt_tokens: int = 1000, completion_tokens: Optional[int] = None) -> ClientResponse:
+        return ClientResponse(
+            content=[TextBlock(content=text)],
+            stop_reason=stop_reason,
+            usage=TokenUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens if completion_tokens is not None else max(1, len(text) // 4),
+            ),
+        )
+
+    def invoke(self, **kwargs) -> ClientResponse:
+        delay, error = self._plan()
+        if error is None:
+            response, generation = self._reply(kwargs)
+            delay += generation
+        time.sleep(min(delay, 3600))
+        if error is not None:
+            raise error
+        return response
+
+    async def a_invoke(self, **kwargs) -> ClientResponse:
+        delay, error = self._plan()
+        if error is None:
+            response, generation = self._reply(kwargs)
+            delay += generation
+        await asyncio.sleep(min(delay, 3600))
+        if error is not None:
+            raise error
+        return response
+
+    async def a_stream_invoke(self, **kwargs):
+        """La latenza pianificata precede il primo chunk, la generazione è distribuita sui chunk"""
+        delay, error = self._plan()
+        if error is None:
+            response, generation = self._reply(kwargs)
+        await asyncio.sleep(min(delay, 3600))
+        if error is not None:
+            raise error
+        text = response.text
+        chunks = range(0, len(text), 40)
+        for start in chunks:
+            if generation:
+                await asyncio.sleep(generation / len(chunks))
+            yield ClientResponse(content=[], delta=text[start:start + 40])
+        yield response
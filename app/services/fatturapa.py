@@ -0,0 +1,209 @@
+# app/services/fatturapa.py
+import base64
+import binascii
+import io
+import re
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+from app.schemas.invoice import InvoiceExtraction, InvoiceLineBase, SupplierInfo
+
+# Estensioni della fattura elettronica SDI (FatturaPA), lette senza AI
+STRUCTURED_INVOICE_EXTENSIONS = {"xml", "p7m"}
+
+# OID id-data (1.2.840.113549.1.7.1) codificato DER
+_ID_DATA_OID = bytes.fromhex("2a864886f70d010701")
+
+
+def is_structured_invoice(mime_ext: str) -> bool:
+    return (mime_ext or "").lower() in STRUCTURED_INVOICE_EXTENSIONS
+
+
+# --- busta firmata CAdES (.p7m) ---
+
+def _read_header(data: bytes, pos: int) -> Tuple[int, bool, Optional[int], int]:
+    """Header BER: (tag, constructed, lunghezza o None se indefinita, inizio contenuto)"""
+    first = data[pos]
+    tag = first & 0x1F
+    constructed = bool(first & 0x20)
+    pos += 1
+    if tag == 0x1F:  # tag multi-byte
+        tag = 0
+        while data[pos] & 0x80:
+            tag = (tag << 7) | (data[pos] & 0x7F)
+            pos += 1
+        tag = (tag << 7) | data[pos]
+        pos += 1
+    tag |= first & 0xC0  # classe (universal/context...)
+    length_byte = data[pos]
+    pos += 1
+    if length_byte == 0x80:
+        return tag, constructed, None, pos
+    if length_byte & 0x80:
+        count = length_byte & 0x7F
+        length = int.from_bytes(data[pos:pos + count], "big")
+        return tag, constructed, length, pos + count
+    return tag, constructed, length_byte, pos
+
+
+def _octets(data: bytes, pos: int, out: List[bytes]) -> int:
+    """
+    Raccoglie i byte di un OCTET STRING (primitivo o costruito a segmenti, anche
+    con lunghezza indefinita) a partire da pos; ritorna la posizione successiva.
+    """
+    tag, constructed, length, start = _read_header(data, pos)
+    if not constructed:
+        out.append(data[start:start + length])
+        return start + length
+    pos = start
+    end = start + length if length is not None else None
+    while end is None or pos < end:
+        if end is None and data[pos:pos + 2] == b"\x00\x00":
+            return pos + 2
+        pos = _octets(data, pos, out)
+    return pos
+
+
+def extract_p7m_content(file_bytes: bytes) -> bytes:
+    """
+    Contenuto firmato di una busta PKCS#7/CAdES: dopo l'OID id-data dell'encapContentInfo
+    c'è [0] EXPLICIT con l'OCTET STRING dell'XML. Walker BER minimale, senza
+    verificare la firma (il documento arriva già validato dallo SDI).
+    """
+    data = file_bytes
+    if not data.startswith(b"\x30"):
+        # p7m salvato in base64
+        try:
+            data = base64.b64decode(re.sub(rb"\s+", b"", data), validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError("File .p7m non valido")
+
+    oid = b"\x06" + bytes([len(_ID_DATA_OID)]) + _ID_DATA_OID
+    pos = data.find(oid)
+    while pos != -1:
+        after = pos + len(oid)
+        if after < len(data) and data[after] == 0xA0:  # [0] EXPLICIT eContent
+            _, _, _, content_start = _read_header(data, after)
+            chunks: List[bytes] = []
+            _octets(data, content_start, chunks)
+            return b"".join(chunks)
+        pos = data.find(oid, after)
+    raise ValueError("Contenuto XML non trovato nel file .p7m")
+
+
+# --- parsing XML ---
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    if value is None or not value.strip():
+        return None
+    try:
+        return float(value.strip())
+    except ValueError:
+        return None
+
+
+def parse_fatturapa(file_bytes: bytes, mime_ext: str = "xml") -> InvoiceExtraction:
+    """
+    Fattura elettronica FatturaPA (.xml o .xml.p7m) -> InvoiceExtraction, in modo
+    deterministico. Parsing con iterparse: ogni DettaglioLinee viene convertito e
+    liberato appena chiuso, la memoria resta costante anche con migliaia di righe.
+    Per i lotti con più fatture viene letta la prima (FatturaElettronicaBody).
+    """
+    if mime_ext.lower() == "p7m":
+        file_bytes = extract_p7m_content(file_bytes)
+
+    supplier: Dict[str, str] = {}
+    header: Dict[str, str] = {}
+    current_line: Dict[str, str] = {}
+    lines: List[InvoiceLineBase] = []
+    summary_total = 0.0
+    has_summary = False
+    path: List[str] = []
+    bodies = 0
+
+    try:
+        for event, elem in ET.iterparse(io.BytesIO(file_bytes), events=("start", "end")):
+            name = _local(elem.tag)
+            if event == "start":
+                path.append(name)
+                if name == "FatturaElettronicaBody":
+                    bodies += 1
+                elif name == "DettaglioLinee":
+                    current_line = {}
+                continue
+
+            text = (elem.text or "").strip()
+            parent = path[-2] if len(path) > 1 else ""
+            in_first_body = bodies == 1 and "FatturaElettronicaBody" in path
+
+            if "CedentePrestatore" in path:
+                if parent == "IdFiscaleIVA" and name in ("IdPaese", "IdCodice"):
+                    supplier[name] = text
+                elif parent == "Anagrafica" and name in ("Denominazione", "Nome", "Cognome"):
+                    supplier[name] = text
+                elif parent == "Sede" and name in ("Indirizzo", "NumeroCivico", "CAP", "Comune", "Provincia"):
+                    supplier[name] = text
+
+            elif in_first_body:
+                if parent == "DatiGeneraliDocumento" and name in ("Divisa", "Data", "Numero", "ImportoTotaleDocumento"):
+                    header[name] = text
+                elif "DettaglioLinee" in path:
+                    if name == "DettaglioLinee":
+                        lines.append(_build_line(current_line, header.get("Divisa")))
+                    elif parent == "CodiceArticolo" and name == "CodiceValore":
+                        current_line.setdefault("CodiceValore", text)
+                    elif parent == "DettaglioLinee":
+                        current_line[name] = text
+                elif parent == "DatiRiepilogo" and name in ("ImponibileImporto", "Imposta"):
+                    summary_total += _float(text) or 0.0
+                    has_summary = True
+
+            path.pop()
+            # Libera gli elementi già letti (righe, allegati base64...)
+            if name in ("DettaglioLinee", "DatiRiepilogo", "Allegati", "CedentePrestatore"):
+                elem.clear()
+    except ET.ParseError as e:
+        raise ValueError(f"XML FatturaPA non valido: {e}") from e
+
+    if not supplier and not header:
+        raise ValueError("Il file XML non è una fattura elettronica FatturaPA")
+
+    name = supplier.get("Denominazione") or " ".join(
+        part for part in (supplier.get("Nome"), supplier.get("Cognome")) if part
+    )
+    vat_number = (supplier.get("IdPaese", "") + supplier.get("IdCodice", "")) or None
+    address = ", ".join(part for part in (
+        " ".join(p for p in (supplier.get("Indirizzo"), supplier.get("NumeroCivico")) if p),
+        " ".join(p for p in (supplier.get("CAP"), supplier.get("Comune")) if p),
+        supplier.get("Provincia"),
+    ) if part) or None
+
+    total_amount = _float(header.get("ImportoTotaleDocumento"))
+    if total_amount is None and has_summary:
+        total_amount = round(summary_total, 2)
+
+    return InvoiceExtraction(
+        supplier=SupplierInfo(name=name or "Fornitore sconosciuto", vat_number=vat_number, address=address),
+        invoice_number=header.get("Numero"),
+        invoice_date=header.get("Data"),
+        currency=header.get("Divisa") or "EUR",
+        total_amount=total_amount,
+        lines=lines,
+    )
+
+
+def _build_line(values: Dict[str, str], currency: Optional[str]) -> InvoiceLineBase:
+    return InvoiceLineBase(
+        raw_description=values.get("Descrizione", ""),
+        product_code=values.get("CodiceValore") or None,
+        quantity=_float(values.get("Quantita")),
+        unit_price=_float(values.get("PrezzoUnitario")),
+        total=_float(values.get("PrezzoTotale")),
+        vat_rate=_float(values.get("AliquotaIVA")),
+        unit_measure=values.get("UnitaMisura") or None,
+        currency=currency or "EUR",
+    )
@@ -0,0 +1,539 @@
+# app/services/import_jobs.py
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.schemas.import_job import ImportJobStage, ImportJobStatus
+from app.schemas.invoice import InvoiceImportResponse
+from app.services.fatturapa import is_structured_invoice
+from app.services.import_pipeline import build_import_response, extract_invoice
+
+logger = logging.getLogger(__name__)
+
+class LeaseLostError(RuntimeError):
+    """Il job non è più in carico a questo processo: l'elaborazione va abbandonata"""
+
+
+FINAL_STAGES = {ImportJobStage.done.value, ImportJobStage.failed.value}
+STAGE_ORDER = {stage.value: position for position, stage in enumerate(ImportJobStage)}
+
+
+@dataclass(frozen=True)
+class ImportJobRecord:
+    id: str
+    filename: Optional[str]
+    mime_ext: str
+    use_cache: bool
+    stage: str
+    result: Optional[dict]
+    error: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+    claimed_by: Optional[str] = None
+    lease_until: Optional[datetime] = None
+
+    def is_newer_than(self, other: "ImportJobRecord") -> bool:
+        """
+        Stato successivo a other: per updated_at, a parità per ordine dello stage.
+        Un job ripreso dopo un lease scaduto può tornare a uno stage precedente,
+        ma con un updated_at più recente.
+        """
+        return (self.updated_at, STAGE_ORDER[self.stage]) > (other.updated_at, STAGE_ORDER[other.stage])
+
+    def to_status(self) -> ImportJobStatus:
+        return ImportJobStatus(
+            job_id=self.id,
+            stage=self.stage,
+            filename=self.filename,
+            error=self.error,
+            result=InvoiceImportResponse(**self.result) if self.result else None,
+            created_at=self.created_at,
+            updated_at=self.updated_at,
+        )
+
+
+class ImportJobStore(ABC):
+    """Persistenza dei job (metodi sincroni, chiamati dal thread pool)"""
+
+    @abstractmethod
+    def create(self, job: ImportJobRecord, file_bytes: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[ImportJobRecord]:
+        ...
+
+    @abstractmethod
+    def load_file(self, job_id: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def update(
+        self, job_id: str, owner: str, stage: str, result: Optional[dict] = None, error: Optional[str] = None
+    ) -> Optional[ImportJobRecord]:
+        """
+        Aggiorna lo stage di un job in carico a owner; a job concluso il file non
+        serve più e viene rimosso. Ritorna None se owner non ha più il job (lease
+        scaduto e ripreso da un altro processo, oppure job già concluso).
+        """
+
+    @abstractmethod
+    def claim(self, job_id: str, owner: str, lease_seconds: float) -> Optional[ImportJobRecord]:
+        """
+        Prende in carico il job in modo atomico (stage "extracting", lease di owner):
+        riesce solo se il job non è concluso e non ha un lease valido di un altro
+        processo. Ritorna None se il job è già in carico altrove.
+        """
+
+    @abstractmethod
+    def renew(self, job_id: str, owner: str, lease_seconds: float) -> bool:
+        """Prolunga il lease finché owner sta elaborando il job; False se l'ha perso"""
+
+    @abstractmethod
+    def unfinished(self) -> List[str]:
+        """Id dei job non conclusi e senza un lease valido, dal più vecchio"""
+
+
+def _claimable(job: ImportJobRecord, now: datetime) -> bool:
+    return job.stage not in FINAL_STAGES and (job.lease_until is None or job.lease_until < now)
+
+
+class MemoryImportJobStore(ImportJobStore):
+    """Job in memoria del processo: per test e sviluppo, si perdono al riavvio"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ImportJobRecord] = {}
+        self._files: Dict[str, bytes] = {}
+
+    def create(self, job: ImportJobRecord, file_bytes: bytes) -> None:
+        with self._lock:
+            self._jobs[job.id] = job
+            self._files[job.id] = file_bytes
+
+    def get(self, job_id: str) -> Optional[ImportJobRecord]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def load_file(self, job_id: str) -> Optional[bytes]:
+        with self._lock:
+            return self._files.get(job_id)
+
+    def update(
+        self, job_id: str, owner: str, stage: str, result: Optional[dict] = None, error: Optional[str] = None
+    ) -> Optional[ImportJobRecord]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.claimed_by != owner or job.stage in FINAL_STAGES:
+                return None
+            job = replace(job, stage=stage, result=result, error=error, updated_at=datetime.utcnow())
+            if stage in FINAL_STAGES:
+                job = replace(job, claimed_by=None, lease_until=None)
+                self._files.pop(job_id, None)
+            self._jobs[job_id] = job
+            return job
+
+    def claim(self, job_id: str, owner: str, lease_seconds: float) -> Optional[ImportJobRecord]:
+        with self._lock:
+            now = datetime.utcnow()
+            job = self._jobs.get(job_id)
+            if job is None or not _claimable(job, now):
+                return None
+            job = replace(
+                job,
+                stage=ImportJobStage.extracting.value,
+                claimed_by=owner,
+                lease_until=now + timedelta(seconds=lease_seconds),
+                updated_at=now,
+            )
+            self._jobs[job_id] = job
+            return job
+
+    def renew(self, job_id: str, owner: str, lease_seconds: float) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.claimed_by != owner or job.stage in FINAL_STAGES:
+                return False
+            self._jobs[job_id] = replace(job, lease_until=datetime.utcnow() + timedelta(seconds=lease_seconds))
+            return True
+
+    def unfinished(self) -> List[str]:
+        with self._lock:
+            now = datetime.utcnow()
+            jobs = sorted(self._jobs.values(), key=lambda j: j.created_at)
+            return [j.id for j in jobs if _claimable(j, now)]
+
+
+class DatabaseImportJobStore(ImportJobStore):
+    """Job nella tabella import_jobs: sopravvivono al riavvio del worker"""
+
+    @staticmethod
+    def _record(job) -> ImportJobRecord:
+        return ImportJobRecord(
+            id=job.id,
+            filename=job.filename,
+            mime_ext=job.mime_ext,
+            use_cache=job.use_cache,
+            stage=job.stage,
+            result=json.loads(job.result) if job.result else None,
+            error=job.error,
+            created_at=job.created_at,
+            updated_at=job.updated_at,
+            claimed_by=job.claimed_by,
+            lease_until=job.lease_until,
+        )
+
+    @staticmethod
+    def _claimable_filter(now: datetime):
+        from sqlalchemy import or_
+
+        from app.db.models import ImportJob
+
+        return (
+            ImportJob.stage.notin_(FINAL_STAGES),
+            or_(ImportJob.lease_until.is_(None), ImportJob.lease_until < now),
+        )
+
+    def create(self, job: ImportJobRecord, file_bytes: bytes) -> None:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            db.add(ImportJob(
+                id=job.id,
+                filename=job.filename,
+                mime_ext=job.mime_ext,
+                use_cache=job.use_cache,
+                stage=job.stage,
+                file_data=file_bytes,
+                created_at=job.created_at,
+                updated_at=job.updated_at,
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+    def get(self, job_id: str) -> Optional[ImportJobRecord]:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            # Senza caricare il file (può essere grande)
+            row = db.query(
+                ImportJob.id, ImportJob.filename, ImportJob.mime_ext, ImportJob.use_cache, ImportJob.stage,
+                ImportJob.result, ImportJob.error, ImportJob.created_at, ImportJob.updated_at,
+                ImportJob.claimed_by, ImportJob.lease_until,
+            ).filter(ImportJob.id == job_id).first()
+            return self._record(row) if row else None
+        finally:
+            db.close()
+
+    def load_file(self, job_id: str) -> Optional[bytes]:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            return db.query(ImportJob.file_data).filter(ImportJob.id == job_id).scalar()
+        finally:
+            db.close()
+
+    def update(
+        self, job_id: str, owner: str, stage: str, result: Optional[dict] = None, error: Optional[str] = None
+    ) -> Optional[ImportJobRecord]:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            values = {
+                "stage": stage,
+                "result": json.dumps(result, ensure_ascii=False) if result is not None else None,
+                "error": error,
+                "updated_at": datetime.utcnow(),
+            }
+            if stage in FINAL_STAGES:
+                values.update(file_data=None, claimed_by=None, lease_until=None)
+            # Solo chi ha ancora il lease: un worker che l'ha perso non sovrascrive il job
+            updated = (
+                db.query(ImportJob)
+                .filter(ImportJob.id == job_id, ImportJob.claimed_by == owner, ImportJob.stage.notin_(FINAL_STAGES))
+                .update(values, synchronize_session=False)
+            )
+            db.commit()
+        finally:
+            db.close()
+        return self.get(job_id) if updated else None
+
+    def claim(self, job_id: str, owner: str, lease_seconds: float) -> Optional[ImportJobRecord]:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            # UPDATE condizionato: con più processi solo uno trova la riga ancora libera
+            now = datetime.utcnow()
+            claimed = (
+                db.query(ImportJob)
+                .filter(ImportJob.id == job_id, *self._claimable_filter(now))
+                .update(
+                    {
+                        "stage": ImportJobStage.extracting.value,
+                        "claimed_by": owner,
+                        "lease_until": now + timedelta(seconds=lease_seconds),
+                        "updated_at": now,
+                    },
+                    synchronize_session=False,
+                )
+            )
+            db.commit()
+        finally:
+            db.close()
+        return self.get(job_id) if claimed else None
+
+    def renew(self, job_id: str, owner: str, lease_seconds: float) -> bool:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            renewed = (
+                db.query(ImportJob)
+                .filter(ImportJob.id == job_id, ImportJob.claimed_by == owner, ImportJob.stage.notin_(FINAL_STAGES))
+                .update(
+                    {"lease_until": datetime.utcnow() + timedelta(seconds=lease_seconds)},
+                    synchronize_session=False,
+                )
+            )
+            db.commit()
+            return bool(renewed)
+        finally:
+            db.close()
+
+    def unfinished(self) -> List[str]:
+        from app.db.models import ImportJob
+        from app.db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(ImportJob.id)
+                .filter(*self._claimable_filter(datetime.utcnow()))
+                .order_by(ImportJob.created_at)
+                .all()
+            )
+            return [job_id for (job_id,) in rows]
+        finally:
+            db.close()
+
+
+def get_import_job_store() -> ImportJobStore:
+    """Backend configurato (IMPORT_JOB_BACKEND: "db" o "memory")"""
+    if settings.IMPORT_JOB_BACKEND == "memory":
+        return MemoryImportJobStore()
+    return DatabaseImportJobStore()
+
+
+class ImportJobManager:
+    """
+    Coda in-process + pool limitato di worker asyncio che eseguono estrazione e
+    matching dei job. Gli aggiornamenti di stage vengono pubblicati agli
+    iscritti (stream SSE) e salvati nello store.
+
+    Con più processi (worker uvicorn, deploy) ogni job viene preso in carico con
+    un lease prima di essere elaborato: un job già in carico altrove viene saltato,
+    uno con il lease scaduto (processo terminato) viene ripreso.
+    """
+
+    def __init__(self, store: Optional[ImportJobStore] = None):
+        self._store = store
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._queued: Set[str] = set()
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._extractor_factory: Optional[Callable] = None
+
+    @property
+    def store(self) -> ImportJobStore:
+        if self._store is None:
+            self._store = get_import_job_store()
+        return self._store
+
+    @property
+    def running(self) -> bool:
+        return any(not worker.done() for worker in self._workers)
+
+    async def start(self, extractor_factory: Callable) -> None:
+        """Avvia i worker (idempotente) e rimette in coda i job rimasti a metà"""
+        self._extractor_factory = extractor_factory
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._queued.clear()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(max(1, settings.IMPORT_JOB_WORKERS))
+        ]
+        await self._requeue_unfinished()
+        self._workers.append(asyncio.create_task(self._requeue_loop()))
+
+    async def _requeue_unfinished(self) -> None:
+        """Job non conclusi senza lease valido: mai presi in carico o di un processo terminato"""
+        unfinished = await run_in_threadpool(self.store.unfinished)
+        requeued = [job_id for job_id in unfinished if job_id not in self._queued]
+        for job_id in requeued:
+            self._enqueue(job_id)
+        if requeued:
+            logger.info(f"🔁 Requeued {len(requeued)} unfinished import jobs")
+
+    async def _requeue_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.IMPORT_JOB_LEASE_SECONDS)
+            try:
+                await self._requeue_unfinished()
+            except Exception:
+                logger.exception("❌ Requeue of unfinished import jobs failed")
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, filename: Optional[str], mime_ext: str, file_bytes: bytes, use_cache: bool = True) -> ImportJobRecord:
+        now = datetime.utcnow()
+        job = ImportJobRecord(
+            id=str(uuid.uuid4()),
+            filename=filename,
+            mime_ext=mime_ext,
+            use_cache=use_cache,
+            stage=ImportJobStage.uploaded.value,
+            result=None,
+            error=None,
+            created_at=now,
+            updated_at=now,
+        )
+        await run_in_threadpool(self.store.create, job, file_bytes)
+        self._enqueue(job.id)
+        return job
+
+    async def get(self, job_id: str) -> Optional[ImportJobRecord]:
+        return await run_in_threadpool(self.store.get, job_id)
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[job_id]
+
+    def _enqueue(self, job_id: str) -> None:
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _publish(self, job: ImportJobRecord) -> None:
+        for queue in self._subscribers.get(job.id, ()):
+            queue.put_nowait(job)
+
+    async def _set_stage(self, job_id: str, stage: ImportJobStage, result: Optional[dict] = None, error: Optional[str] = None) -> None:
+        job = await run_in_threadpool(self.store.update, job_id, self._owner, stage.value, result, error)
+        if job is None:
+            raise LeaseLostError(f"Import job {job_id} non più in carico a questo processo")
+        self._publish(job)
+
+    async def _keep_lease(self, job_id: str, processing: asyncio.Task, lease_lost: asyncio.Event) -> None:
+        """Rinnova il lease a intervalli regolari; se lo perde interrompe l'elaborazione"""
+        lease = settings.IMPORT_JOB_LEASE_SECONDS
+        while True:
+            await asyncio.sleep(lease / 3)
+            if not await run_in_threadpool(self.store.renew, job_id, self._owner, lease):
+                lease_lost.set()
+                processing.cancel()
+                return
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception:
+                logger.exception(f"❌ Import job {job_id} crashed")
+            finally:
+                self._queued.discard(job_id)
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        job = await run_in_threadpool(self.store.claim, job_id, self._owner, settings.IMPORT_JOB_LEASE_SECONDS)
+        if job is None:
+            # Concluso, oppure in carico a un altro processo con lease valido
+            return
+        self._publish(job)
+        lease_lost = asyncio.Event()
+        processing = asyncio.create_task(self._process(job))
+        heartbeat = asyncio.create_task(self._keep_lease(job_id, processing, lease_lost))
+        try:
+            await processing
+        except LeaseLostError:
+            logger.warning(f"⚠️ Import job {job_id} lease lost, result discarded")
+        except asyncio.CancelledError:
+            if not lease_lost.is_set():
+                raise
+            logger.warning(f"⚠️ Import job {job_id} lease lost, processing cancelled")
+        finally:
+            heartbeat.cancel()
+
+    async def _process(self, job: ImportJobRecord) -> None:
+        job_id = job.id
+        file_bytes = await run_in_threadpool(self.store.load_file, job_id)
+        if file_bytes is None:
+            await self._set_stage(job_id, ImportJobStage.failed, error="File del job non disponibile")
+            return
+
+        try:
+            extractor = None if is_structured_invoice(job.mime_ext) else self._extractor_factory()
+            extraction = await extract_invoice(extractor, file_bytes, job.mime_ext, use_cache=job.use_cache)
+
+            await self._set_stage(job_id, ImportJobStage.matching)
+            response = await run_in_threadpool(_match_with_own_session, extraction)
+        except LeaseLostError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Import job {job_id} failed: {e}")
+            await self._set_stage(job_id, ImportJobStage.failed, error=str(e))
+            return
+
+        await self._set_stage(job_id, ImportJobStage.done, result=response.model_dump(mode="json"))
+
+
+def _match_with_own_session(extraction) -> InvoiceImportResponse:
+    """I worker non hanno una richiesta HTTP: aprono una sessione dedicata"""
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        return build_import_response(db, extraction)
+    finally:
+        db.close()
+
+
+# Istanza condivisa a livello di processo
+import_job_manager = ImportJobManager()
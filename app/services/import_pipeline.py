@@ -0,0 +1,171 @@
+# app/services/import_pipeline.py
+import asyncio
+import contextlib
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.schemas.invoice import InvoiceExtraction, InvoiceImportResponse, InvoiceLineWithMatch, SupplierInfo
+from app.services.fatturapa import is_structured_invoice, parse_fatturapa
+from app.services.layout_templates import extract_with_layout_template, save_layout_sample
+from app.services.match_index import get_product_match_index
+from app.services.matching import get_or_create_supplier, deterministic_match_all_lines, deterministic_match_line
+from app.services.pdf_pages import extract_text_layer
+
+# Limita le estrazioni AI contemporanee per processo (creato al primo uso)
+_extraction_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def extraction_semaphore() -> asyncio.Semaphore:
+    global _extraction_semaphore
+    if _extraction_semaphore is None:
+        _extraction_semaphore = asyncio.Semaphore(settings.EXTRACTION_MAX_CONCURRENCY)
+    return _extraction_semaphore
+
+
+async def _layout_template(file_bytes: bytes, mime_ext: str) -> Tuple[Optional[str], Optional[InvoiceExtraction]]:
+    """
+    PDF digitali: testo del documento e, se il layout del fornitore è noto e letto con
+    confidenza sufficiente, la fattura estratta dal template (altrimenti None).
+    """
+    if mime_ext.lower() != "pdf" or not settings.LAYOUT_TEMPLATES_ENABLED:
+        return None, None
+    text = await run_in_threadpool(extract_text_layer, file_bytes, settings.PDF_TEXT_MIN_CHARS_PER_PAGE)
+    if text is None:
+        return None, None
+    return text, await run_in_threadpool(extract_with_layout_template, text)
+
+
+async def _with_layout_sample(file_bytes: bytes, text: Optional[str], invoice: InvoiceExtraction) -> InvoiceExtraction:
+    """Conserva il testo fino alla conferma, per imparare (o rinforzare) il layout del fornitore"""
+    if text is None:
+        return invoice
+    sample_id = await run_in_threadpool(save_layout_sample, file_bytes, text, invoice)
+    return invoice.model_copy(update={"layout_sample_id": sample_id})
+
+
+async def extract_invoice(extractor, file_bytes: bytes, mime_ext: str, use_cache: bool = True) -> InvoiceExtraction:
+    """
+    Estrazione async. Le fatture elettroniche FatturaPA (.xml/.p7m) sono lette
+    direttamente (nessuna chiamata AI, extractor può essere None), così come i PDF
+    di fornitori con un layout appreso; le altre passano dall'AI, al massimo
+    EXTRACTION_MAX_CONCURRENCY alla volta.
+    """
+    if is_structured_invoice(mime_ext):
+        return await run_in_threadpool(parse_fatturapa, file_bytes, mime_ext)
+    text, invoice = await _layout_template(file_bytes, mime_ext)
+    if invoice is None:
+        async with extraction_semaphore():
+            invoice = await extractor.a_extract_from_bytes(file_bytes, mime_ext, use_cache=use_cache)
+    return await _with_layout_sample(file_bytes, text, invoice)
+
+
+async def _invoice_events(invoice: InvoiceExtraction) -> AsyncIterator[Tuple[str, object]]:
+    """Stessi eventi di a_stream_extract per una fattura già letta (FatturaPA o template)"""
+    yield "fields", invoice.model_dump(exclude={"lines", "raw_text"})
+    for line in invoice.lines:
+        yield "line", line
+    yield "invoice", invoice
+
+
+def build_import_response(
+    db: Session,
+    extraction: InvoiceExtraction,
+    supplier_ids: Optional[Dict[str, int]] = None,
+) -> InvoiceImportResponse:
+    """
+    Parte sincrona (DB) dell'import: fornitore + matching deterministico delle righe.
+    Va eseguita nel thread pool quando chiamata da codice async.
+    supplier_ids: cache nome -> id fornitore condivisa tra più import (batch)
+    """
+    supplier_name = extraction.supplier.name
+    if supplier_ids is not None and supplier_name in supplier_ids:
+        supplier_id = supplier_ids[supplier_name]
+    else:
+        supplier_id = get_or_create_supplier(db, supplier_name).id
+        if supplier_ids is not None:
+            supplier_ids[supplier_name] = supplier_id
+
+    lines_with_match = deterministic_match_all_lines(db, extraction, supplier_id=supplier_id)
+
+    return InvoiceImportResponse(
+        invoice_id=None,  # in futuro potrai salvare subito un draft
+        supplier_id=supplier_id,  # ID del fornitore creato/trovato
+        supplier=extraction.supplier,
+        invoice_number=extraction.invoice_number,
+        invoice_date=extraction.invoice_date,
+        currency=extraction.currency,
+        total_amount=extraction.total_amount,  # Totale documento dall'estrazione
+        lines=lines_with_match,
+        dropped_lines=extraction.dropped_lines,
+        layout_sample_id=extraction.layout_sample_id,
+    )
+
+
+async def import_invoice_bytes(
+    db: Session,
+    extractor,
+    file_bytes: bytes,
+    mime_ext: str,
+    use_cache: bool = True,
+) -> InvoiceImportResponse:
+    """Pipeline completa di import senza bloccare l'event loop"""
+    extraction = await extract_invoice(extractor, file_bytes, mime_ext, use_cache=use_cache)
+    return await run_in_threadpool(build_import_response, db, extraction)
+
+
+async def stream_import_events(
+    extractor,
+    file_bytes: bytes,
+    mime_ext: str,
+    use_cache: bool = True,
+) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Import in streaming: ("supplier", ...) appena il fornitore è noto, ("line", ...)
+    per ogni riga già matchata appena il modello la completa, infine ("done", ...)
+    con la stessa risposta di import_invoice_bytes (suggerimenti compresi).
+    """
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        index = await run_in_threadpool(get_product_match_index, db)
+        supplier_ids: Dict[str, int] = {}
+        supplier_id: Optional[int] = None
+        position = 0
+
+        text = None
+        if is_structured_invoice(mime_ext):
+            invoice = await run_in_threadpool(parse_fatturapa, file_bytes, mime_ext)
+        else:
+            text, invoice = await _layout_template(file_bytes, mime_ext)
+        if invoice is not None:
+            limit, events = contextlib.nullcontext(), _invoice_events(invoice)
+        else:
+            limit, events = extraction_semaphore(), extractor.a_stream_extract(file_bytes, mime_ext, use_cache=use_cache)
+
+        async with limit:
+            async for event, payload in events:
+                if event == "fields":
+                    supplier = payload.get("supplier") or {}
+                    if supplier.get("name") and supplier_id is None:
+                        supplier_id = await run_in_threadpool(_resolve_supplier, db, supplier["name"], supplier_ids)
+                        yield "supplier", {"supplier_id": supplier_id, "supplier": SupplierInfo(**supplier).model_dump()}
+                elif event == "line":
+                    line = InvoiceLineWithMatch(**payload.dict())
+                    line = await run_in_threadpool(deterministic_match_line, db, line, index, supplier_id)
+                    yield "line", {"index": position, "line": line.model_dump(mode="json")}
+                    position += 1
+                elif event == "invoice":
+                    payload = await _with_layout_sample(file_bytes, text, payload)
+                    response = await run_in_threadpool(build_import_response, db, payload, supplier_ids)
+                    yield "done", response.model_dump(mode="json")
+    finally:
+        db.close()
+
+
+def _resolve_supplier(db: Session, supplier_name: str, supplier_ids: Dict[str, int]) -> int:
+    supplier_ids[supplier_name] = get_or_create_supplier(db, supplier_name).id
+    return supplier_ids[supplier_name]
@@ -1,14 +1,30 @@
 # app/services/invoice_extractor.py
+import asyncio
 import base64
+import hashlib
 import json
+import logging
+import time
+from dataclasses import replace
 from pathlib import Path
-from typing import Union
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 
-from datapizza.clients.openai import OpenAIClient
 from datapizza.type import Media, MediaBlock, TextBlock
+from pydantic import ValidationError
 
 from app.config import settings
-from app.schemas.invoice import InvoiceExtraction
+from app.schemas.invoice import DroppedLine, InvoiceExtraction, InvoiceLineBase
+from app.services.extraction_cache import extraction_cache_key, get_extraction_cache
+from app.services.extraction_metrics import record_extraction_call
+from app.services.extraction_routing import DocumentProfile, ExtractionRoute, choose_route, full_route, profile_document
+from app.services.json_stream import IncrementalInvoiceParser, recover_invoice_json
+from app.services.llm_backends import build_llm_client
+from app.services.pdf_pages import extract_text_layer, page_ranges, pdf_page_count, split_pdf
+
+logger = logging.getLogger(__name__)
+
+# stop_reason delle risposte interrotte per esaurimento di max_tokens
+_TRUNCATED_STOP_REASONS = {"incomplete", "length", "max_tokens"}
 
 
 class DatapizzaInvoiceExtractor:
@@ -18,80 +34,31 @@ class DatapizzaInvoiceExtractor:
     """
 
     def __init__(self):
-        self.client = OpenAIClient(
-            api_key=settings.OPENAI_API_KEY,
-            model="gpt-4.1-mini",
-        )
+        self.model = settings.EXTRACTION_MODEL
+        self._clients: Dict[str, object] = {}
+        self.client = self._client(self.model)
+        self.cache = get_extraction_cache()
+        self._version = None
 
-    def _try_fix_json(self, raw_text: str) -> str:
-        """
-        Tenta di riparare un JSON malformato, specialmente stringhe non terminate.
-        """
-        # Rimuovi eventuali blocchi markdown ```json ... ```
-        if raw_text.startswith("```"):
-            raw_text = raw_text.strip("`").replace("json", "", 1).strip()
-        
-        # Se il JSON termina con una stringa non chiusa, prova a chiuderla
-        if raw_text.count('"') % 2 != 0:
-            # Numero dispari di virgolette = stringa non chiusa
-            # Trova l'ultima virgoletta di apertura non chiusa
-            last_quote_pos = raw_text.rfind('"')
-            if last_quote_pos != -1:
-                # Controlla se dopo l'ultima virgoletta c'è già una chiusura
-                after_quote = raw_text[last_quote_pos + 1:]
-                # Se dopo la virgoletta non c'è una virgoletta di chiusura prima di :, }, ], o fine stringa
-                # allora dobbiamo chiudere la stringa
-                needs_closing = True
-                for char in after_quote:
-                    if char == '"':
-                        needs_closing = False
-                        break
-                    if char in [':', '}', ']', ',', '\n']:
-                        break
-                
-                if needs_closing:
-                    # Trova dove dovrebbe terminare la stringa (prima di :, }, ], , o fine riga)
-                    end_pos = len(raw_text)
-                    for i in range(last_quote_pos + 1, len(raw_text)):
-                        char = raw_text[i]
-                        if char in [':', '}', ']', ',']:
-                            # Inserisci la virgoletta di chiusura prima di questo carattere
-                            raw_text = raw_text[:i] + '"' + raw_text[i:]
-                            break
-                    else:
-                        # Se non troviamo un carattere di terminazione, chiudi alla fine
-                        raw_text = raw_text.rstrip() + '"'
-        
-        # Prova a chiudere oggetti/array non chiusi
-        open_braces = raw_text.count('{') - raw_text.count('}')
-        open_brackets = raw_text.count('[') - raw_text.count(']')
-        
-        if open_braces > 0:
-            raw_text = raw_text.rstrip() + '\n' + '}' * open_braces
-        if open_brackets > 0:
-            raw_text = raw_text.rstrip() + '\n' + ']' * open_brackets
-        
-        return raw_text
-
-    def _extract_json_from_text(self, raw_text: str) -> str:
-        """
-        Estrae il JSON dalla risposta, anche se circondato da testo.
-        """
-        # Rimuovi eventuali blocchi markdown ```json ... ```
-        if raw_text.startswith("```"):
-            raw_text = raw_text.strip("`").replace("json", "", 1).strip()
-        
-        # Cerca il primo { e l'ultimo } per estrarre solo il JSON
-        first_brace = raw_text.find('{')
-        if first_brace == -1:
-            return raw_text
-        
-        # Trova l'ultima } corrispondente
-        last_brace = raw_text.rfind('}')
-        if last_brace == -1 or last_brace <= first_brace:
-            return raw_text
-        
-        return raw_text[first_brace:last_brace + 1]
+    def _client(self, model: str):
+        """Un client per modello (il routing può usare più modelli), dal backend configurato"""
+        if model not in self._clients:
+            self._clients[model] = build_llm_client(model)
+        return self._clients[model]
+
+    @property
+    def version(self) -> str:
+        """Hash di modelli + prompt + EXTRACTION_CACHE_VERSION, parte della chiave di cache"""
+        if self._version is None:
+            models = [self.model]
+            if settings.EXTRACTION_ROUTING_ENABLED:
+                models.append(settings.EXTRACTION_MODEL_FAST)
+            backend = settings.EXTRACTION_BACKEND.lower()
+            if backend in ("replay", "synthetic"):
+                models.append(backend)  # risultati finti: mai nella cache delle estrazioni reali
+            fingerprint = "\n".join([*models, settings.EXTRACTION_CACHE_VERSION, self._build_system_prompt()])
+            self._version = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+        return self._version
 
     # --- costruzione Media ---
 
@@ -108,7 +75,8 @@ class DatapizzaInvoiceExtractor:
         else:
             raise ValueError(f"Estensione non supportata: {ext}")
 
-        b64 = base64.b64encode(file_bytes).decode("utf-8")
+        # Una sola stringa base64 (l'intermedio bytes viene liberato subito)
+        b64 = base64.b64encode(file_bytes).decode("ascii")
 
         return Media(
             media_type=media_type,
@@ -158,61 +126,397 @@ IMPORTANTE:
 - Se una stringa contiene caratteri speciali, usali correttamente escapati
         """.strip()
 
+    # --- cache ---
+
+    def _cache_key(self, file_bytes: bytes) -> Optional[str]:
+        return extraction_cache_key(file_bytes, self.version) if self.cache else None
+
+    def _cache_get(self, cache_key: str) -> Optional[InvoiceExtraction]:
+        try:
+            cached = self.cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"⚠️ Extraction cache read failed: {e}")
+            return None
+        return InvoiceExtraction(**cached) if cached is not None else None
+
+    def _cache_set(self, cache_key: str, invoice: InvoiceExtraction) -> None:
+        if invoice.dropped_lines:
+            return  # risultato parziale: il prossimo import riprova l'estrazione
+        try:
+            self.cache.set(cache_key, invoice.model_dump(mode="json"))
+        except Exception as e:
+            logger.warning(f"⚠️ Extraction cache write failed: {e}")
+
     # --- entry point principale ---
 
-    def extract_from_bytes(self, file_bytes: bytes, mime_ext: str) -> InvoiceExtraction:
+    def extract_from_bytes(self, file_bytes: bytes, mime_ext: str, use_cache: bool = True) -> InvoiceExtraction:
         """
         Usa base64 come da esempio ufficiale Datapizza.
         mime_ext: estensione del file (png, jpg, jpeg, pdf)
+        use_cache: se False non legge dalla cache (il nuovo risultato viene comunque salvato)
         """
-        
-        media = self._build_media_from_bytes(file_bytes, mime_ext)
+        cache_key = self._cache_key(file_bytes)
+        if cache_key and use_cache:
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached
+
+        blocks, profile = self._prepare(file_bytes, mime_ext)
+        route = choose_route(profile)
+        try:
+            invoice, truncated = self._invoke(blocks, route, profile)
+        except ValueError:
+            if not self._can_escalate(route):
+                raise
+            invoice, truncated = None, True
+        if truncated and self._can_escalate(route):
+            logger.info(f"↗️ Extraction truncated on {route.model} ({route.max_tokens} tokens), retrying with full budget")
+            invoice, _ = self._invoke(blocks, full_route("escalated"), profile)
+
+        if cache_key:
+            self._cache_set(cache_key, invoice)
+        return invoice
+
+    async def a_extract_from_bytes(self, file_bytes: bytes, mime_ext: str, use_cache: bool = True) -> InvoiceExtraction:
+        """
+        Variante async di extract_from_bytes: la chiamata al modello non blocca
+        l'event loop, cache e costruzione del payload girano nel thread pool.
+        I PDF con almeno PDF_CHUNK_MIN_PAGES pagine vengono estratti a blocchi in parallelo.
+        """
+        cache_key = self._cache_key(file_bytes)
+        if cache_key and use_cache:
+            cached = await asyncio.to_thread(self._cache_get, cache_key)
+            if cached is not None:
+                return cached
+
+        invoice = None
+        page_count = None
+        if mime_ext.lower() == "pdf":
+            page_count = await asyncio.to_thread(pdf_page_count, file_bytes)
+            if page_count and settings.PDF_CHUNK_MIN_PAGES > 0 and page_count >= settings.PDF_CHUNK_MIN_PAGES:
+                invoice = await self._a_extract_chunked(file_bytes, page_count)
+
+        if invoice is None:
+            blocks, profile = await asyncio.to_thread(self._prepare, file_bytes, mime_ext, page_count)
+            route = choose_route(profile)
+            try:
+                invoice, truncated = await self._a_invoke(blocks, route, profile)
+            except ValueError:
+                if not self._can_escalate(route):
+                    raise
+                invoice, truncated = None, True
+            if truncated and self._can_escalate(route):
+                # Stima troppo bassa: un solo nuovo tentativo con modello standard e budget pieno
+                logger.info(f"↗️ Extraction truncated on {route.model} ({route.max_tokens} tokens), retrying with full budget")
+                invoice, _ = await self._a_invoke(blocks, full_route("escalated"), profile)
+
+        if cache_key:
+            await asyncio.to_thread(self._cache_set, cache_key, invoice)
+        return invoice
+
+    async def a_stream_extract(
+        self, file_bytes: bytes, mime_ext: str, use_cache: bool = True
+    ) -> AsyncIterator[Tuple[str, object]]:
+        """
+        Estrazione in streaming: consuma i token del modello e produce
+        ("fields", dict) appena il fornitore è completo,
+        ("line", InvoiceLineBase) appena ogni riga si chiude e infine
+        ("invoice", InvoiceExtraction) con il risultato completo (anche in cache).
+        """
+        cache_key = self._cache_key(file_bytes)
+        if cache_key and use_cache:
+            cached = await asyncio.to_thread(self._cache_get, cache_key)
+            if cached is not None:
+                yield "fields", cached.model_dump(exclude={"lines", "raw_text"})
+                for line in cached.lines:
+                    yield "line", line
+                yield "invoice", cached
+                return
+
+        blocks, profile = await asyncio.to_thread(self._prepare, file_bytes, mime_ext)
+        # Le righe già inviate non si possono ritirare: niente secondo tentativo, budget pieno
+        route = replace(choose_route(profile), max_tokens=settings.EXTRACTION_MAX_TOKENS)
+        parser = IncrementalInvoiceParser()
+        deltas: List[str] = []
+        fields_sent = False
+        last = None
+
+        started = time.perf_counter()
+        try:
+            async for chunk in self._client(route.model).a_stream_invoke(input=blocks, max_tokens=route.max_tokens):
+                last = chunk
+                delta = chunk.delta or ""
+                deltas.append(delta)
+                items = parser.feed(delta)
+                if not fields_sent and ("supplier" in parser.fields or items):
+                    fields_sent = True
+                    yield "fields", dict(parser.fields)
+                for item in items:
+                    try:
+                        yield "line", InvoiceLineBase(**item)
+                    except ValidationError:
+                        continue  # riga non valida per lo schema: saltata nello stream
+            invoice = self._parse_response("".join(deltas))
+        except Exception as e:
+            await self._a_record(route, profile, started, last, None, error=e)
+            raise
+        await self._a_record(route, profile, started, last, invoice)
+
+        if cache_key:
+            await asyncio.to_thread(self._cache_set, cache_key, invoice)
+        yield "invoice", invoice
+
+    # --- chiamata al modello con routing e metriche ---
+
+    def _prepare(self, file_bytes: bytes, mime_ext: str, page_count: Optional[int] = None, use_history: bool = True) -> Tuple[list, DocumentProfile]:
+        """Input per il modello e profilo del documento per il routing (text layer estratto una volta sola)"""
+        ext = mime_ext.lower()
+        if ext == "pdf" and page_count is None:
+            page_count = pdf_page_count(file_bytes)
+        text = self._text_layer(file_bytes, ext)
+        blocks = self._blocks(file_bytes, ext, text)
+        return blocks, profile_document(file_bytes, ext, page_count, text, use_history=use_history)
+
+    @staticmethod
+    def _can_escalate(route: ExtractionRoute) -> bool:
+        return route.model != settings.EXTRACTION_MODEL or route.max_tokens < settings.EXTRACTION_MAX_TOKENS
+
+    @staticmethod
+    def _is_truncated(response, invoice: InvoiceExtraction) -> bool:
+        stop_reason = getattr(response, "stop_reason", None)
+        return stop_reason in _TRUNCATED_STOP_REASONS or any(d.reason == "riga troncata" for d in invoice.dropped_lines)
+
+    def _metric(self, route: ExtractionRoute, profile: DocumentProfile, started: float, response, invoice: Optional[InvoiceExtraction], error: Optional[Exception] = None) -> dict:
+        usage = getattr(response, "usage", None)
+        return dict(
+            tier=route.tier,
+            model=route.model,
+            mime_ext=profile.mime_ext,
+            input_kind=profile.input_kind,
+            file_size=profile.file_size,
+            page_count=profile.page_count,
+            estimated_lines=profile.estimated_lines,
+            max_tokens=route.max_tokens,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+            latency_ms=int((time.perf_counter() - started) * 1000),
+            lines_extracted=len(invoice.lines) if invoice is not None else None,
+            truncated=invoice is not None and self._is_truncated(response, invoice),
+            error=str(error)[:500] if error is not None else None,
+        )
+
+    async def _a_record(self, route, profile, started, response, invoice, error=None) -> None:
+        await asyncio.to_thread(record_extraction_call, **self._metric(route, profile, started, response, invoice, error))
 
+    def _invoke(self, blocks: list, route: ExtractionRoute, profile: DocumentProfile) -> Tuple[InvoiceExtraction, bool]:
+        """Una chiamata sincrona: (fattura, troncata), token e latenza salvati nelle metriche"""
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self._client(route.model).invoke(input=blocks, max_tokens=route.max_tokens)
+            invoice = self._parse_response(response.text)
+        except Exception as e:
+            record_extraction_call(**self._metric(route, profile, started, response, None, e))
+            raise
+        record_extraction_call(**self._metric(route, profile, started, response, invoice))
+        return invoice, self._is_truncated(response, invoice)
+
+    async def _a_invoke(self, blocks: list, route: ExtractionRoute, profile: DocumentProfile) -> Tuple[InvoiceExtraction, bool]:
+        """Come _invoke, senza bloccare l'event loop"""
+        started = time.perf_counter()
+        response = None
+        try:
+            response = await self._client(route.model).a_invoke(input=blocks, max_tokens=route.max_tokens)
+            invoice = self._parse_response(response.text)
+        except Exception as e:
+            await self._a_record(route, profile, started, response, None, error=e)
+            raise
+        await self._a_record(route, profile, started, response, invoice)
+        return invoice, self._is_truncated(response, invoice)
+
+    # --- estrazione a blocchi di pagine (PDF lunghi) ---
+
+    async def _a_extract_chunked(self, file_bytes: bytes, page_count: int) -> InvoiceExtraction:
+        """
+        Divide il PDF in blocchi di PDF_CHUNK_PAGES pagine estratti in parallelo:
+        intestazione dal primo blocco, totale documento dall'ultimo, righe da tutti.
+        Un blocco che fallisce viene ritentato da solo; se un blocco fallisce
+        definitivamente gli altri vengono annullati.
+        """
+        ranges = page_ranges(page_count, settings.PDF_CHUNK_PAGES)
+        chunks = await asyncio.to_thread(split_pdf, file_bytes, ranges)
+        tasks = [
+            asyncio.ensure_future(self._a_extract_chunk(chunk, position, ranges, page_count))
+            for position, chunk in enumerate(chunks)
+        ]
+        try:
+            parts = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        return self._merge_chunks(parts)
+
+    async def _a_extract_chunk(self, chunk_bytes: bytes, position: int, ranges: list, page_count: int) -> InvoiceExtraction:
+        start, end = ranges[position]
+        blocks, profile = await asyncio.to_thread(self._prepare, chunk_bytes, "pdf", end - start, False)
+        blocks.insert(1, TextBlock(content=self._chunk_instructions(position, ranges, page_count)))
+        route = ExtractionRoute(tier="chunk", model=settings.EXTRACTION_MODEL, max_tokens=settings.PDF_CHUNK_MAX_TOKENS)
+
+        attempts = 1 + max(0, settings.PDF_CHUNK_MAX_RETRIES)
+        failures = 0
+        while True:
+            try:
+                invoice, truncated = await self._a_invoke(blocks, route, profile)
+            except Exception as e:
+                failures += 1
+                if failures >= attempts:
+                    raise
+                logger.warning(f"⚠️ PDF chunk {position + 1}/{len(ranges)} failed, retrying: {e}")
+                continue
+            # Risposta troncata: le ultime righe del blocco mancano, si riprova con il budget pieno
+            if truncated and self._can_escalate(route):
+                logger.info(
+                    f"↗️ PDF chunk {position + 1}/{len(ranges)} truncated ({route.max_tokens} tokens), retrying with full budget"
+                )
+                route = full_route("chunk")
+                continue
+            if truncated:
+                logger.warning(f"⚠️ PDF chunk {position + 1}/{len(ranges)} truncated with full budget, trailing lines may be missing")
+            return invoice
+
+    def _chunk_instructions(self, position: int, ranges: list, page_count: int) -> str:
+        start, end = ranges[position]
+        is_first = position == 0
+        is_last = position == len(ranges) - 1
+
+        rules = [
+            f"ATTENZIONE: il documento allegato contiene solo le pagine {start + 1}-{end} "
+            f"di {page_count} della fattura (blocco {position + 1} di {len(ranges)}).",
+            "- Estrai in \"lines\" SOLO le righe presenti in queste pagine, senza inventare righe di altre pagine.",
+        ]
+        if not is_first:
+            rules.append(
+                "- Fornitore, numero, data e valuta sono nella prima pagina: se qui non sono visibili "
+                "metti supplier.name a \"\" e gli altri campi a null."
+            )
+        if not is_last:
+            rules.append("- Il totale documento è nell'ultima pagina: metti total_amount a null.")
+        return "\n".join(rules)
+
+    def _merge_chunks(self, parts: list) -> InvoiceExtraction:
+        """Unisce i risultati parziali nell'ordine delle pagine"""
+        first, last = parts[0], parts[-1]
+
+        def first_value(field: str):
+            for part in parts:
+                value = getattr(part, field)
+                if value:
+                    return value
+            return None
+
+        supplier = first.supplier if first.supplier.name else next(
+            (part.supplier for part in parts if part.supplier.name), first.supplier
+        )
+        total_amount = last.total_amount
+        if total_amount is None:
+            total_amount = next((part.total_amount for part in reversed(parts) if part.total_amount is not None), None)
+
+        # Posizioni delle righe scartate riportate sull'intera fattura
+        dropped = []
+        offset = 0
+        for part in parts:
+            dropped.extend(d.model_copy(update={"index": d.index + offset}) for d in part.dropped_lines)
+            offset += len(part.lines) + len(part.dropped_lines)
+
+        return InvoiceExtraction(
+            supplier=supplier,
+            invoice_number=first.invoice_number or first_value("invoice_number"),
+            invoice_date=first.invoice_date or first_value("invoice_date"),
+            currency=first.currency or first_value("currency"),
+            total_amount=total_amount,
+            lines=[line for part in parts for line in part.lines],
+            raw_text="\n".join(part.raw_text or "" for part in parts),
+            dropped_lines=dropped,
+        )
+
+    def _text_layer(self, file_bytes: bytes, mime_ext: str) -> Optional[str]:
+        """Testo dei PDF digitali, None per scansioni/immagini o se disattivato"""
+        if mime_ext.lower() == "pdf" and settings.PDF_TEXT_LAYER_ENABLED:
+            return extract_text_layer(file_bytes, settings.PDF_TEXT_MIN_CHARS_PER_PAGE)
+        return None
+
+    def _blocks(self, file_bytes: bytes, mime_ext: str, text: Optional[str]) -> list:
+        """
+        Input per il modello: per i PDF digitali solo il testo estratto localmente
+        (molti meno token e latenza), per scansioni e immagini il file come Media.
+        """
         system_prompt = self._build_system_prompt()
 
-        blocks = [
+        if text is not None:
+            return [
+                TextBlock(content=system_prompt),
+                TextBlock(content=(
+                    "La fattura è fornita come testo estratto dal PDF "
+                    "(colonne delle tabelle separate da \" | \"):\n\n" + text
+                )),
+            ]
+
+        media = self._build_media_from_bytes(file_bytes, mime_ext)
+
+        return [
             TextBlock(content=system_prompt),
             MediaBlock(media=media),
         ]
 
-        response = self.client.invoke(
-            input=blocks,
-            max_tokens=8000,  # Aumentato per gestire fatture complesse
-        )
-        raw_text = response.text.strip()
-
-        # Estrai solo la parte JSON dalla risposta
-        raw_text = self._extract_json_from_text(raw_text)
+    def _parse_response(self, raw_text: str) -> InvoiceExtraction:
+        """
+        Estrae e valida il JSON della risposta del modello.
+        Se il JSON è troncato o in parte malformato (o circondato da testo/```json),
+        un unico passaggio del parser incrementale recupera i campi completi e
+        tutte le righe intere; le righe perse sono riportate in dropped_lines.
+        """
+        raw_text = raw_text.strip()
 
-        # Prova prima il parsing diretto
+        dropped: List[DroppedLine] = []
         try:
             data = json.loads(raw_text)
+            items = (data.get("lines") or []) if isinstance(data, dict) else []
+            positions = list(range(len(items)))
         except json.JSONDecodeError as e:
-            # Se fallisce, prova a riparare il JSON
-            try:
-                fixed_text = self._try_fix_json(raw_text)
-                data = json.loads(fixed_text)
-            except (json.JSONDecodeError, ValueError) as fix_error:
-                # Se anche la riparazione fallisce, solleva un errore dettagliato
-                error_pos = getattr(e, 'pos', None)
-                error_line = getattr(e, 'lineno', None)
-                error_col = getattr(e, 'colno', None)
-                
-                # Mostra il contesto intorno all'errore
-                context_start = max(0, error_pos - 200) if error_pos else 0
-                context_end = min(len(raw_text), error_pos + 200) if error_pos else 400
-                context = raw_text[context_start:context_end]
-                
-                error_msg = (
+            recovered = recover_invoice_json(raw_text)
+            if "supplier" not in recovered.fields:
+                # Nulla di utilizzabile: errore dettagliato come in passato
+                error_pos = e.pos
+                context = raw_text[max(0, error_pos - 200):error_pos + 200]
+                raise ValueError(
                     f"Errore nel parsing JSON della risposta AI: {e}\n"
-                    f"Posizione errore: linea {error_line}, colonna {error_col}, carattere {error_pos}\n"
+                    f"Posizione errore: linea {e.lineno}, colonna {e.colno}, carattere {error_pos}\n"
                     f"Contesto intorno all'errore:\n{context}\n"
                     f"Primi 500 caratteri della risposta:\n{raw_text[:500]}"
-                )
-                raise ValueError(error_msg) from e
+                ) from e
+            data = recovered.fields
+            items = recovered.lines or []
+            positions = recovered.positions
+            dropped.extend(DroppedLine(**item._asdict()) for item in recovered.dropped)
 
-        invoice = InvoiceExtraction(**data)
-        invoice.raw_text = raw_text
-        return invoice
+        if not isinstance(data, dict):
+            raise ValueError(f"Risposta AI non valida (atteso un oggetto JSON): {raw_text[:500]}")
 
+        # Righe validate una per una: una riga non valida non fa perdere le altre
+        lines: List[InvoiceLineBase] = []
+        for position, item in zip(positions, items):
+            try:
+                lines.append(InvoiceLineBase(**item))
+            except (TypeError, ValidationError) as e:
+                dropped.append(DroppedLine(index=position, reason=f"riga non valida: {e}", fragment=json.dumps(item, ensure_ascii=False)[:200]))
+        dropped.sort(key=lambda d: d.index)
+        if dropped:
+            logger.warning(f"⚠️ AI response: {len(lines)} lines recovered, {len(dropped)} dropped")
 
+        try:
+            invoice = InvoiceExtraction(**{**data, "lines": lines, "dropped_lines": dropped})
+        except ValidationError as e:
+            raise ValueError(f"Risposta AI non valida: {e}") from e
+        invoice.raw_text = raw_text
+        return invoice
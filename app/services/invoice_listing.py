@@ -0,0 +1,116 @@
+# app/services/invoice_listing.py
+import base64
+from dataclasses import dataclass
+from datetime import date
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Session
+
+from app.db.models import Invoice, Supplier
+from app.schemas.invoice import InvoiceListItem
+
+
+@dataclass
+class InvoiceFilters:
+    supplier_id: Optional[int] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+
+    def apply(self, query):
+        if self.supplier_id is not None:
+            query = query.filter(Invoice.supplier_id == self.supplier_id)
+        if self.date_from is not None:
+            query = query.filter(Invoice.invoice_date >= self.date_from)
+        if self.date_to is not None:
+            query = query.filter(Invoice.invoice_date <= self.date_to)
+        if self.min_amount is not None:
+            query = query.filter(Invoice.total_amount >= self.min_amount)
+        if self.max_amount is not None:
+            query = query.filter(Invoice.total_amount <= self.max_amount)
+        return query
+
+    @property
+    def by_date(self) -> bool:
+        """Con un filtro sulla data le fatture senza data sono escluse"""
+        return self.date_from is not None or self.date_to is not None
+
+
+def encode_cursor(invoice_date: Optional[date], invoice_id: int) -> str:
+    """Cursore opaco: posizione (data, id) dell'ultima fattura della pagina"""
+    raw = f"{invoice_date.isoformat() if invoice_date else ''}|{invoice_id}"
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[date], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        day, _, invoice_id = raw.partition("|")
+        return (date.fromisoformat(day) if day else None), int(invoice_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Cursore non valido: {cursor}") from e
+
+
+def _page_query(db: Session, filters: InvoiceFilters):
+    query = (
+        db.query(
+            Invoice.id,
+            Invoice.invoice_number,
+            Invoice.invoice_date,
+            Invoice.currency,
+            Invoice.total_amount,
+            Supplier.name,
+        )
+        .join(Supplier, Invoice.supplier_id == Supplier.id)
+    )
+    return filters.apply(query)
+
+
+def list_invoice_page(
+    db: Session, filters: InvoiceFilters, cursor: Optional[str], limit: int
+) -> Tuple[List[InvoiceListItem], Optional[str]]:
+    """
+    Pagina di fatture ordinate per (invoice_date DESC, id DESC), fatture senza data in fondo.
+    Paginazione keyset: ogni pagina riparte dalla posizione del cursore sull'indice
+    (invoice_date, id), quindi costa uguale alla prima pagina o alla millesima.
+    Ritorna (righe, cursore della pagina successiva o None).
+    """
+    after_date, after_id = decode_cursor(cursor) if cursor else (None, None)
+    rows = []
+
+    # Fatture con data: confronto tra tuple, percorso diretto dell'indice
+    if after_id is None or after_date is not None:
+        dated = _page_query(db, filters).filter(Invoice.invoice_date.isnot(None))
+        if after_id is not None:
+            dated = dated.filter(tuple_(Invoice.invoice_date, Invoice.id) < tuple_(after_date, after_id))
+        rows = dated.order_by(Invoice.invoice_date.desc(), Invoice.id.desc()).limit(limit + 1).all()
+
+    # Fatture senza data, dopo tutte le altre
+    if len(rows) <= limit and not filters.by_date:
+        undated = _page_query(db, filters).filter(Invoice.invoice_date.is_(None))
+        if after_id is not None and after_date is None:
+            undated = undated.filter(Invoice.id < after_id)
+        rows += undated.order_by(Invoice.id.desc()).limit(limit + 1 - len(rows)).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [
+        InvoiceListItem(
+            id=row.id,
+            supplier_name=row.name,
+            invoice_number=row.invoice_number,
+            invoice_date=row.invoice_date.isoformat() if row.invoice_date else None,
+            currency=row.currency,
+            total_amount=row.total_amount,
+        )
+        for row in rows
+    ]
+    next_cursor = encode_cursor(rows[-1].invoice_date, rows[-1].id) if has_more else None
+    return items, next_cursor
+
+
+def count_invoices(db: Session, filters: InvoiceFilters) -> int:
+    """Totale con gli stessi filtri, senza join né ordinamento (solo indici)"""
+    return filters.apply(db.query(func.count(Invoice.id))).scalar() or 0
@@ -0,0 +1,183 @@
+# app/services/json_stream.py
+import json
+from typing import Any, Dict, List, NamedTuple, Optional
+
+# Lunghezza massima del frammento riportato per una riga scartata
+FRAGMENT_LENGTH = 200
+
+
+class DroppedItem(NamedTuple):
+    index: int  # posizione nell'array "lines"
+    reason: str
+    fragment: str
+
+
+class IncrementalInvoiceParser:
+    """
+    Parser incrementale della risposta JSON del modello mentre arriva in streaming.
+    Scandisce ogni carattere una sola volta (stato: profondità, stringa, escape) e
+    restituisce gli elementi di "lines" appena il loro oggetto si chiude, più i
+    campi di primo livello (supplier, invoice_number, ...) appena completi.
+    Il testo prima della prima "{" (es. ```json) e dopo la "}" finale viene ignorato;
+    quello già consumato viene scartato, così la memoria resta limitata al valore in corso.
+    Le righe non valide o troncate finiscono in dropped (con la loro posizione).
+    """
+
+    def __init__(self, array_key: str = "lines"):
+        self.array_key = array_key
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._text = ""
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._started = False
+        self._string_start: Optional[int] = None
+        self._last_string: Optional[str] = None
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+        self._in_array = False
+        self._item_start: Optional[int] = None
+        self._finished = False
+        self.saw_array = False
+        self.item_positions: List[int] = []  # posizione in "lines" di ogni riga restituita
+        self.dropped: List[DroppedItem] = []
+        self._item_count = 0
+
+    def feed(self, delta: str) -> List[dict]:
+        """Aggiunge un pezzo di testo; ritorna le righe completate in questo pezzo"""
+        if not delta or self._finished:
+            return []
+        self._text += delta
+        completed: List[dict] = []
+        text = self._text
+
+        for i in range(self._pos, len(text)):
+            char = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._value_start is None:
+                        self._last_string = text[self._string_start:i + 1]
+                continue
+
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+                if self._depth == 1 and self._value_start is None and self._key is not None:
+                    self._value_start = i
+            elif char == ":" and self._depth == 1:
+                key = self._loads(self._last_string) if self._last_string else None
+                self._key = key if isinstance(key, str) else None
+                self._last_string = None
+            elif char in "{[":
+                if self._depth == 1 and self._key is not None and self._value_start is None:
+                    self._value_start = i
+                    self._in_array = char == "[" and self._key == self.array_key
+                    self.saw_array = self.saw_array or self._in_array
+                elif self._in_array and self._depth == 2 and char == "{":
+                    self._item_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._in_array and self._depth == 2 and char == "}" and self._item_start is not None:
+                    fragment = text[self._item_start:i + 1]
+                    item = self._loads(fragment)
+                    if isinstance(item, dict):
+                        completed.append(item)
+                        self.item_positions.append(self._item_count)
+                    else:
+                        self._drop("JSON non valido", fragment)
+                    self._item_count += 1
+                    self._item_start = None
+                elif self._depth == 1:
+                    self._close_value(text, i + 1)
+                elif self._depth == 0:
+                    self._close_value(text, i)
+                    self._finished = True
+                    break
+            elif char == "," and self._depth == 1:
+                self._close_value(text, i)
+            elif self._depth == 1 and self._key is not None and self._value_start is None and not char.isspace():
+                self._value_start = i  # numeri, true/false/null
+
+        self._discard_consumed()
+        return completed
+
+    def finish(self) -> None:
+        """Fine del testo: una riga rimasta aperta (risposta troncata) viene scartata"""
+        if not self._finished and self._item_start is not None:
+            self._drop("riga troncata", self._text[self._item_start:])
+            self._item_count += 1
+            self._item_start = None
+        self._finished = True
+
+    def _drop(self, reason: str, fragment: str) -> None:
+        self.dropped.append(DroppedItem(self._item_count, reason, fragment[:FRAGMENT_LENGTH]))
+
+    def _discard_consumed(self) -> None:
+        starts = [self._item_start, self._string_start if self._in_string else None]
+        if not self._in_array:
+            starts.append(self._value_start)
+        keep = min((p for p in starts if p is not None), default=len(self._text))
+        self._text = self._text[keep:]
+        self._pos = len(self._text)
+        if self._item_start is not None:
+            self._item_start -= keep
+        if self._string_start is not None:
+            self._string_start = max(0, self._string_start - keep)
+        if self._value_start is not None:
+            self._value_start = max(0, self._value_start - keep)
+
+    def _close_value(self, text: str, end: int) -> None:
+        if self._key is not None and self._value_start is not None and not self._in_array:
+            value = self._loads(text[self._value_start:end].strip())
+            if value is not _INVALID:
+                self.fields[self._key] = value
+        self._key = None
+        self._value_start = None
+        self._in_array = False
+
+    @staticmethod
+    def _loads(fragment: str) -> Any:
+        try:
+            return json.loads(fragment)
+        except ValueError:
+            return _INVALID
+
+
+_INVALID = object()
+
+
+class RecoveredInvoice(NamedTuple):
+    fields: Dict[str, Any]  # campi di primo livello completi
+    lines: Optional[List[dict]]  # None se l'array "lines" non è mai iniziato
+    positions: List[int]  # posizione in "lines" di ogni riga recuperata
+    dropped: List[DroppedItem]
+
+
+def recover_invoice_json(text: str) -> RecoveredInvoice:
+    """
+    Recupera in un solo passaggio quanto c'è di valido in una risposta troncata o
+    in parte malformata: campi di primo livello completi e righe intere.
+    """
+    parser = IncrementalInvoiceParser()
+    lines = parser.feed(text)
+    parser.finish()
+    return RecoveredInvoice(
+        fields=dict(parser.fields),
+        lines=lines if parser.saw_array else None,
+        positions=parser.item_positions,
+        dropped=parser.dropped,
+    )
@@ -0,0 +1,570 @@
+# app/services/layout_templates.py
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.schemas.invoice import InvoiceExtraction, InvoiceLineBase, SupplierInfo
+from app.services.extraction_cache import file_hash
+
+logger = logging.getLogger(__name__)
+
+CELL_SEPARATOR = " | "  # colonne ricostruite da pdf_pages._compact_layout
+PAGE_MARKER = "--- Pagina"
+
+# Importi/quantità nel formato italiano o inglese (1.234,56 - 1,234.56 - 12,5 - 3)
+_AMOUNT_PATTERN = r"-?\d{1,3}(?:\.\d{3})+(?:,\d+)?|-?\d{1,3}(?:,\d{3})+(?:\.\d+)?|-?\d+(?:[.,]\d+)?"
+_AMOUNT = re.compile(_AMOUNT_PATTERN)
+_DATE_PATTERN = r"\d{1,2}[/.-]\d{1,2}[/.-](?:\d{4}|\d{2})|\d{4}-\d{2}-\d{2}"
+_DATE = re.compile(_DATE_PATTERN)
+_INVOICE_NUMBER_PATTERN = r"[A-Za-z0-9][\w/.-]*"
+_DIGIT = re.compile(r"\d")
+
+# Campi di riga nell'ordine in cui vengono assegnati alle colonne
+_LINE_FIELDS = ("total", "unit_price", "quantity", "vat_rate", "product_code", "raw_description", "code_description", "unit_measure")
+_NUMERIC_FIELDS = {"total", "unit_price", "quantity", "vat_rate"}
+# Quota minima di righe confermate riconosciute nel testo per imparare il layout
+_MIN_ROW_COVERAGE = 0.6
+_DESCRIPTION_KEY_LENGTH = 20
+
+
+def _norm(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _cells(row: str) -> List[str]:
+    return [cell.strip() for cell in row.split(CELL_SEPARATOR)]
+
+
+def parse_number(text: str) -> Optional[float]:
+    """Numero da una cella ("1.234,56", "1,234.56", "22%", "€ 3,50"), None se non è un numero"""
+    cleaned = text.replace("€", "").replace("%", "").replace(" ", "").strip()
+    if not re.fullmatch(r"-?[\d.,]*\d", cleaned):
+        return None
+    if "," in cleaned and "." in cleaned:
+        if cleaned.rfind(",") > cleaned.rfind("."):
+            cleaned = cleaned.replace(".", "").replace(",", ".")
+        else:
+            cleaned = cleaned.replace(",", "")
+    elif "," in cleaned:
+        cleaned = cleaned.replace(",", ".")
+    elif cleaned.count(".") > 1:
+        cleaned = cleaned.replace(".", "")
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def parse_date(text: str) -> Optional[str]:
+    """Data in formato ISO da "01/02/2024", "1-2-24", "2024-02-01"..."""
+    try:
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", text):
+            return datetime.strptime(text, "%Y-%m-%d").date().isoformat()
+        day, month, year = re.split(r"[/.-]", text)
+        if len(year) == 2:
+            year = f"20{year}"
+        return datetime(int(year), int(month), int(day)).date().isoformat()
+    except ValueError:
+        return None
+
+
+def _same_number(a: Optional[float], b: Optional[float]) -> bool:
+    return a is not None and b is not None and abs(a - b) < 0.011
+
+
+@dataclass
+class LayoutTemplate:
+    header: str  # riga di intestazione della tabella righe (normalizzata)
+    supplier_anchor: str  # P.IVA o nome del fornitore presente nel testo (normalizzato)
+    columns: int  # celle di una riga fattura
+    roles: Dict[str, int]  # campo di riga -> indice della cella
+    footer: Optional[str] = None  # etichetta che chiude la tabella, es "totale imponibile"
+    labels: Dict[str, str] = field(default_factory=dict)  # campo di testata -> etichetta che lo precede
+    currency: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(f"{self.header}\n{self.supplier_anchor}".encode("utf-8")).hexdigest()[:32]
+
+    def same_layout(self, other: "LayoutTemplate") -> bool:
+        """Stesse colonne con gli stessi campi (le etichette di testata possono arricchirsi)"""
+        return (self.header, self.columns, self.roles, self.footer) == (other.header, other.columns, other.roles, other.footer)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> "LayoutTemplate":
+        return cls(**json.loads(data))
+
+
+# --- apprendimento dalla fattura confermata ---
+
+def _row_has_number(row: str, value: Optional[float]) -> bool:
+    return value is None or any(_same_number(parse_number(m.group()), value) for m in _AMOUNT.finditer(row))
+
+
+def _match_line_rows(rows: List[str], lines) -> List[Tuple[int, object]]:
+    """Riga del testo di ogni riga confermata (descrizione + totale), nell'ordine del documento"""
+    matched = []
+    start = 0
+    for line in lines:
+        key = _norm(line.raw_description or "")[:_DESCRIPTION_KEY_LENGTH]
+        if not key:
+            continue
+        for position in range(start, len(rows)):
+            if key in _norm(rows[position]) and _row_has_number(rows[position], line.total):
+                matched.append((position, line))
+                start = position + 1
+                break
+    return matched
+
+
+def _cell_fields(cell: str, line) -> List[str]:
+    """Campi della riga confermata compatibili con il contenuto della cella"""
+    fields = []
+    normalized = _norm(cell)
+    code = (line.product_code or "").strip()
+    description = _norm(line.raw_description or "")[:_DESCRIPTION_KEY_LENGTH]
+
+    if code and cell == code:
+        fields.append("product_code")
+    if description and description in normalized:
+        if code and normalized.startswith(_norm(code) + " "):
+            fields.append("code_description")
+        else:
+            fields.append("raw_description")
+    if line.unit_measure and normalized == _norm(line.unit_measure):
+        fields.append("unit_measure")
+    value = parse_number(cell)
+    if value is not None:
+        fields.extend(name for name in sorted(_NUMERIC_FIELDS) if _same_number(value, getattr(line, name)))
+    return fields
+
+
+def _learn_roles(samples: List[Tuple[List[str], object]]) -> Dict[str, int]:
+    """Colonna di ogni campo, a maggioranza sulle righe riconosciute"""
+    votes: Counter = Counter()
+    for cells, line in samples:
+        for position, cell in enumerate(cells):
+            for name in _cell_fields(cell, line):
+                votes[(name, position)] += 1
+
+    needed = max(1, math.ceil(_MIN_ROW_COVERAGE * len(samples)))
+    roles: Dict[str, int] = {}
+    for name in _LINE_FIELDS:
+        if name == "code_description" and "raw_description" in roles:
+            continue
+        candidates = [(count, position) for (field_name, position), count in votes.items()
+                      if field_name == name and position not in roles.values() and count >= needed]
+        if not candidates:
+            continue
+        best = max(count for count, _ in candidates)
+        positions = [position for count, position in candidates if count == best]
+        # A parità (es quantità 1: prezzo = totale) il totale è la colonna più a destra
+        roles[name] = max(positions) if name == "total" else min(positions)
+    return roles
+
+
+def _header_above(rows: List[str], first_line_row: int) -> Optional[str]:
+    """Intestazione della tabella: la riga con più colonne e senza numeri più vicina sopra la prima riga"""
+    for position in range(first_line_row - 1, max(-1, first_line_row - 15), -1):
+        row = rows[position]
+        if row.startswith(PAGE_MARKER):
+            break
+        if len(_cells(row)) >= 2 and not _DIGIT.search(row):
+            return _norm(row)
+    return None
+
+
+def _text_before_number(row: str) -> str:
+    match = _AMOUNT.search(row)
+    label = _norm((row[:match.start()] if match else row).replace("|", " "))
+    return label.strip(" :.-")
+
+
+def _footer_below(rows: List[str], last_line_row: int, columns: int) -> Optional[str]:
+    """Prima riga con un importo dopo la tabella (es "Totale imponibile | 120,00")"""
+    for position in range(last_line_row + 1, min(len(rows), last_line_row + 30)):
+        row = rows[position]
+        if row.startswith(PAGE_MARKER):
+            break
+        if _AMOUNT.search(row) and len(_cells(row)) != columns:
+            label = _text_before_number(row)
+            if len(label) >= 3 and not _DIGIT.search(label):
+                return label
+    return None
+
+
+def _label_before(row: str, start: int) -> Optional[str]:
+    """Etichetta subito prima di un valore: la cella precedente o il testo prima del valore nella cella"""
+    before = row[:start].rstrip()
+    if before.endswith("|"):
+        before = before[:-1].rstrip()
+    label = _norm(before.split(CELL_SEPARATOR)[-1])
+    label = _DIGIT.split(label)[-1].strip(" :")  # solo il testo dopo l'ultimo numero
+    label = label[-30:].strip()
+    return label if len(label) >= 2 else None
+
+
+def _learn_label(rows: List[str], pattern: re.Pattern, matches_value, reverse: bool = False) -> Optional[str]:
+    ordered = reversed(rows) if reverse else rows
+    for row in ordered:
+        for match in pattern.finditer(row):
+            if matches_value(match.group()):
+                label = _label_before(row, match.start())
+                if label:
+                    return label
+    return None
+
+
+def learn_template(
+    text: str,
+    anchors: Iterable[Optional[str]],
+    invoice_number: Optional[str],
+    invoice_date: Optional[str],
+    total_amount: Optional[float],
+    currency: Optional[str],
+    lines,
+) -> Optional[LayoutTemplate]:
+    """
+    Layout dal testo del PDF e dai dati confermati dall'utente.
+    None se le righe confermate non si ritrovano nel testo in modo coerente.
+    """
+    rows = text.splitlines()
+    lines = list(lines)
+    matched = _match_line_rows(rows, lines)
+    if not matched or len(matched) < math.ceil(_MIN_ROW_COVERAGE * len(lines)):
+        return None
+
+    columns = Counter(len(_cells(rows[position])) for position, _ in matched).most_common(1)[0][0]
+    matched = [(position, line) for position, line in matched if len(_cells(rows[position])) == columns]
+    roles = _learn_roles([(_cells(rows[position]), line) for position, line in matched])
+    if "total" not in roles or not ({"raw_description", "code_description"} & roles.keys()):
+        return None
+
+    header = _header_above(rows, matched[0][0])
+    normalized_text = _norm(text)
+    supplier_anchor = next((_norm(anchor) for anchor in anchors if anchor and _norm(anchor) in normalized_text), None)
+    if header is None or supplier_anchor is None:
+        return None
+
+    labels = {}
+    if invoice_number:
+        number = re.compile(r"(?<![\w/.-])" + re.escape(invoice_number) + r"(?![\w/-])")
+        labels["invoice_number"] = _learn_label(rows, number, lambda value: True)
+    if invoice_date:
+        labels["invoice_date"] = _learn_label(rows, _DATE, lambda value: parse_date(value) == invoice_date)
+    if total_amount is not None:
+        labels["total_amount"] = _learn_label(rows, _AMOUNT, lambda value: _same_number(parse_number(value), total_amount), reverse=True)
+
+    return LayoutTemplate(
+        header=header,
+        supplier_anchor=supplier_anchor,
+        columns=columns,
+        roles=roles,
+        footer=_footer_below(rows, matched[-1][0], columns),
+        labels={name: label for name, label in labels.items() if label},
+        currency=currency,
+    )
+
+
+# --- lettura con il template ---
+
+def _value_after(rows: List[str], label: str, value_pattern: str, reverse: bool = False) -> Optional[str]:
+    pattern = re.compile(r"\s+".join(re.escape(word) for word in label.split()) + r"[\s:|]*(" + value_pattern + ")", re.I)
+    for row in (reversed(rows) if reverse else rows):
+        match = pattern.search(row)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _parse_line(cells: List[str], template: LayoutTemplate) -> Optional[InvoiceLineBase]:
+    values: Dict[str, object] = {}
+    for name, position in template.roles.items():
+        cell = cells[position]
+        if name in _NUMERIC_FIELDS:
+            value = parse_number(cell) if cell else None
+            if cell and value is None:
+                return None  # testo dove il layout prevede un numero: non è una riga
+            values[name] = value
+        elif name == "code_description":
+            code, _, description = cell.partition(" ")
+            values["product_code"] = code or None
+            values["raw_description"] = description.strip()
+        else:
+            values[name] = cell or None
+    if not values.get("raw_description") or values.get("total") is None:
+        return None
+    return InvoiceLineBase(**values)
+
+
+def apply_template(template: LayoutTemplate, text: str) -> Tuple[Optional[dict], float]:
+    """
+    Campi della fattura letti con il template e confidenza (0-1): righe della tabella
+    non riconducibili al layout, quantità x prezzo diverso dal totale, etichette di
+    testata non trovate e totale documento incoerente con le righe la abbassano.
+    """
+    rows = text.splitlines()
+    lines: List[InvoiceLineBase] = []
+    unparsed = 0
+    in_table = False
+    for row in rows:
+        normalized = _norm(row)
+        if normalized == template.header:
+            in_table = True
+            continue
+        if row.startswith(PAGE_MARKER) or (template.footer and _text_before_number(row).startswith(template.footer)):
+            in_table = False
+            continue
+        if not in_table or not _AMOUNT.search(row):
+            continue
+        cells = _cells(row)
+        line = _parse_line(cells, template) if len(cells) == template.columns else None
+        if line is None:
+            unparsed += 1
+        else:
+            lines.append(line)
+
+    if not lines:
+        return None, 0.0
+
+    coverage = len(lines) / (len(lines) + unparsed)
+    checked = [line for line in lines if None not in (line.quantity, line.unit_price, line.total)]
+    consistent = sum(1 for line in checked if abs(line.quantity * line.unit_price - line.total) <= max(0.02, 0.02 * abs(line.total)))
+    confidence = min(coverage, consistent / len(checked) if checked else 1.0)
+
+    fields: Dict[str, object] = {}
+    value_patterns = {"invoice_number": _INVOICE_NUMBER_PATTERN, "invoice_date": _DATE_PATTERN, "total_amount": _AMOUNT_PATTERN}
+    for name, label in template.labels.items():
+        raw = _value_after(rows, label, value_patterns[name], reverse=name == "total_amount")
+        if name == "invoice_date" and raw:
+            raw = parse_date(raw)
+        elif name == "total_amount" and raw:
+            raw = parse_number(raw)
+        if raw is None:
+            confidence *= 0.5  # etichetta appresa ma non ritrovata: layout diverso
+        fields[name] = raw
+
+    total_amount = fields.get("total_amount")
+    if total_amount is not None:
+        lines_total = sum(line.total for line in lines)
+        # Totale documento = imponibile delle righe + IVA (al massimo 22%)
+        if not (lines_total - 0.05 <= total_amount <= lines_total * 1.22 + 0.05):
+            confidence *= 0.5
+
+    fields["lines"] = lines
+    fields["currency"] = template.currency
+    return fields, confidence
+
+
+# --- layout appresi: cache, lettura, apprendimento ---
+
+@dataclass(frozen=True)
+class KnownLayout:
+    layout_id: int
+    supplier: SupplierInfo
+    template: LayoutTemplate
+    samples: int
+
+
+class SupplierLayoutCache:
+    """Layout con abbastanza conferme, caricati con una query e tenuti in memoria per LAYOUT_CACHE_TTL_SECONDS"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded: Optional[Tuple[float, List[KnownLayout]]] = None
+
+    def _load(self, db: Session) -> List[KnownLayout]:
+        with self._lock:
+            loaded = self._loaded
+        if loaded and time.monotonic() - loaded[0] < settings.LAYOUT_CACHE_TTL_SECONDS:
+            return loaded[1]
+
+        from app.db.models import Supplier, SupplierLayout
+
+        rows = (
+            db.query(SupplierLayout.id, SupplierLayout.template, SupplierLayout.samples, Supplier.name, Supplier.vat_number, Supplier.address)
+            .join(Supplier, SupplierLayout.supplier_id == Supplier.id)
+            .filter(SupplierLayout.samples >= settings.LAYOUT_TEMPLATE_MIN_SAMPLES)
+            .order_by(SupplierLayout.samples.desc())
+            .all()
+        )
+        layouts = [
+            KnownLayout(layout_id, SupplierInfo(name=name, vat_number=vat_number, address=address), LayoutTemplate.from_json(template), samples)
+            for layout_id, template, samples, name, vat_number, address in rows
+        ]
+        with self._lock:
+            self._loaded = (time.monotonic(), layouts)
+        return layouts
+
+    def candidates(self, db: Session, text: str) -> List[KnownLayout]:
+        """Layout le cui ancore (fornitore + intestazione tabella) compaiono nel testo"""
+        normalized_text = _norm(text)
+        normalized_rows = {_norm(row) for row in text.splitlines()}
+        return [
+            layout for layout in self._load(db)
+            if layout.template.supplier_anchor in normalized_text and layout.template.header in normalized_rows
+        ]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded = None
+
+
+# Istanza condivisa a livello di processo
+supplier_layout_cache = SupplierLayoutCache()
+
+
+def _count_outcome(db: Session, layout_id: int, column: str) -> None:
+    from app.db.models import SupplierLayout
+
+    db.query(SupplierLayout).filter(SupplierLayout.id == layout_id).update(
+        {column: getattr(SupplierLayout, column) + 1}, synchronize_session=False
+    )
+    db.commit()
+
+
+def extract_with_layout_template(text: str) -> Optional[InvoiceExtraction]:
+    """
+    Fattura letta con il template del fornitore, senza chiamata AI.
+    None se nessun layout noto corrisponde o la confidenza è sotto LAYOUT_TEMPLATE_MIN_CONFIDENCE.
+    Sincrona (DB), da eseguire nel thread pool.
+    """
+    from app.db.session import SessionLocal
+
+    db = SessionLocal()
+    try:
+        for layout in supplier_layout_cache.candidates(db, text):
+            fields, confidence = apply_template(layout.template, text)
+            if fields is not None and confidence >= settings.LAYOUT_TEMPLATE_MIN_CONFIDENCE:
+                _count_outcome(db, layout.layout_id, "hits")
+                logger.info(f"🧩 Invoice read with layout template of {layout.supplier.name} (confidence {confidence:.2f})")
+                return InvoiceExtraction(supplier=layout.supplier, **fields)
+            _count_outcome(db, layout.layout_id, "fallbacks")
+            logger.info(f"🧩 Layout of {layout.supplier.name} recognised but confidence {confidence:.2f} too low, using the model")
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Layout template extraction failed: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def save_layout_sample(file_bytes: bytes, text: str, extraction: InvoiceExtraction) -> Optional[str]:
+    """
+    Conserva il testo di un PDF importato fino alla conferma e ritorna il suo id
+    (da rimandare in /invoices/confirm come layout_sample_id). Sincrona, thread pool.
+    """
+    from app.db.models import LayoutSample
+    from app.db.session import SessionLocal
+
+    sample_id = file_hash(file_bytes)
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        db.query(LayoutSample).filter(
+            LayoutSample.created_at < now - timedelta(hours=settings.LAYOUT_SAMPLE_TTL_HOURS)
+        ).delete(synchronize_session=False)
+        db.merge(LayoutSample(
+            id=sample_id,
+            text=text,
+            extraction=json.dumps({
+                "supplier_name": extraction.supplier.name,
+                "supplier_vat_number": extraction.supplier.vat_number,
+                "total_amount": extraction.total_amount,
+            }, ensure_ascii=False),
+            created_at=now,
+        ))
+        db.commit()
+        return sample_id
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"⚠️ Layout sample not saved: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def _vat_digits(vat_number: Optional[str]) -> Optional[str]:
+    digits = re.sub(r"\D", "", vat_number or "")
+    return digits if len(digits) == 11 else None
+
+
+def learn_supplier_layout(
+    db: Session,
+    supplier_id: int,
+    sample_id: str,
+    invoice_number: Optional[str],
+    invoice_date: Optional[str],
+    currency: Optional[str],
+    lines,
+) -> bool:
+    """
+    Impara (nella transazione corrente) il layout del fornitore dal testo del PDF
+    importato e dai dati confermati. Un layout uguale a quello già noto ne aumenta
+    le conferme, uno diverso lo sostituisce ripartendo da una.
+    """
+    from app.db.models import LayoutSample, Supplier, SupplierLayout
+
+    sample = db.get(LayoutSample, sample_id)
+    supplier = db.get(Supplier, supplier_id)
+    if sample is None or supplier is None:
+        return False
+
+    extracted = json.loads(sample.extraction)
+    anchors = [
+        _vat_digits(supplier.vat_number),
+        _vat_digits(extracted.get("supplier_vat_number")),
+        supplier.name,
+        extracted.get("supplier_name"),
+    ]
+    template = learn_template(
+        sample.text, anchors, invoice_number, invoice_date, extracted.get("total_amount"), currency, lines
+    )
+    db.delete(sample)
+    if template is None:
+        logger.info(f"🧩 Layout of supplier {supplier_id} not learned: confirmed lines not found in the PDF text")
+        return False
+
+    now = datetime.utcnow()
+    layout = (
+        db.query(SupplierLayout)
+        .filter(SupplierLayout.supplier_id == supplier_id, SupplierLayout.fingerprint == template.fingerprint)
+        .first()
+    )
+    if layout is None:
+        db.add(SupplierLayout(
+            supplier_id=supplier_id,
+            fingerprint=template.fingerprint,
+            template=template.to_json(),
+            samples=1,
+            hits=0,
+            fallbacks=0,
+            created_at=now,
+            updated_at=now,
+        ))
+    else:
+        previous = LayoutTemplate.from_json(layout.template)
+        if previous.same_layout(template):
+            template.labels = {**previous.labels, **template.labels}
+            layout.samples += 1
+        else:
+            layout.samples = 1
+        layout.template = template.to_json()
+        layout.updated_at = now
+    db.flush()
+    supplier_layout_cache.invalidate()
+    return True
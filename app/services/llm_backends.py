@@ -0,0 +1,311 @@
+# app/services/llm_backends.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from datapizza.clients.openai import OpenAIClient
+from datapizza.core.clients.models import ClientResponse
+from datapizza.type import MediaBlock
+
+from app.config import settings
+from app.services.fake_llm import FakeLLMClient
+from app.services.llm_resilience import ResilientClient
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_BACKENDS = ("datapizza", "record", "replay", "synthetic")
+
+# stop_reason delle risposte interrotte per esaurimento di max_tokens (come nel client OpenAI)
+_TRUNCATED_STOP_REASON = "incomplete"
+
+
+class RecordingNotFoundError(LookupError):
+    """Backend replay: nessuna risposta registrata per questo input"""
+
+
+def request_key(blocks: list) -> str:
+    """
+    Hash dell'input del modello (prompt + file o testo estratto): stesso file e stesso
+    prompt danno la stessa chiave, ogni blocco di un PDF lungo ha la sua.
+    Modello e max_tokens non ne fanno parte: il routing dipende dallo stato del DB.
+    """
+    digest = hashlib.sha256()
+    for block in blocks:
+        if isinstance(block, MediaBlock):
+            digest.update(f"media:{block.media.extension}:".encode("utf-8"))
+            digest.update(str(block.media.source).encode("ascii", "replace"))
+        else:
+            digest.update(f"text:{getattr(block, 'content', '')}".encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# --- registrazioni ---
+
+
+class ResponseRecordings:
+    """Un file JSON per input (chiave = request_key) con testo, stop_reason, token e latenza"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict) -> None:
+        """Una risposta troncata non sostituisce una completa (la rilancia con budget pieno la registra)"""
+        existing = self.get(key)
+        if existing and existing.get("stop_reason") != _TRUNCATED_STOP_REASON and entry.get("stop_reason") == _TRUNCATED_STOP_REASON:
+            return
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+class RecordingClient:
+    """Client reale che salva ogni risposta riuscita per il backend replay"""
+
+    def __init__(self, client, recordings: ResponseRecordings, model: str):
+        self.client = client
+        self.recordings = recordings
+        self.model = model
+
+    def _save(self, kwargs: dict, text: str, response, started: float) -> None:
+        usage = getattr(response, "usage", None)
+        try:
+            self.recordings.put(request_key(kwargs.get("input") or []), {
+                "model": self.model,
+                "text": text,
+                "stop_reason": getattr(response, "stop_reason", None),
+                "prompt_tokens": usage.prompt_tokens if usage else None,
+                "completion_tokens": usage.completion_tokens if usage else None,
+                "latency_ms": int((time.perf_counter() - started) * 1000),
+                "recorded_at": time.time(),
+            })
+        except Exception as e:
+            logger.warning(f"⚠️ Could not record LLM response: {e}")
+
+    def invoke(self, **kwargs):
+        started = time.perf_counter()
+        response = self.client.invoke(**kwargs)
+        self._save(kwargs, response.text, response, started)
+        return response
+
+    async def a_invoke(self, **kwargs):
+        started = time.perf_counter()
+        response = await self.client.a_invoke(**kwargs)
+        await asyncio.to_thread(self._save, kwargs, response.text, response, started)
+        return response
+
+    async def a_stream_invoke(self, **kwargs):
+        started = time.perf_counter()
+        deltas: List[str] = []
+        last = None
+        async for chunk in self.client.a_stream_invoke(**kwargs):
+            last = chunk
+            deltas.append(chunk.delta or "")
+            yield chunk
+        await asyncio.to_thread(self._save, kwargs, "".join(deltas), last, started)
+
+
+class ReplayClient(FakeLLMClient):
+    """
+    Risposte registrate dal backend record, senza chiamare il provider. Latenza
+    simulata: quella di FakeLLMClient più la latenza registrata x latency_scale.
+    """
+
+    def __init__(self, recordings: ResponseRecordings, latency_scale: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.recordings = recordings
+        self.latency_scale = latency_scale
+
+    def _reply(self, kwargs: dict) -> Tuple[ClientResponse, float]:
+        key = request_key(kwargs.get("input") or [])
+        entry = self.recordings.get(key)
+        if entry is None:
+            raise RecordingNotFoundError(
+                f"Nessuna risposta registrata per questo documento (chiave {key[:16]}): "
+                f"importalo una volta con EXTRACTION_BACKEND=record"
+            )
+        response = self._response(
+            entry["text"],
+            stop_reason=entry.get("stop_reason") or "completed",
+            prompt_tokens=entry.get("prompt_tokens") or 0,
+            completion_tokens=entry.get("completion_tokens"),
+        )
+        recorded = (entry.get("latency_ms") or 0) / 1000 * self.latency_scale
+        return response, recorded + self._generation_seconds(response)
+
+
+# --- fatture sintetiche ---
+
+_SYNTHETIC_SUPPLIERS = [
+    ("Alfa Distribuzione Alimentare S.r.l.", "IT01234560011", "Via Roma 1, Milano"),
+    ("Bottega Verde Ortofrutta S.n.c.", "IT02345670022", "Via Garibaldi 12, Torino"),
+    ("Caseificio Monti S.p.A.", "IT03456780033", "Strada Provinciale 4, Parma"),
+    ("Delta Bevande S.r.l.", "IT04567890044", "Viale Europa 88, Verona"),
+    ("Emporio Horeca S.r.l.", "IT05678900055", "Via Napoli 3, Bari"),
+    ("Forno Fratelli Rossi S.a.s.", "IT06789010066", "Corso Italia 45, Firenze"),
+]
+_SYNTHETIC_ITEMS = [
+    ("Farina tipo 00", "KG"), ("Farina di semola rimacinata", "KG"), ("Zucchero semolato", "KG"),
+    ("Olio extravergine di oliva", "LT"), ("Olio di semi di girasole", "LT"), ("Pomodori pelati", "PZ"),
+    ("Passata di pomodoro", "PZ"), ("Mozzarella fior di latte", "KG"), ("Parmigiano Reggiano 24 mesi", "KG"),
+    ("Ricotta vaccina", "KG"), ("Burro", "KG"), ("Latte intero", "LT"), ("Panna da cucina", "LT"),
+    ("Uova fresche", "PZ"), ("Caffè in grani", "KG"), ("Acqua minerale naturale", "CF"),
+    ("Acqua minerale frizzante", "CF"), ("Birra chiara", "CF"), ("Vino rosso", "PZ"), ("Riso Carnaroli", "KG"),
+    ("Pasta penne rigate", "KG"), ("Pasta spaghetti", "KG"), ("Prosciutto crudo", "KG"), ("Salame Milano", "KG"),
+    ("Tonno sott'olio", "PZ"), ("Basilico fresco", "PZ"), ("Insalata iceberg", "PZ"), ("Patate", "KG"),
+    ("Cipolle dorate", "KG"), ("Limoni", "KG"),
+]
+_SYNTHETIC_FORMATS = ["", " 500g", " 1kg", " 5kg", " 25kg", " 1l", " 5l", " bio", " conf. 6pz", " conf. 12pz"]
+_SYNTHETIC_VAT = [4, 10, 22]
+
+
+def _synthetic_catalog(supplier_index: int) -> List[Tuple[str, str, str, float]]:
+    """Catalogo fisso del fornitore: (codice, descrizione, unità, prezzo base)"""
+    rng = random.Random(f"catalog-{supplier_index}")
+    products = [(item, unit, fmt) for item, unit in _SYNTHETIC_ITEMS for fmt in _SYNTHETIC_FORMATS]
+    chosen = rng.sample(products, 120)
+    return [
+        (f"{supplier_index + 1}{position:04d}", f"{item}{fmt}", unit, round(rng.uniform(0.5, 60.0), 2))
+        for position, (item, unit, fmt) in enumerate(chosen)
+    ]
+
+
+def synthetic_invoice(key: str, line_count: int) -> dict:
+    """
+    Fattura inventata ma coerente, determinata dalla chiave: fornitori e cataloghi
+    fissi (i prodotti si ripetono tra le fatture, come nella realtà), prezzi che
+    variano di qualche punto percentuale tra un documento e l'altro.
+    """
+    rng = random.Random(key)
+    supplier_index = rng.randrange(len(_SYNTHETIC_SUPPLIERS))
+    name, vat_number, address = _SYNTHETIC_SUPPLIERS[supplier_index]
+    catalog = _synthetic_catalog(supplier_index)
+    if line_count <= len(catalog):
+        items = rng.sample(catalog, line_count)
+    else:
+        items = [rng.choice(catalog) for _ in range(line_count)]
+
+    lines = []
+    total_amount = 0.0
+    for code, description, unit, base_price in items:
+        quantity = float(rng.randint(1, 24))
+        unit_price = round(base_price * rng.uniform(0.95, 1.05), 2)
+        total = round(quantity * unit_price, 2)
+        vat_rate = _SYNTHETIC_VAT[int(code) % len(_SYNTHETIC_VAT)]
+        total_amount += total * (1 + vat_rate / 100)
+        lines.append({
+            "product_code": code,
+            "raw_description": description,
+            "quantity": quantity,
+            "unit_measure": unit,
+            "unit_price": unit_price,
+            "total": total,
+            "vat_rate": vat_rate,
+        })
+
+    return {
+        "supplier": {"name": name, "vat_number": vat_number, "address": address},
+        "invoice_number": f"SYN-{key[:10].upper()}",
+        "invoice_date": (date(2025, 1, 1) + timedelta(days=rng.randrange(365))).isoformat(),
+        "currency": "EUR",
+        "total_amount": round(total_amount, 2),
+        "lines": lines,
+    }
+
+
+class SyntheticClient(FakeLLMClient):
+    """
+    Genera una fattura per ogni input (stesso documento -> stessa fattura), con un
+    numero di righe tra min_lines e max_lines. Rispetta max_tokens come il modello:
+    oltre il budget la risposta viene troncata con stop_reason "incomplete".
+    I PDF estratti a blocchi ricevono una fattura completa per blocco.
+    """
+
+    def __init__(self, min_lines: int = 5, max_lines: int = 40, **kwargs):
+        super().__init__(**kwargs)
+        self.min_lines = max(1, min_lines)
+        self.max_lines = max(self.min_lines, max_lines)
+
+    def _reply(self, kwargs: dict) -> Tuple[ClientResponse, float]:
+        key = request_key(kwargs.get("input") or [])
+        line_count = random.Random(f"lines-{key}").randint(self.min_lines, self.max_lines)
+        text = json.dumps(synthetic_invoice(key, line_count), ensure_ascii=False)
+
+        stop_reason = "completed"
+        max_tokens = kwargs.get("max_tokens")
+        if max_tokens and len(text) // 4 > max_tokens:
+            text = text[:max_tokens * 4]
+            stop_reason = _TRUNCATED_STOP_REASON
+        response = self._response(text, stop_reason=stop_reason)
+        return response, self._generation_seconds(response)
+
+
+# --- scelta del backend ---
+
+
+def _fake_latency() -> dict:
+    return dict(
+        latency=settings.EXTRACTION_FAKE_LATENCY_SECONDS,
+        jitter=settings.EXTRACTION_FAKE_JITTER_SECONDS,
+        seconds_per_1k_tokens=settings.EXTRACTION_FAKE_SECONDS_PER_1K_TOKENS,
+    )
+
+
+def build_llm_client(model: str):
+    """
+    Client per il modello secondo EXTRACTION_BACKEND:
+    "datapizza" (OpenAI), "record" (OpenAI + risposte salvate in EXTRACTION_RECORDINGS_DIR),
+    "replay" (risposte salvate, nessuna chiamata), "synthetic" (fatture generate).
+    Tutti passano dal livello di resilienza: i retry li gestisce ResilientClient, non l'SDK OpenAI.
+    """
+    backend = settings.EXTRACTION_BACKEND.lower()
+    if backend not in EXTRACTION_BACKENDS:
+        raise ValueError(f"EXTRACTION_BACKEND non valido: {settings.EXTRACTION_BACKEND} (ammessi: {', '.join(EXTRACTION_BACKENDS)})")
+
+    if backend in ("datapizza", "record"):
+        if settings.LLM_RESILIENCE_ENABLED:
+            client = OpenAIClient(
+                api_key=settings.OPENAI_API_KEY,
+                model=model,
+                timeout=settings.LLM_CALL_TIMEOUT_SECONDS,
+                max_retries=0,
+            )
+        else:
+            client = OpenAIClient(
+                api_key=settings.OPENAI_API_KEY,
+                model=model,
+            )
+        if backend == "record":
+            client = RecordingClient(client, ResponseRecordings(settings.EXTRACTION_RECORDINGS_DIR), model)
+    elif backend == "replay":
+        client = ReplayClient(
+            ResponseRecordings(settings.EXTRACTION_RECORDINGS_DIR),
+            latency_scale=settings.EXTRACTION_REPLAY_LATENCY_SCALE,
+            **_fake_latency(),
+        )
+    else:
+        client = SyntheticClient(settings.SYNTHETIC_MIN_LINES, settings.SYNTHETIC_MAX_LINES, **_fake_latency())
+
+    if backend != "datapizza":
+        logger.info(f"🧪 LLM backend '{backend}' for {model}")
+    return ResilientClient(client, name=model) if settings.LLM_RESILIENCE_ENABLED else client
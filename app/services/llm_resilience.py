@@ -0,0 +1,343 @@
+# app/services/llm_resilience.py
+import asyncio
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Status HTTP del provider per cui ha senso riprovare
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMUnavailableError(RuntimeError):
+    """Provider non disponibile: circuito aperto o tentativi esauriti su errori transitori"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retryable_exceptions() -> tuple:
+    errors = (asyncio.TimeoutError, TimeoutError, ConnectionError)
+    try:
+        import openai
+
+        errors += (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+    except ImportError:
+        pass
+    return errors
+
+
+_RETRYABLE_EXCEPTIONS = _retryable_exceptions()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Timeout, errori di rete, 429 e 5xx; gli errori di richiesta (400, 401...) no"""
+    if isinstance(error, _RETRYABLE_EXCEPTIONS):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt: int) -> float:
+    """Backoff esponenziale con full jitter: casuale tra 0 e base * 2^attempt (max LLM_RETRY_MAX_SECONDS)"""
+    return random.uniform(0, min(settings.LLM_RETRY_MAX_SECONDS, settings.LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Dopo LLM_BREAKER_FAILURES errori transitori consecutivi il circuito si apre e le
+    chiamate falliscono subito per LLM_BREAKER_RESET_SECONDS; poi passa una sola
+    chiamata di prova (half-open): se riesce il circuito si richiude.
+
+    allow() ritorna il tipo di chiamata ammessa (NORMAL o TRIAL, None se rifiutata)
+    da ripassare all'esito: solo la chiamata di prova decide sul circuito aperto,
+    le chiamate partite prima dell'apertura non lo toccano.
+    """
+
+    NORMAL = "normal"
+    TRIAL = "trial"
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half_open"
+            return "open"
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> Optional[str]:
+        with self._lock:
+            if self._opened_at is None:
+                return self.NORMAL
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                return None
+            self._trial_running = True
+            return self.TRIAL
+
+    def record_success(self, admission: str) -> None:
+        with self._lock:
+            if admission == self.TRIAL:
+                logger.info(f"🔌 Circuit breaker closed for {self.name}")
+                self._failures = 0
+                self._opened_at = None
+                self._trial_running = False
+            elif self._opened_at is None:
+                self._failures = 0
+
+    def record_failure(self, admission: str) -> None:
+        with self._lock:
+            if admission == self.TRIAL:
+                logger.warning(f"🔌 Circuit breaker reopened for {self.name}: trial call failed")
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+            elif self._opened_at is None:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    logger.warning(f"🔌 Circuit breaker open for {self.name} after {self._failures} failures")
+                    self._opened_at = time.monotonic()
+
+    def release(self, admission: str) -> None:
+        """Chiamata conclusa con un errore non imputabile al provider: libera la prova"""
+        if admission == self.TRIAL:
+            with self._lock:
+                self._trial_running = False
+
+
+class LatencyTracker:
+    """Latenze recenti delle chiamate riuscite, per il ritardo delle richieste hedged (p95)"""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < settings.LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def call_with_deadline(fn, kwargs: dict, timeout: float, name: str = "llm-call"):
+    """
+    Esegue fn(**kwargs) in un thread dedicato e aspetta al massimo timeout secondi
+    dal suo avvio. Una chiamata bloccante non si può interrompere: allo scadere
+    viene abbandonata e il suo thread termina con il timeout passato all'SDK, senza
+    occupare un pool condiviso (le chiamate successive non restano in coda).
+    """
+    future: concurrent.futures.Future = concurrent.futures.Future()
+
+    def run() -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(**kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future.result(timeout=timeout)
+
+
+async def _aclose(stream) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        logger.debug(f"Stream close failed: {e!r}")
+
+
+class ResilientClient:
+    """
+    Avvolge un client Datapizza (invoke / a_invoke / a_stream_invoke) con:
+    scadenza per chiamata, retry con backoff e jitter sugli errori transitori,
+    richiesta duplicata (hedged) se la prima supera il p95 delle latenze recenti
+    (LLM_HEDGE_ENABLED, solo a_invoke) e circuit breaker per modello.
+    """
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+        self.breaker = CircuitBreaker(name, settings.LLM_BREAKER_FAILURES, settings.LLM_BREAKER_RESET_SECONDS)
+        self.latencies = LatencyTracker()
+
+    def _check_breaker(self) -> str:
+        admission = self.breaker.allow()
+        if admission is None:
+            retry_after = self.breaker.retry_after()
+            raise LLMUnavailableError(
+                f"Servizio di estrazione temporaneamente non disponibile ({self.name}), riprova tra {retry_after:.0f}s",
+                retry_after=retry_after,
+            )
+        return admission
+
+    def _give_up(self, error: BaseException, attempts: int) -> LLMUnavailableError:
+        reason = str(error) or type(error).__name__
+        return LLMUnavailableError(f"Servizio di estrazione non raggiungibile dopo {attempts} tentativi: {reason}")
+
+    def _outcome(self, admission: str, error: Optional[BaseException]) -> None:
+        if error is None:
+            self.breaker.record_success(admission)
+        elif is_retryable(error):
+            self.breaker.record_failure(admission)
+        else:
+            self.breaker.release(admission)
+
+    # --- sincrono ---
+
+    def invoke(self, **kwargs):
+        attempts = 1 + max(0, settings.LLM_MAX_RETRIES)
+        for attempt in range(attempts):
+            admission = self._check_breaker()
+            started = time.perf_counter()
+            try:
+                response = call_with_deadline(
+                    self.client.invoke, kwargs, settings.LLM_CALL_TIMEOUT_SECONDS, name=f"llm-call-{self.name}"
+                )
+            except concurrent.futures.TimeoutError:
+                error: BaseException = TimeoutError(f"nessuna risposta entro {settings.LLM_CALL_TIMEOUT_SECONDS}s")
+            except Exception as e:
+                error = e
+            else:
+                self._outcome(admission, None)
+                self.latencies.record(time.perf_counter() - started)
+                return response
+
+            self._outcome(admission, error)
+            if not is_retryable(error):
+                raise error
+            if attempt + 1 >= attempts:
+                raise self._give_up(error, attempts) from error
+            delay = backoff_delay(attempt)
+            logger.warning(f"⚠️ LLM call to {self.name} failed ({error}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+    # --- async ---
+
+    async def _a_timed(self, **kwargs):
+        started = time.perf_counter()
+        response = await asyncio.wait_for(self.client.a_invoke(**kwargs), timeout=settings.LLM_CALL_TIMEOUT_SECONDS)
+        self.latencies.record(time.perf_counter() - started)
+        return response
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not settings.LLM_HEDGE_ENABLED:
+            return None
+        p95 = self.latencies.percentile(0.95)
+        return None if p95 is None else max(settings.LLM_HEDGE_MIN_DELAY_SECONDS, p95)
+
+    async def _a_attempt(self, **kwargs):
+        """Una chiamata; se supera il ritardo di hedge parte un duplicato e vince la prima risposta valida"""
+        tasks = [asyncio.ensure_future(self._a_timed(**kwargs))]
+        try:
+            delay = self._hedge_delay()
+            if delay is None:
+                return await tasks[0]
+
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                logger.info(f"🪁 LLM call to {self.name} slower than {delay:.1f}s, sending hedged request")
+                tasks.append(asyncio.ensure_future(self._a_timed(**kwargs)))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                results = [(task.exception(), task) for task in done]
+                for task_error, task in results:
+                    if task_error is None:
+                        return task.result()
+                    error = task_error
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def a_invoke(self, **kwargs):
+        attempts = 1 + max(0, settings.LLM_MAX_RETRIES)
+        for attempt in range(attempts):
+            admission = self._check_breaker()
+            try:
+                response = await self._a_attempt(**kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release(admission)
+                raise
+            except Exception as e:
+                self._outcome(admission, e)
+                if not is_retryable(e):
+                    raise
+                if attempt + 1 >= attempts:
+                    raise self._give_up(e, attempts) from e
+                delay = backoff_delay(attempt)
+                logger.warning(f"⚠️ LLM call to {self.name} failed ({e!r}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self._outcome(admission, None)
+                return response
+
+    async def a_stream_invoke(self, **kwargs) -> AsyncIterator:
+        """
+        Streaming con scadenza complessiva; si riprova solo se l'errore arriva prima
+        del primo chunk (dopo, il chiamante ha già ricevuto parte della risposta).
+        """
+        attempts = 1 + max(0, settings.LLM_MAX_RETRIES)
+        for attempt in range(attempts):
+            admission = self._check_breaker()
+            deadline = time.monotonic() + settings.LLM_CALL_TIMEOUT_SECONDS
+            received = False
+            stream = self.client.a_stream_invoke(**kwargs).__aiter__()
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(0.0, deadline - time.monotonic()))
+                    except StopAsyncIteration:
+                        break
+                    received = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                self.breaker.release(admission)
+                raise
+            except Exception as e:
+                self._outcome(admission, e)
+                # Stream abbandonato: chiuso prima di rilanciare o riprovare (connessione del client)
+                await _aclose(stream)
+                if received or not is_retryable(e):
+                    raise
+                if attempt + 1 >= attempts:
+                    raise self._give_up(e, attempts) from e
+                delay = backoff_delay(attempt)
+                logger.warning(f"⚠️ LLM stream from {self.name} failed ({e!r}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self._outcome(admission, None)
+                return
@@ -0,0 +1,321 @@
+# app/services/match_index.py
+import bisect
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db.models import Product
+from app.services.normalization import normalize_description, extract_product_code
+from app.services.ngram_index import NgramIndex, significant_part
+
+
+@dataclass(frozen=True)
+class IndexedProduct:
+    """Vista leggera di un prodotto tenuta nell'indice in memoria"""
+    id: int
+    name: str
+    product_code: Optional[str]
+    normalized_name: str
+    supplier_id: Optional[int] = None
+
+
+class ProductMatchIndex:
+    """
+    Indice in memoria (locale al processo) del catalogo prodotti.
+    Replica la cascata di find_matching_product senza query al DB:
+    - mappa hash product_code -> prodotti, più la fetta per fornitore (supplier_id, product_code)
+    - mappa nome normalizzato -> prodotti (match esatto)
+    - lista ordinata di nomi normalizzati per le ricerche a prefisso ("codice%")
+    - indice invertito a trigrammi sui nomi normalizzati (match per contenimento)
+
+    Viene costruito una volta dalla tabella products e aggiornato da
+    confirm_invoice / merge_products. Se il DB è cambiato da un altro processo
+    (conteggio o id massimo diversi) o il TTL è scaduto, viene ricostruito; i
+    prodotti modificati altrove (updated_at più recente dell'ultimo visto, ad
+    esempio codice o fornitore assegnati da una conferma) vengono riletti e
+    aggiornati senza ricostruire. Le modifiche fatte senza ORM, che non toccano
+    updated_at, restano visibili solo dopo il TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._products: Dict[int, IndexedProduct] = {}
+        self._by_code: Dict[str, Set[int]] = {}
+        self._by_supplier_code: Dict[Tuple[int, str], Set[int]] = {}
+        self._by_name: Dict[str, Set[int]] = {}
+        self._sorted_names: List[Tuple[str, int]] = []
+        self._ngrams = NgramIndex()
+        self._built_at: Optional[float] = None
+        # updated_at più recente già riflesso nell'indice
+        self._updated_at: Optional[datetime] = None
+        # Incrementato a ogni modifica: permette agli indici derivati di sapere se rigenerarsi
+        self.version = 0
+
+    @property
+    def is_ready(self) -> bool:
+        return self._built_at is not None
+
+    # --- costruzione / freschezza ---
+
+    def build(self, db: Session) -> None:
+        """Ricostruisce l'indice con una sola query sulla tabella products"""
+        rows = db.query(
+            Product.id, Product.name, Product.product_code, Product.normalized_name, Product.supplier_id, Product.updated_at
+        ).all()
+        with self._lock:
+            self._products = {}
+            self._by_code = {}
+            self._by_supplier_code = {}
+            self._by_name = {}
+            self._sorted_names = []
+            self._ngrams = NgramIndex()
+            for product_id, name, product_code, normalized_name, supplier_id, _ in rows:
+                self._add(product_id, name, product_code, normalized_name, supplier_id)
+            self._sorted_names.sort()
+            self._updated_at = max((row.updated_at for row in rows if row.updated_at), default=None)
+            self._built_at = time.monotonic()
+            self.version += 1
+
+    def _check(self, db: Session) -> Tuple[bool, Optional[datetime]]:
+        """(da ricostruire, updated_at più recente del DB): una sola query aggregata"""
+        if self._built_at is None:
+            return True, None
+        if time.monotonic() - self._built_at > settings.MATCH_INDEX_TTL_SECONDS:
+            return True, None
+        db_count, db_max_id, db_updated_at = db.query(
+            func.count(Product.id), func.max(Product.id), func.max(Product.updated_at)
+        ).one()
+        with self._lock:
+            local_count = len(self._products)
+            local_max_id = max(self._products, default=None)
+        return (db_count or 0) != local_count or db_max_id != local_max_id, db_updated_at
+
+    def is_stale(self, db: Session) -> bool:
+        """
+        Confronta (conteggio, id massimo) del DB con lo stato locale:
+        una sola query aggregata, molto più economica di una ricostruzione.
+        """
+        return self._check(db)[0]
+
+    def ensure_fresh(self, db: Session) -> "ProductMatchIndex":
+        stale, db_updated_at = self._check(db)
+        if stale:
+            self.build(db)
+        elif db_updated_at is not None and (self._updated_at is None or db_updated_at > self._updated_at):
+            self._apply_updates(db, self._updated_at)
+        return self
+
+    def _apply_updates(self, db: Session, since: Optional[datetime]) -> None:
+        """Rilegge i prodotti modificati dopo since (indice su updated_at) e li aggiorna nell'indice"""
+        query = db.query(
+            Product.id, Product.name, Product.product_code, Product.normalized_name, Product.supplier_id, Product.updated_at
+        )
+        if since is not None:
+            query = query.filter(Product.updated_at > since)
+        else:
+            query = query.filter(Product.updated_at.isnot(None))
+        rows = query.all()
+        for row in rows:
+            self.upsert(row)
+        latest = max((row.updated_at for row in rows), default=None)
+        with self._lock:
+            if latest is not None and (self._updated_at is None or latest > self._updated_at):
+                self._updated_at = latest
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built_at = None
+
+    # --- aggiornamenti incrementali ---
+
+    def upsert(self, product) -> None:
+        """
+        Aggiunge o aggiorna un prodotto (da chiamare dopo il commit).
+        product: Product o IndexedProduct (id, name, product_code, normalized_name, supplier_id)
+        """
+        if not self.is_ready:
+            return
+        with self._lock:
+            self._remove(product.id)
+            self._add(
+                product.id,
+                product.name,
+                product.product_code,
+                product.normalized_name,
+                product.supplier_id,
+                keep_sorted=True,
+            )
+            self.version += 1
+
+    def remove(self, product_id: int) -> None:
+        if not self.is_ready:
+            return
+        with self._lock:
+            self._remove(product_id)
+            self.version += 1
+
+    def snapshot(self) -> List[IndexedProduct]:
+        with self._lock:
+            return list(self._products.values())
+
+    def _add(
+        self,
+        product_id: int,
+        name: str,
+        product_code: Optional[str],
+        normalized_name: Optional[str] = None,
+        supplier_id: Optional[int] = None,
+        keep_sorted: bool = False,
+    ) -> None:
+        name = name or ""
+        entry = IndexedProduct(
+            id=product_id,
+            name=name,
+            product_code=product_code,
+            normalized_name=normalized_name if normalized_name is not None else normalize_description(name),
+            supplier_id=supplier_id,
+        )
+        self._products[product_id] = entry
+        self._ngrams.add(product_id, entry.normalized_name)
+        if product_code:
+            self._by_code.setdefault(product_code, set()).add(product_id)
+            if supplier_id is not None:
+                self._by_supplier_code.setdefault((supplier_id, product_code), set()).add(product_id)
+        key = entry.normalized_name
+        self._by_name.setdefault(key, set()).add(product_id)
+        if keep_sorted:
+            bisect.insort(self._sorted_names, (key, product_id))
+        else:
+            self._sorted_names.append((key, product_id))
+
+    def _remove(self, product_id: int) -> None:
+        entry = self._products.pop(product_id, None)
+        if entry is None:
+            return
+        self._ngrams.remove(product_id)
+        if entry.product_code:
+            ids = self._by_code.get(entry.product_code)
+            if ids:
+                ids.discard(product_id)
+                if not ids:
+                    del self._by_code[entry.product_code]
+            if entry.supplier_id is not None:
+                scoped_key = (entry.supplier_id, entry.product_code)
+                ids = self._by_supplier_code.get(scoped_key)
+                if ids:
+                    ids.discard(product_id)
+                    if not ids:
+                        del self._by_supplier_code[scoped_key]
+        key = entry.normalized_name
+        ids = self._by_name.get(key)
+        if ids:
+            ids.discard(product_id)
+            if not ids:
+                del self._by_name[key]
+        pos = bisect.bisect_left(self._sorted_names, (key, product_id))
+        if pos < len(self._sorted_names) and self._sorted_names[pos] == (key, product_id):
+            del self._sorted_names[pos]
+
+    # --- lookup ---
+
+    def _first(self, ids: Optional[Set[int]]) -> Optional[IndexedProduct]:
+        # A parità di criterio vince l'id più basso (ordine di inserimento a DB)
+        if not ids:
+            return None
+        return self._products[min(ids)]
+
+    def by_code(self, product_code: str, supplier_id: Optional[int] = None) -> Optional[IndexedProduct]:
+        """Prima la fetta del fornitore, poi la ricerca globale"""
+        if supplier_id is not None:
+            product = self._first(self._by_supplier_code.get((supplier_id, product_code)))
+            if product:
+                return product
+        return self._first(self._by_code.get(product_code))
+
+    def by_exact_name(self, raw_description: str) -> Optional[IndexedProduct]:
+        normalized = normalize_description(raw_description)
+        return self._first(self._by_name.get(normalized)) if normalized else None
+
+    def by_name_prefix(self, code: str, supplier_id: Optional[int] = None) -> Optional[IndexedProduct]:
+        prefix = normalize_description(code)
+        if not prefix:
+            return None
+        pos = bisect.bisect_left(self._sorted_names, (prefix, -1))
+        best_id = None
+        best_scoped_id = None
+        while pos < len(self._sorted_names):
+            name, product_id = self._sorted_names[pos]
+            if not name.startswith(prefix):
+                break
+            if best_id is None or product_id < best_id:
+                best_id = product_id
+            if supplier_id is not None and self._products[product_id].supplier_id == supplier_id:
+                if best_scoped_id is None or product_id < best_scoped_id:
+                    best_scoped_id = product_id
+            pos += 1
+        if best_scoped_id is not None:
+            return self._products[best_scoped_id]
+        return self._products[best_id] if best_id is not None else None
+
+    def by_code_or_prefix(self, code: str, supplier_id: Optional[int] = None) -> Optional[IndexedProduct]:
+        return self.by_code(code, supplier_id) or self.by_name_prefix(code, supplier_id)
+
+    def by_normalized_containment(self, normalized: str) -> Optional[IndexedProduct]:
+        with self._lock:
+            product_id = self._ngrams.find_containment(significant_part(normalized))
+            return self._products[product_id] if product_id is not None else None
+
+    def find(
+        self,
+        raw_description: str,
+        product_code: Optional[str] = None,
+        supplier_id: Optional[int] = None,
+    ) -> Optional[IndexedProduct]:
+        """
+        Stessa cascata di priorità di find_matching_product, risolta in memoria.
+        """
+        if not raw_description and not product_code:
+            return None
+
+        with self._lock:
+            if product_code:
+                product = self.by_code_or_prefix(product_code, supplier_id)
+                if product:
+                    return product
+
+            if raw_description:
+                product = self.by_exact_name(raw_description)
+                if product:
+                    return product
+
+            extracted_code = extract_product_code(raw_description) if raw_description else None
+            if extracted_code and extracted_code != product_code:
+                product = self.by_code_or_prefix(extracted_code, supplier_id)
+                if product:
+                    return product
+
+            normalized = normalize_description(raw_description) if raw_description else ""
+            if normalized:
+                return self.by_normalized_containment(normalized)
+
+        return None
+
+
+# Istanza condivisa a livello di processo
+product_match_index = ProductMatchIndex()
+
+
+def get_product_match_index(db: Session) -> Optional[ProductMatchIndex]:
+    """
+    Ritorna l'indice aggiornato, oppure None se disabilitato da configurazione
+    (in quel caso il matching usa le query al DB).
+    """
+    if not settings.MATCH_INDEX_ENABLED:
+        return None
+    return product_match_index.ensure_fresh(db)
@@ -1,15 +1,31 @@
 # app/services/matching.py
-import re
-from typing import Optional
+from typing import Dict, List, Optional
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from app.db.models import Supplier, Product  # per ora solo Product
+from app.services.normalization import normalize_description, extract_product_code, escape_like
+from app.services.match_index import ProductMatchIndex, get_product_match_index, product_match_index
+from app.services.ngram_index import (
+    db_find_containment,
+    db_find_containment_many,
+    db_ngram_backend,
+    significant_part,
+)
+from app.services.similarity import CatalogSimilarityIndex
+from app.services.aliases import product_alias_cache
+from app.config import settings
 from app.schemas.invoice import (
     InvoiceExtraction,
     InvoiceLineWithMatch,
     LineMatchStatus,
+    ProductSuggestion,
 )
 
+# Indice di similarità del catalogo, derivato dall'indice prodotti in memoria
+catalog_similarity_index = CatalogSimilarityIndex()
+
 
 def get_or_create_supplier(db: Session, supplier_name: str) -> Supplier:
     supplier = db.query(Supplier).filter(Supplier.name == supplier_name).first()
@@ -17,57 +33,30 @@ def get_or_create_supplier(db: Session, supplier_name: str) -> Supplier:
         return supplier
     supplier = Supplier(name=supplier_name)
     db.add(supplier)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Creato nel frattempo da un import concorrente dello stesso fornitore
+        db.rollback()
+        return db.query(Supplier).filter(Supplier.name == supplier_name).one()
     db.refresh(supplier)
     return supplier
 
 
-def normalize_description(description: str) -> str:
-    """
-    Normalizza una descrizione prodotto per il matching:
-    - Rimuove parti variabili come "Tipo dato:XXX", "Rif. testo:YYY"
-    - Rimuove spazi multipli
-    - Converti in lowercase
-    - Rimuove caratteri speciali ai margini
-    """
-    if not description:
-        return ""
-    
-    # Rimuovi parti variabili comuni che cambiano tra fatture diverse
-    # Es: "Tipo dato:PDC Rif. testo:3145HOTEL OLIMPIA SRL"
-    cleaned = description
-    cleaned = re.sub(r'\s*Tipo\s+dato\s*:.*?(\s|$)', ' ', cleaned, flags=re.IGNORECASE)
-    cleaned = re.sub(r'\s*Rif\.?\s*testo\s*:.*?(\s|$)', ' ', cleaned, flags=re.IGNORECASE)
-    
-    # Rimuovi spazi multipli e normalizza
-    normalized = re.sub(r'\s+', ' ', cleaned.strip())
-    return normalized.lower()
-
-
-def extract_product_code(description: str) -> str:
-    """
-    Estrae il codice prodotto dalla descrizione.
-    Cerca pattern comuni come numeri all'inizio (es: "0025650.01" o "12345")
-    """
-    if not description:
-        return ""
-    
-    # Cerca pattern tipo: numero con punto opzionale (es: "0025650.01" o "12345")
-    # Match all'inizio della stringa
-    match = re.match(r'^(\d+(?:\.\d+)?)', description.strip())
-    if match:
-        return match.group(1)
-    return ""
-
-
-def find_matching_product(db: Session, raw_description: str, product_code: Optional[str] = None) -> Optional[Product]:
+def find_matching_product(
+    db: Session,
+    raw_description: str,
+    product_code: Optional[str] = None,
+    supplier_id: Optional[int] = None,
+) -> Optional[Product]:
     """
     Cerca un prodotto esistente che matcha la descrizione.
     Usa più criteri di matching con priorità:
     1. Match deterministico su codice prodotto (se fornito) - PRIORITARIO
        - Cerca prima sul campo product_code del prodotto
        - Fallback sul nome se product_code non è presente nel DB
-    2. Match esatto sul nome (case-insensitive)
+       - Se è noto il fornitore, i prodotti del fornitore hanno la precedenza
+    2. Match esatto sul nome normalizzato (normalized_name)
     3. Match su codice prodotto estratto dalla descrizione (se presente)
     4. Match su parte iniziale normalizzata (primi 50 caratteri)
     """
@@ -77,105 +66,310 @@ def find_matching_product(db: Session, raw_description: str, product_code: Optio
     # 1. Match deterministico su codice prodotto (se fornito esplicitamente)
     # Questo è il check deterministico più affidabile
     if product_code:
-        # PRIORITÀ 1: Match esatto sul campo product_code del prodotto
-        product = db.query(Product).filter(
-            Product.product_code == product_code
-        ).first()
-        
+        product = _find_by_code(db, product_code, supplier_id)
         if product:
             return product
-        
-        # PRIORITÀ 2: Fallback - cerca prodotti che iniziano con lo stesso codice nel nome
-        # (per retrocompatibilità con prodotti vecchi che hanno il codice nel nome)
-        products = db.query(Product).filter(
-            Product.name.ilike(f"{product_code}%")
-        ).all()
-        
-        if products:
-            # Se c'è più di un match, preferisci quello con descrizione più simile
-            # Per ora prendi il primo, ma potresti implementare un algoritmo di similarità
-            return products[0]
     
     # Normalizza la descrizione
     normalized = normalize_description(raw_description) if raw_description else ""
     extracted_code = extract_product_code(raw_description) if raw_description else None
     
-    # 2. Match esatto sul nome (case-insensitive)
-    if raw_description:
+    # 2. Match esatto sul nome normalizzato (seek sull'indice di normalized_name)
+    if normalized:
         product = db.query(Product).filter(
-            Product.name.ilike(raw_description)
-        ).first()
+            Product.normalized_name == normalized
+        ).order_by(Product.id).first()
         
         if product:
             return product
     
     # 3. Match su codice prodotto estratto dalla descrizione (se presente e non già usato)
     if extracted_code and extracted_code != product_code:
-        # Prova prima sul campo product_code
-        product = db.query(Product).filter(
-            Product.product_code == extracted_code
-        ).first()
-        
+        product = _find_by_code(db, extracted_code, supplier_id)
         if product:
             return product
-        
-        # Fallback sul nome
-        products = db.query(Product).filter(
-            Product.name.ilike(f"{extracted_code}%")
-        ).all()
-        
-        if products:
-            return products[0]
     
     # 4. Match su parte iniziale normalizzata (primi caratteri significativi)
     # Rimuove codici e parti comuni, prende i primi 100 caratteri per il matching
     if normalized:
-        significant_part = normalized[:100] if len(normalized) > 100 else normalized
-        if len(significant_part) > 20:  # Almeno 20 caratteri per evitare match troppo generici
-            # Cerca prodotti che contengono questa parte significativa
-            # o che hanno una parte iniziale simile
-            products = db.query(Product).all()
-            for prod in products:
-                prod_normalized = normalize_description(prod.name)
-                # Se la parte significativa è contenuta nel prodotto esistente o viceversa
-                if significant_part in prod_normalized or prod_normalized in significant_part:
-                    # Verifica che non sia un match troppo generico (almeno 20 caratteri comuni)
-                    common_length = min(len(significant_part), len(prod_normalized))
-                    if common_length >= 20:
-                        return prod
+        return find_containment_match(db, normalized)
     
     return None
 
 
-def deterministic_match_line(db: Session, line: InvoiceLineWithMatch) -> InvoiceLineWithMatch:
+def _find_by_code(db: Session, code: str, supplier_id: Optional[int] = None) -> Optional[Product]:
     """
-    Cerca di matchare una riga fattura con un prodotto esistente.
-    Usa criteri multipli con priorità:
-    1. Match deterministico su codice prodotto (se presente) - PRIORITARIO
-    2. Match esatto, codice prodotto estratto, parte iniziale normalizzata
+    PRIORITÀ 1: match esatto sul campo product_code del prodotto.
+    PRIORITÀ 2: prodotti il cui nome normalizzato inizia con il codice
+    (retrocompatibilità con prodotti vecchi che hanno il codice nel nome);
+    con text_pattern_ops il LIKE 'codice%' è un range scan sull'indice.
+    I codici sono univoci solo all'interno di un fornitore: per ciascuna priorità
+    si cerca prima nella fetta del fornitore (indice (supplier_id, product_code)),
+    poi in tutto il catalogo.
     """
-    # Usa il codice articolo se disponibile per un match deterministico più affidabile
-    product = find_matching_product(db, line.raw_description, product_code=line.product_code)
+    scopes = [supplier_id, None] if supplier_id is not None else [None]
 
+    for scope in scopes:
+        query = db.query(Product).filter(Product.product_code == code)
+        if scope is not None:
+            query = query.filter(Product.supplier_id == scope)
+        product = query.order_by(Product.id).first()
+        if product:
+            return product
+
+    prefix = normalize_description(code)
+    if not prefix:
+        return None
+    for scope in scopes:
+        query = db.query(Product).filter(
+            Product.normalized_name.like(f"{escape_like(prefix)}%", escape="\\")
+        )
+        if scope is not None:
+            query = query.filter(Product.supplier_id == scope)
+        product = query.order_by(Product.id).first()
+        if product:
+            return product
+    return None
+
+
+def find_containment_match(db: Session, normalized: str) -> Optional[Product]:
+    """
+    Step 4 del matching: la parte significativa (primi 100 caratteri, almeno 20)
+    è contenuta nel nome normalizzato di un prodotto o viceversa.
+    Usa l'indice n-gram persistente sul DB (pg_trgm / FTS5) se disponibile,
+    altrimenti l'indice a trigrammi in memoria: in entrambi i casi vengono
+    verificati solo i candidati che condividono abbastanza trigrammi.
+    """
+    part = significant_part(normalized)
+    if not part:
+        return None
+
+    if settings.NGRAM_INDEX_BACKEND != "memory" and db_ngram_backend():
+        product_id = db_find_containment(db, part)
+        return db.get(Product, product_id) if product_id is not None else None
+
+    hit = product_match_index.ensure_fresh(db).by_normalized_containment(normalized)
+    return db.get(Product, hit.id) if hit else None
+
+
+def batch_find_matching_products(
+    db: Session,
+    lines: List[InvoiceLineWithMatch],
+    supplier_id: Optional[int] = None,
+) -> list:
+    """
+    Variante set-based di find_matching_product per tutte le righe di una fattura.
+    Ogni livello di priorità viene risolto con UNA query per l'intera fattura:
+    1. product_code IN (...) per i codici espliciti ed estratti dalla descrizione
+    2. normalized_name LIKE 'codice%' (OR dei prefissi) per i codici non trovati
+    3. normalized_name IN (...) per il match esatto sul nome
+    4. contenimento sui nomi normalizzati tramite l'indice n-gram
+    Poi a ogni riga viene assegnato il match con le stesse regole di priorità
+    del matching riga per riga (prodotti del fornitore prima di quelli globali).
+    Il numero di query non cresce con le righe.
+    """
+    codes_by_line = [line.product_code or None for line in lines]
+    extracted_by_line = [
+        (extract_product_code(line.raw_description) if line.raw_description else None) or None
+        for line in lines
+    ]
+    all_codes = {c for c in codes_by_line + extracted_by_line if c}
+
+    # Tier 1: match esatto sul campo product_code
+    by_code: Dict[str, object] = {}
+    by_code_scoped: Dict[str, object] = {}
+    if all_codes:
+        rows = (
+            db.query(Product.id, Product.name, Product.product_code, Product.supplier_id)
+            .filter(Product.product_code.in_(all_codes))
+            .order_by(Product.id)
+            .all()
+        )
+        for row in rows:
+            by_code.setdefault(row.product_code, row)
+            if supplier_id is not None and row.supplier_id == supplier_id:
+                by_code_scoped.setdefault(row.product_code, row)
+
+    # Tier 2: prefisso del codice nel nome normalizzato (prodotti vecchi senza product_code)
+    by_prefix: Dict[str, object] = {}
+    by_prefix_scoped: Dict[str, object] = {}
+    missing_codes = sorted(all_codes - set(by_code))
+    prefixes = {code: normalize_description(code) for code in missing_codes}
+    if any(prefixes.values()):
+        rows = (
+            db.query(Product.id, Product.name, Product.normalized_name, Product.supplier_id)
+            .filter(or_(*[
+                Product.normalized_name.like(f"{escape_like(prefix)}%", escape="\\")
+                for prefix in set(prefixes.values()) if prefix
+            ]))
+            .order_by(Product.id)
+            .all()
+        )
+        for row in rows:
+            for code, prefix in prefixes.items():
+                if prefix and (row.normalized_name or "").startswith(prefix):
+                    by_prefix.setdefault(code, row)
+                    if supplier_id is not None and row.supplier_id == supplier_id:
+                        by_prefix_scoped.setdefault(code, row)
+
+    # Tier 3: match esatto sul nome normalizzato
+    by_name: Dict[str, object] = {}
+    normalized_by_line = [normalize_description(line.raw_description) if line.raw_description else "" for line in lines]
+    descriptions = {n for n in normalized_by_line if n}
+    if descriptions:
+        rows = (
+            db.query(Product.id, Product.name, Product.normalized_name)
+            .filter(Product.normalized_name.in_(descriptions))
+            .order_by(Product.id)
+            .all()
+        )
+        for row in rows:
+            by_name.setdefault(row.normalized_name, row)
+
+    def _by_code(code: Optional[str]):
+        if not code:
+            return None
+        return (
+            by_code_scoped.get(code)
+            or by_code.get(code)
+            or by_prefix_scoped.get(code)
+            or by_prefix.get(code)
+        )
+
+    matches: list = []
+    pending: Dict[int, str] = {}
+    for i, line in enumerate(lines):
+        code = codes_by_line[i]
+        extracted = extracted_by_line[i]
+        normalized = normalized_by_line[i]
+        product = _by_code(code)
+        if product is None and normalized:
+            product = by_name.get(normalized)
+        if product is None and extracted and extracted != code:
+            product = _by_code(extracted)
+        if product is None and normalized:
+            part = significant_part(normalized)
+            if part:
+                pending[i] = part
+        matches.append(product)
+
+    # Tier 4: contenimento, una sola ricerca per tutte le righe ancora senza match
+    if pending:
+        if settings.NGRAM_INDEX_BACKEND != "memory" and db_ngram_backend():
+            found = db_find_containment_many(db, list(pending.values()))
+            for i, part in pending.items():
+                matches[i] = found.get(part)
+        else:
+            index = product_match_index.ensure_fresh(db)
+            for i, part in pending.items():
+                matches[i] = index.by_normalized_containment(part)
+
+    return matches
+
+
+def _apply_match(line: InvoiceLineWithMatch, product) -> InvoiceLineWithMatch:
     if product:
         line.deterministic_product_id = product.id
         line.deterministic_product_label = product.name
         line.match_status = LineMatchStatus.matched
     else:
         line.match_status = LineMatchStatus.unmatched
-
     return line
 
 
-def deterministic_match_all_lines(db: Session, extraction: InvoiceExtraction):
+def deterministic_match_line(
+    db: Session,
+    line: InvoiceLineWithMatch,
+    index: Optional[ProductMatchIndex] = None,
+    supplier_id: Optional[int] = None,
+) -> InvoiceLineWithMatch:
+    """
+    Cerca di matchare una riga fattura con un prodotto esistente.
+    Usa criteri multipli con priorità:
+    0. Alias appreso da una conferma precedente dello stesso fornitore (lookup per chiave)
+    1. Match deterministico su codice prodotto (se presente) - PRIORITARIO
+    2. Match esatto, codice prodotto estratto, parte iniziale normalizzata
+    Se viene passato l'indice in memoria, il matching non fa query al DB.
+    """
+    product = product_alias_cache.lookup(db, supplier_id, line.product_code, line.raw_description)
+
+    # Usa il codice articolo se disponibile per un match deterministico più affidabile
+    if product is None and index is not None:
+        product = index.find(line.raw_description, product_code=line.product_code, supplier_id=supplier_id)
+    elif product is None:
+        product = find_matching_product(
+            db, line.raw_description, product_code=line.product_code, supplier_id=supplier_id
+        )
+
+    return _apply_match(line, product)
+
+
+def get_catalog_similarity_index(db: Session) -> CatalogSimilarityIndex:
+    """Ricostruisce i vettori del catalogo solo se l'indice prodotti è cambiato"""
+    index = product_match_index.ensure_fresh(db)
+    if catalog_similarity_index.version != index.version:
+        version = index.version
+        catalog_similarity_index.build(
+            ((p.id, p.name, p.normalized_name) for p in index.snapshot()),
+            version=version,
+        )
+    return catalog_similarity_index
+
+
+def suggest_products(db: Session, lines: List[InvoiceLineWithMatch]) -> List[InvoiceLineWithMatch]:
+    """
+    Aggiunge alle righe non matchate i top-k prodotti più simili del catalogo,
+    così l'operatore può scegliere un suggerimento invece di cercare a mano.
+    """
+    unmatched = [line for line in lines if line.match_status == LineMatchStatus.unmatched and line.raw_description]
+    if not settings.SUGGESTIONS_ENABLED or not unmatched:
+        return lines
+
+    similarity = get_catalog_similarity_index(db)
+    for line in unmatched:
+        line.suggestions = [
+            ProductSuggestion(product_id=hit.id, label=hit.name, score=hit.score)
+            for hit in similarity.top_k(
+                line.raw_description,
+                k=settings.SUGGESTIONS_TOP_K,
+                min_score=settings.SUGGESTIONS_MIN_SCORE,
+            )
+        ]
+    return lines
+
+
+def deterministic_match_all_lines(db: Session, extraction: InvoiceExtraction, supplier_id: Optional[int] = None):
     """
     Trasforma le InvoiceLineBase in InvoiceLineWithMatch e applica il matching.
+    Prima vengono risolti gli alias appresi del fornitore, poi le righe restanti
+    seguono la strategia (settings.MATCHING_STRATEGY):
+    - "index": indice prodotti in memoria (una sola query di verifica per fattura)
+    - "batch": query set-based, un numero fisso di query per fattura
+    - "per_line": cascata di query riga per riga
+    Le righe rimaste senza match ricevono i suggerimenti fuzzy (top-k).
     """
-    lines_with_match: list[InvoiceLineWithMatch] = []
+    lines_with_match: list[InvoiceLineWithMatch] = [
+        InvoiceLineWithMatch(**l.dict()) for l in extraction.lines
+    ]
+
+    pending: list[InvoiceLineWithMatch] = []
+    for line in lines_with_match:
+        alias = product_alias_cache.lookup(db, supplier_id, line.product_code, line.raw_description)
+        if alias:
+            _apply_match(line, alias)
+        else:
+            pending.append(line)
+
+    if pending:
+        strategy = settings.MATCHING_STRATEGY
+        index = get_product_match_index(db) if strategy == "index" else None
 
-    for l in extraction.lines:
-        line = InvoiceLineWithMatch(**l.dict())
-        line = deterministic_match_line(db, line)
-        lines_with_match.append(line)
+        if index is None and strategy != "per_line":
+            products = batch_find_matching_products(db, pending, supplier_id=supplier_id)
+            for line, product in zip(pending, products):
+                _apply_match(line, product)
+        else:
+            for line in pending:
+                deterministic_match_line(db, line, index=index, supplier_id=supplier_id)
 
-    return lines_with_match
+    return suggest_products(db, lines_with_match)
@@ -0,0 +1,262 @@
+# app/services/ngram_index.py
+import logging
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import inspect, or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.db.models import Product
+from app.services.normalization import escape_like, normalize_description
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+# Lunghezza minima della parte comune (stessa soglia storica dello step 4 del matching)
+MIN_CONTAINMENT_LENGTH = 20
+SIGNIFICANT_PART_LENGTH = 100
+# Numero massimo di finestre per singola query sull'indice persistente
+DB_WINDOWS_PER_QUERY = 400
+
+# Backend DB attivo per questo processo: "postgresql", "sqlite" oppure None (fallback in memoria)
+_db_backend: Optional[str] = None
+
+
+class ProductRef(NamedTuple):
+    """Riferimento minimo (id, nome) a un prodotto trovato dall'indice"""
+    id: int
+    name: str
+
+
+def ngrams(value: str, size: int = NGRAM_SIZE) -> Set[str]:
+    if len(value) < size:
+        return {value} if value else set()
+    return {value[i:i + size] for i in range(len(value) - size + 1)}
+
+
+def significant_part(normalized: str) -> str:
+    """Parte iniziale usata per il match per contenimento (vuota se troppo corta)"""
+    part = normalized[:SIGNIFICANT_PART_LENGTH]
+    return part if len(part) > MIN_CONTAINMENT_LENGTH else ""
+
+
+def is_containment_match(part: str, prod_normalized: str) -> bool:
+    """
+    Semantica storica dello step 4: la parte significativa è contenuta nel nome
+    del prodotto o viceversa, con almeno 20 caratteri in comune.
+    """
+    if not part or not prod_normalized:
+        return False
+    if part in prod_normalized or prod_normalized in part:
+        return min(len(part), len(prod_normalized)) >= MIN_CONTAINMENT_LENGTH
+    return False
+
+
+class NgramIndex:
+    """
+    Indice invertito in memoria trigramma -> prodotti sui nomi normalizzati.
+    Restituisce solo i prodotti che condividono abbastanza trigrammi con la
+    descrizione cercata, invece di scorrere tutto il catalogo:
+    - "parte contenuta nel prodotto": il prodotto deve avere TUTTI i trigrammi della parte
+    - "prodotto contenuto nella parte": TUTTI i trigrammi del prodotto devono stare nella parte
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._gram_counts: Dict[int, int] = {}
+        self._names: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, product_id: int, normalized_name: str) -> None:
+        self.remove(product_id)
+        grams = ngrams(normalized_name)
+        self._names[product_id] = normalized_name
+        self._gram_counts[product_id] = len(grams)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(product_id)
+
+    def remove(self, product_id: int) -> None:
+        normalized_name = self._names.pop(product_id, None)
+        if normalized_name is None:
+            return
+        self._gram_counts.pop(product_id, None)
+        for gram in ngrams(normalized_name):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def candidates(self, part: str) -> Set[int]:
+        grams = ngrams(part)
+        if not grams:
+            return set()
+
+        # Prodotti che contengono la parte: intersezione delle posting list (dalla più corta)
+        postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+        containing = set(postings[0])
+        for ids in postings[1:]:
+            if not containing:
+                break
+            containing &= ids
+
+        # Prodotti contenuti nella parte: tutti i loro trigrammi compaiono nella parte
+        hits: Dict[int, int] = {}
+        for ids in postings:
+            for product_id in ids:
+                hits[product_id] = hits.get(product_id, 0) + 1
+        contained = {
+            product_id for product_id, count in hits.items()
+            if count == self._gram_counts.get(product_id)
+        }
+
+        return containing | contained
+
+    def find_containment(self, part: str) -> Optional[int]:
+        """Id più basso tra i candidati che soddisfano il match per contenimento"""
+        if not part:
+            return None
+        matches = [
+            product_id for product_id in self.candidates(part)
+            if is_containment_match(part, self._names[product_id])
+        ]
+        return min(matches) if matches else None
+
+
+# --- variante persistente su DB ---
+
+def _windows(part: str) -> List[str]:
+    """
+    Finestre di 20 caratteri della parte significativa: ogni prodotto che la
+    contiene, o che vi è contenuto con almeno 20 caratteri, contiene almeno una finestra.
+    """
+    size = MIN_CONTAINMENT_LENGTH
+    return list(dict.fromkeys(part[i:i + size] for i in range(len(part) - size + 1)))
+
+
+def setup_db_ngram_index(engine: Engine) -> Optional[str]:
+    """
+    Crea (in modo idempotente) l'indice n-gram persistente sul DB, sulla colonna
+    products.normalized_name (vedi migrate_add_normalized_name.py):
+    - PostgreSQL: estensione pg_trgm + indice GIN su normalized_name
+    - SQLite: tabella FTS5 con tokenizer trigram, mantenuta da trigger
+    Se non è possibile, il matching usa l'indice in memoria.
+    """
+    global _db_backend
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            columns = {c["name"] for c in inspect(conn).get_columns("products")}
+            if "normalized_name" not in columns:
+                logger.warning("⚠️ products.normalized_name missing: run migrate_add_normalized_name.py")
+                _db_backend = None
+                return None
+
+            if dialect == "postgresql":
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_products_normalized_name_trgm "
+                    "ON products USING gin (normalized_name gin_trgm_ops)"
+                ))
+            elif dialect == "sqlite":
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_normalized_fts'"
+                )).first()
+                if not exists:
+                    conn.execute(text(
+                        "CREATE VIRTUAL TABLE products_normalized_fts USING fts5("
+                        "normalized_name, content='products', content_rowid='id', tokenize='trigram')"
+                    ))
+                    conn.execute(text(
+                        "CREATE TRIGGER products_normalized_fts_ai AFTER INSERT ON products BEGIN "
+                        "INSERT INTO products_normalized_fts(rowid, normalized_name) "
+                        "VALUES (new.id, new.normalized_name); END"
+                    ))
+                    conn.execute(text(
+                        "CREATE TRIGGER products_normalized_fts_ad AFTER DELETE ON products BEGIN "
+                        "INSERT INTO products_normalized_fts(products_normalized_fts, rowid, normalized_name) "
+                        "VALUES ('delete', old.id, old.normalized_name); END"
+                    ))
+                    conn.execute(text(
+                        "CREATE TRIGGER products_normalized_fts_au AFTER UPDATE OF normalized_name ON products BEGIN "
+                        "INSERT INTO products_normalized_fts(products_normalized_fts, rowid, normalized_name) "
+                        "VALUES ('delete', old.id, old.normalized_name); "
+                        "INSERT INTO products_normalized_fts(rowid, normalized_name) "
+                        "VALUES (new.id, new.normalized_name); END"
+                    ))
+                    conn.execute(text(
+                        "INSERT INTO products_normalized_fts(products_normalized_fts) VALUES ('rebuild')"
+                    ))
+            else:
+                _db_backend = None
+                return None
+        _db_backend = dialect
+    except Exception as e:
+        logger.warning(f"⚠️ N-gram index not available on DB, using in-memory fallback: {e}")
+        _db_backend = None
+    return _db_backend
+
+
+def db_ngram_backend() -> Optional[str]:
+    return _db_backend
+
+
+def db_containment_candidates(db: Session, parts: List[str]) -> List[Tuple[int, str, str]]:
+    """
+    Candidati (id, name, normalized_name) dall'indice persistente: prodotti che
+    contengono almeno una finestra di 20 caratteri di una delle parti significative.
+    Tutte le parti (anche di righe diverse) vengono risolte con un'unica query
+    per blocco di finestre.
+    """
+    windows = list(dict.fromkeys(w for part in parts for w in _windows(part)))
+    rows: Dict[int, Tuple[int, str, str]] = {}
+
+    for start in range(0, len(windows), DB_WINDOWS_PER_QUERY):
+        chunk = windows[start:start + DB_WINDOWS_PER_QUERY]
+        if _db_backend == "postgresql":
+            result = db.query(Product.id, Product.name, Product.normalized_name).filter(
+                or_(*[Product.normalized_name.like(f"%{escape_like(w)}%", escape="\\") for w in chunk])
+            ).all()
+        elif _db_backend == "sqlite":
+            query = " OR ".join('"' + w.replace('"', '""') + '"' for w in chunk)
+            result = db.execute(
+                text(
+                    "SELECT p.id, p.name, p.normalized_name FROM products_normalized_fts f "
+                    "JOIN products p ON p.id = f.rowid "
+                    "WHERE products_normalized_fts MATCH :query"
+                ),
+                {"query": query},
+            ).all()
+        else:
+            return []
+        rows.update((row[0], tuple(row)) for row in result)
+
+    return list(rows.values())
+
+
+def db_find_containment_many(db: Session, parts: List[str]) -> Dict[str, ProductRef]:
+    """
+    Verifica in Python i candidati del DB con la semantica dello step 4.
+    Ritorna parte -> prodotto con id più basso che matcha.
+    """
+    parts = [p for p in dict.fromkeys(parts) if p]
+    if not parts:
+        return {}
+    candidates = sorted(
+        (product_id, name, normalized_name or normalize_description(name))
+        for product_id, name, normalized_name in db_containment_candidates(db, parts)
+    )
+    found: Dict[str, ProductRef] = {}
+    for part in parts:
+        for product_id, name, prod_normalized in candidates:
+            if is_containment_match(part, prod_normalized):
+                found[part] = ProductRef(product_id, name)
+                break
+    return found
+
+
+def db_find_containment(db: Session, part: str) -> Optional[int]:
+    hit = db_find_containment_many(db, [part]).get(part)
+    return hit.id if hit else None
@@ -0,0 +1,54 @@
+# app/services/normalization.py
+import hashlib
+import re
+
+
+def normalize_description(description: str) -> str:
+    """
+    Normalizza una descrizione prodotto per il matching:
+    - Rimuove parti variabili come "Tipo dato:XXX", "Rif. testo:YYY"
+    - Rimuove spazi multipli
+    - Converti in lowercase
+    - Rimuove caratteri speciali ai margini
+    """
+    if not description:
+        return ""
+    
+    # Rimuovi parti variabili comuni che cambiano tra fatture diverse
+    # Es: "Tipo dato:PDC Rif. testo:3145HOTEL OLIMPIA SRL"
+    cleaned = description
+    cleaned = re.sub(r'\s*Tipo\s+dato\s*:.*?(\s|$)', ' ', cleaned, flags=re.IGNORECASE)
+    cleaned = re.sub(r'\s*Rif\.?\s*testo\s*:.*?(\s|$)', ' ', cleaned, flags=re.IGNORECASE)
+    
+    # Rimuovi spazi multipli e normalizza
+    normalized = re.sub(r'\s+', ' ', cleaned.strip())
+    return normalized.lower()
+
+
+def description_hash(normalized_description: str) -> str:
+    """
+    SHA-256 di una descrizione già normalizzata: chiave a lunghezza fissa per
+    indici univoci (le descrizioni non hanno limite di lunghezza).
+    """
+    return hashlib.sha256(normalized_description.encode("utf-8")).hexdigest()
+
+
+def extract_product_code(description: str) -> str:
+    """
+    Estrae il codice prodotto dalla descrizione.
+    Cerca pattern comuni come numeri all'inizio (es: "0025650.01" o "12345")
+    """
+    if not description:
+        return ""
+    
+    # Cerca pattern tipo: numero con punto opzionale (es: "0025650.01" o "12345")
+    # Match all'inizio della stringa
+    match = re.match(r'^(\d+(?:\.\d+)?)', description.strip())
+    if match:
+        return match.group(1)
+    return ""
+
+
+def escape_like(value: str) -> str:
+    """Escape dei caratteri speciali di LIKE/ILIKE (da usare con escape="\\")"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
@@ -0,0 +1,96 @@
+# app/services/pdf_pages.py
+import io
+import logging
+import re
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PageRange = Tuple[int, int]  # (prima pagina, ultima pagina esclusa), base 0
+
+
+def _reader(pdf_bytes: bytes):
+    # Import lazy: pypdf serve solo per l'estrazione a blocchi
+    from pypdf import PdfReader
+
+    return PdfReader(io.BytesIO(pdf_bytes))
+
+
+def pdf_page_count(pdf_bytes: bytes) -> Optional[int]:
+    """Numero di pagine, None se pypdf non è installato o il PDF non è leggibile"""
+    try:
+        return len(_reader(pdf_bytes).pages)
+    except ImportError:
+        logger.warning("⚠️ pypdf not installed: chunked PDF extraction disabled")
+    except Exception as e:
+        logger.warning(f"⚠️ Cannot read PDF pages: {e}")
+    return None
+
+
+def page_ranges(page_count: int, pages_per_chunk: int) -> List[PageRange]:
+    size = max(1, pages_per_chunk)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def split_pdf(pdf_bytes: bytes, ranges: List[PageRange]) -> List[bytes]:
+    """Un PDF per ogni intervallo di pagine"""
+    from pypdf import PdfWriter
+
+    reader = _reader(pdf_bytes)
+    chunks = []
+    for start, end in ranges:
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        out = io.BytesIO()
+        writer.write(out)
+        chunks.append(out.getvalue())
+    return chunks
+
+
+_WIDE_GAP = re.compile(r" {3,}")
+
+
+def _compact_layout(page_text: str) -> str:
+    """
+    Testo in layout mode reso compatto: colonne separate da " | " al posto degli
+    spazi di allineamento, righe vuote rimosse (meno token, tabella leggibile).
+    """
+    rows = (_WIDE_GAP.sub(" | ", row.strip()) for row in page_text.splitlines())
+    return "\n".join(row for row in rows if row)
+
+
+def _is_usable_text(text: str, page_count: int, min_chars_per_page: int) -> bool:
+    """Testo sufficiente e leggibile (i PDF scansionati non hanno testo, font senza mappa danno simboli)"""
+    visible = [c for c in text if not c.isspace() and c != "|"]
+    if len(visible) < min_chars_per_page * page_count:
+        return False
+    readable = sum(1 for c in visible if c.isalnum() or c in ".,;:-/%€()")
+    return readable / len(visible) >= 0.8 and text.count("\ufffd") < len(visible) * 0.01
+
+
+def _page_text(page) -> str:
+    try:
+        return page.extract_text(extraction_mode="layout") or ""
+    except KeyError:
+        return ""  # pagina senza contenuto (es. bianca)
+
+
+def extract_text_layer(pdf_bytes: bytes, min_chars_per_page: int) -> Optional[str]:
+    """
+    Testo dei PDF digitali (layout mode di pypdf, colonne ricostruite), pagina per pagina.
+    None se il PDF non ha un text layer utilizzabile o pypdf non è disponibile.
+    """
+    try:
+        reader = _reader(pdf_bytes)
+        pages = [_compact_layout(_page_text(page)) for page in reader.pages]
+    except ImportError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Cannot read PDF text layer: {e}")
+        return None
+
+    text = "\n\n".join(f"--- Pagina {number} ---\n{page}" for number, page in enumerate(pages, start=1))
+    if not pages or not _is_usable_text("".join(pages), len(pages), min_chars_per_page):
+        return None
+    return text
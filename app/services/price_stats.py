@@ -0,0 +1,272 @@
+# app/services/price_stats.py
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from sqlalchemy import Date, DateTime, Float, Integer, and_, bindparam, case, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from app.db.models import Product, ProductPriceHistory, ProductPriceStats
+from app.db.session import dialect_insert
+from app.schemas.product import PriceStats
+
+# Prodotti ricalcolati per query dal rebuild completo
+REBUILD_BATCH_SIZE = 500
+
+
+def latest_prices(db: Session, product_ids: Iterable[int]) -> Dict[int, dict]:
+    """
+    Ultime due voci dello storico per prodotto, con una window function: per ogni
+    prodotto torna una sola riga (la più recente, ROW_NUMBER = 1) con la voce
+    precedente affiancata (LEAD sull'ordine decrescente = LAG su quello crescente).
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+
+    window = dict(
+        partition_by=ProductPriceHistory.product_id,
+        order_by=(ProductPriceHistory.price_date.desc(), ProductPriceHistory.id.desc()),
+    )
+    ranked = (
+        db.query(
+            ProductPriceHistory.product_id.label("product_id"),
+            ProductPriceHistory.unit_price.label("current_price"),
+            ProductPriceHistory.price_date.label("current_price_date"),
+            ProductPriceHistory.id.label("current_history_id"),
+            # type_ esplicito: su SQLite il risultato di LEAD perde il tipo (date come stringhe)
+            func.lead(ProductPriceHistory.unit_price, type_=Float).over(**window).label("previous_price"),
+            func.lead(ProductPriceHistory.price_date, type_=Date).over(**window).label("previous_price_date"),
+            func.lead(ProductPriceHistory.id, type_=Integer).over(**window).label("previous_history_id"),
+            func.row_number().over(**window).label("position"),
+        )
+        .filter(ProductPriceHistory.product_id.in_(product_ids))
+        .subquery()
+    )
+    rows = db.query(ranked).filter(ranked.c.position == 1).all()
+    return {row.product_id: {key: value for key, value in row._asdict().items() if key != "position"} for row in rows}
+
+
+def compute_price_stats(db: Session, product_ids: Iterable[int]) -> Dict[int, dict]:
+    """Statistiche calcolate dallo storico (valori delle colonne di ProductPriceStats)"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    stats = latest_prices(db, product_ids)
+    totals = (
+        db.query(
+            ProductPriceHistory.product_id,
+            func.min(ProductPriceHistory.unit_price),
+            func.max(ProductPriceHistory.unit_price),
+            func.sum(ProductPriceHistory.unit_price),
+            func.count(ProductPriceHistory.id),
+        )
+        .filter(ProductPriceHistory.product_id.in_(product_ids))
+        .group_by(ProductPriceHistory.product_id)
+        .all()
+    )
+    for product_id, min_price, max_price, price_sum, purchase_count in totals:
+        stats[product_id].update(
+            min_price=min_price, max_price=max_price, price_sum=price_sum, purchase_count=purchase_count
+        )
+    return stats
+
+
+def _sync_unit_prices(db: Session, product_ids: List[int]) -> None:
+    """Product.unit_price = prezzo corrente, per i prodotti che hanno uno storico"""
+    current = (
+        select(ProductPriceStats.current_price)
+        .where(ProductPriceStats.product_id == Product.id)
+        .scalar_subquery()
+    )
+    has_stats = select(ProductPriceStats.product_id).where(ProductPriceStats.product_id.in_(product_ids))
+    db.query(Product).filter(Product.id.in_(has_stats)).update(
+        {Product.unit_price: current}, synchronize_session=False
+    )
+
+
+def refresh_price_stats(db: Session, product_ids: Iterable[int]) -> int:
+    """
+    Ricalcola dallo storico le statistiche dei prodotti indicati (eliminazioni,
+    unioni, backfill). Le righe sono aggiornate sul posto con un upsert, senza
+    eliminarle: una conferma concorrente trova sempre la riga da aggiornare.
+    Le righe dei prodotti rimasti senza storico vengono rimosse.
+    Non fa commit: resta nella transazione del chiamante.
+    Ritorna i prodotti che hanno uno storico.
+    """
+    product_ids = list(dict.fromkeys(product_ids))
+    if not product_ids:
+        return 0
+    db.flush()
+    stats = compute_price_stats(db, product_ids)
+    if stats:
+        now = datetime.utcnow()
+        statement = dialect_insert(db)(ProductPriceStats.__table__).values(
+            [dict(values, updated_at=now) for values in stats.values()]
+        )
+        columns = [column.name for column in ProductPriceStats.__table__.columns if column.name != "product_id"]
+        db.execute(statement.on_conflict_do_update(
+            index_elements=["product_id"],
+            set_={name: statement.excluded[name] for name in columns},
+        ))
+    without_history = [product_id for product_id in product_ids if product_id not in stats]
+    if without_history:
+        remove_price_stats(db, without_history)
+    _sync_unit_prices(db, product_ids)
+    return len(stats)
+
+
+def _record_price_statement():
+    """
+    UPDATE incrementale per una nuova voce (parametri price, day, history_id, pid):
+    le espressioni SET usano i valori precedenti della riga.
+    """
+    stats = ProductPriceStats.__table__.c
+    price, day, history_id = bindparam("price", type_=Float), bindparam("day", type_=Date), bindparam("history_id", type_=Integer)
+    newer_than_current = or_(
+        stats.current_price_date < day,
+        and_(stats.current_price_date == day, stats.current_history_id < history_id),
+    )
+    newer_than_previous = or_(
+        stats.previous_price_date.is_(None),
+        stats.previous_price_date < day,
+        and_(stats.previous_price_date == day, stats.previous_history_id < history_id),
+    )
+
+    def shift(current_column, previous_column, value):
+        # Nuova voce più recente: la corrente diventa precedente; tra le due: diventa precedente
+        return case((newer_than_current, current_column), (newer_than_previous, value), else_=previous_column)
+
+    return (
+        update(ProductPriceStats.__table__)
+        .where(stats.product_id == bindparam("pid", type_=Integer))
+        .values(
+            previous_price=shift(stats.current_price, stats.previous_price, price),
+            previous_price_date=shift(stats.current_price_date, stats.previous_price_date, day),
+            previous_history_id=shift(stats.current_history_id, stats.previous_history_id, history_id),
+            current_price=case((newer_than_current, price), else_=stats.current_price),
+            current_price_date=case((newer_than_current, day), else_=stats.current_price_date),
+            current_history_id=case((newer_than_current, history_id), else_=stats.current_history_id),
+            min_price=case((stats.min_price > price, price), else_=stats.min_price),
+            max_price=case((stats.max_price < price, price), else_=stats.max_price),
+            price_sum=stats.price_sum + price,
+            purchase_count=stats.purchase_count + 1,
+            updated_at=bindparam("now", type_=DateTime),
+        )
+    )
+
+
+_RECORD_PRICE = _record_price_statement()
+
+
+def _insert_missing_stats(db: Session, rows: List[dict]) -> set:
+    """
+    INSERT ... ON CONFLICT DO NOTHING delle righe indicate; ritorna i prodotti
+    effettivamente inseriti (gli altri hanno già una riga, creata da una
+    transazione concorrente).
+    """
+    statement = (
+        dialect_insert(db)(ProductPriceStats.__table__)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["product_id"])
+        .returning(ProductPriceStats.__table__.c.product_id)
+    )
+    return set(db.execute(statement).scalars())
+
+
+def record_prices(db: Session, entries: Iterable[ProductPriceHistory]) -> None:
+    """
+    Aggiornamento incrementale dopo l'inserimento di nuove voci di storico:
+    lo stesso UPDATE atomico eseguito una volta per voce (executemany), senza
+    rileggere lo storico. Prodotti senza riga (nuovi o non ancora in backfill):
+    riga calcolata dallo storico, che include già le voci nuove, e inserita senza
+    errore se nel frattempo un'altra conferma l'ha creata; in quel caso le voci
+    nuove passano dall'UPDATE. Conferme concorrenti non perdono aggiornamenti.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    db.flush()
+    product_ids = list({entry.product_id for entry in entries})
+    existing = {
+        product_id
+        for (product_id,) in db.query(ProductPriceStats.product_id).filter(ProductPriceStats.product_id.in_(product_ids))
+    }
+    now = datetime.utcnow()
+    missing = compute_price_stats(db, [product_id for product_id in product_ids if product_id not in existing])
+    inserted = _insert_missing_stats(db, [dict(values, updated_at=now) for values in missing.values()]) if missing else set()
+
+    params = [
+        dict(pid=entry.product_id, price=entry.unit_price, day=entry.price_date, history_id=entry.id, now=now)
+        for entry in entries
+        if entry.product_id not in inserted
+    ]
+    if params:
+        db.execute(_RECORD_PRICE, params)
+        # Riga rimossa nel frattempo (ricalcolo concorrente che non vedeva ancora
+        # queste voci): l'UPDATE non l'ha trovata, si ricalcola dallo storico
+        updated = {entry["pid"] for entry in params}
+        present = {
+            product_id
+            for (product_id,) in db.query(ProductPriceStats.product_id).filter(ProductPriceStats.product_id.in_(updated))
+        }
+        missed = compute_price_stats(db, updated - present)
+        if missed:
+            _insert_missing_stats(db, [dict(values, updated_at=now) for values in missed.values()])
+    _sync_unit_prices(db, product_ids)
+
+
+def remove_price_stats(db: Session, product_ids: Iterable[int]) -> None:
+    """Prima di eliminare un prodotto (la riga ha una foreign key su products)"""
+    product_ids = list(product_ids)
+    if product_ids:
+        db.query(ProductPriceStats).filter(ProductPriceStats.product_id.in_(product_ids)).delete(synchronize_session=False)
+
+
+def rebuild_price_stats(db: Session, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    """
+    Ricostruisce l'intera tabella dallo storico, a blocchi di prodotti con un commit
+    per blocco (backfill e riallineamento). Ritorna i prodotti con statistiche.
+    """
+    rebuilt = 0
+    last_id = 0
+    while True:
+        product_ids = [
+            product_id
+            for (product_id,) in db.query(Product.id).filter(Product.id > last_id).order_by(Product.id).limit(batch_size)
+        ]
+        if not product_ids:
+            return rebuilt
+        rebuilt += refresh_price_stats(db, product_ids)
+        db.commit()
+        last_id = product_ids[-1]
+
+
+def to_price_stats(stats) -> PriceStats:
+    """Riga di ProductPriceStats (o dizionario di compute_price_stats) -> schema API"""
+    values = stats if isinstance(stats, dict) else {column.name: getattr(stats, column.name) for column in ProductPriceStats.__table__.columns}
+    return PriceStats(
+        current_price=values["current_price"],
+        current_price_date=values["current_price_date"].isoformat(),
+        previous_price=values["previous_price"],
+        previous_price_date=values["previous_price_date"].isoformat() if values["previous_price_date"] else None,
+        min_price=values["min_price"],
+        max_price=values["max_price"],
+        avg_price=values["price_sum"] / values["purchase_count"],
+        purchase_count=values["purchase_count"],
+    )
+
+
+def load_price_stats(db: Session, product_ids: Iterable[int]) -> Dict[int, PriceStats]:
+    """
+    Statistiche precalcolate (una lettura per chiave primaria); per i prodotti senza
+    riga, ad esempio prima del backfill, calcolate al volo dallo storico.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    rows = db.query(ProductPriceStats).filter(ProductPriceStats.product_id.in_(product_ids)).all()
+    result = {row.product_id: to_price_stats(row) for row in rows}
+    missing = [product_id for product_id in product_ids if product_id not in result]
+    for product_id, values in compute_price_stats(db, missing).items():
+        result[product_id] = to_price_stats(values)
+    return result
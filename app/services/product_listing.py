@@ -0,0 +1,91 @@
+# app/services/product_listing.py
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.db.models import Product
+from app.schemas.product import PriceVariation, Product as ProductSchema
+from app.services.normalization import escape_like, normalize_description
+from app.services.price_stats import load_price_stats
+
+
+def price_variation(current_price: Optional[float], previous_price: Optional[float], price_date: Optional[date]) -> Optional[PriceVariation]:
+    """Variazione tra gli ultimi due prezzi (None senza prezzo precedente o se è zero)"""
+    if current_price is None or previous_price is None or previous_price == 0:
+        return None
+    absolute_change = current_price - previous_price
+    return PriceVariation(
+        previous_price=previous_price,
+        current_price=current_price,
+        absolute_change=absolute_change,
+        percentage_change=(absolute_change / previous_price) * 100,
+        variation_date=price_date.isoformat() if price_date else "",
+    )
+
+
+def latest_price_variations(db: Session, product_ids: Iterable[int]) -> Dict[int, PriceVariation]:
+    """Ultima variazione di prezzo dei prodotti indicati, dalle statistiche precalcolate"""
+    variations: Dict[int, PriceVariation] = {}
+    for product_id, stats in load_price_stats(db, product_ids).items():
+        variation = price_variation(
+            stats.current_price,
+            stats.previous_price,
+            date.fromisoformat(stats.current_price_date),
+        )
+        if variation is not None:
+            variations[product_id] = variation
+    return variations
+
+
+def _filtered(query, search: Optional[str]):
+    """Ricerca per nome (normalizzato, anche a metà parola) o per codice articolo (prefisso)"""
+    if not search or not search.strip():
+        return query
+    normalized = normalize_description(search)
+    conditions = [Product.product_code.ilike(f"{escape_like(search.strip())}%", escape="\\")]
+    if normalized:
+        conditions.append(Product.normalized_name.like(f"%{escape_like(normalized)}%", escape="\\"))
+    return query.filter(or_(*conditions))
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(cursor)
+    except ValueError as e:
+        raise ValueError(f"Cursore non valido: {cursor}") from e
+
+
+def list_product_page(
+    db: Session, search: Optional[str], cursor: Optional[str], limit: int
+) -> Tuple[List[ProductSchema], Optional[str]]:
+    """
+    Pagina di prodotti in ordine di id (keyset: il cursore è l'ultimo id della pagina),
+    con l'ultima variazione di prezzo. Ritorna (prodotti, cursore successivo o None).
+    """
+    query = _filtered(
+        db.query(Product.id, Product.product_code, Product.name, Product.unit_price), search
+    )
+    if cursor:
+        query = query.filter(Product.id > decode_cursor(cursor))
+    rows = query.order_by(Product.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    variations = latest_price_variations(db, [row.id for row in rows])
+    items = [
+        ProductSchema(
+            id=row.id,
+            product_code=row.product_code,
+            name=row.name,
+            unit_price=row.unit_price,
+            variazione=variations.get(row.id),
+        )
+        for row in rows
+    ]
+    return items, (str(rows[-1].id) if has_more else None)
+
+
+def count_products(db: Session, search: Optional[str]) -> int:
+    return _filtered(db.query(func.count(Product.id)), search).scalar() or 0
@@ -0,0 +1,142 @@
+# app/services/similarity.py
+import math
+import threading
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from app.services.normalization import normalize_description
+
+SHINGLE_SIZE = 3
+# Spazio delle feature (trigrammi hashati): 2^18 bucket
+N_FEATURES = 1 << 18
+
+
+class SimilarityHit(NamedTuple):
+    id: int
+    name: str
+    score: float
+
+
+def _shingle_features(normalized: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Trigrammi di caratteri (con padding) hashati nello spazio delle feature.
+    Ritorna (feature, conteggi) con feature uniche.
+    """
+    if not normalized:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    padded = f"  {normalized} "
+    hashed = np.fromiter(
+        (hash(padded[i:i + SHINGLE_SIZE]) & (N_FEATURES - 1) for i in range(len(padded) - SHINGLE_SIZE + 1)),
+        dtype=np.int64,
+    )
+    features, counts = np.unique(hashed, return_counts=True)
+    return features, counts.astype(np.float32)
+
+
+class CatalogSimilarityIndex:
+    """
+    Scoring fuzzy del catalogo con NumPy: i nomi normalizzati sono vettori tf-idf
+    di trigrammi di caratteri hashati, salvati come indice invertito in formato CSR
+    (feature -> prodotti). Una riga fattura viene confrontata con tutto il catalogo
+    in un solo passaggio vettorizzato (similarità coseno) e si prendono i top-k.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version: Optional[int] = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._names: List[str] = []
+        self._idf = np.zeros(N_FEATURES, dtype=np.float32)
+        self._indptr = np.zeros(N_FEATURES + 1, dtype=np.int64)
+        self._postings_doc = np.empty(0, dtype=np.int32)
+        self._postings_weight = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def build(self, products: Iterable[Tuple[int, str, str]], version: Optional[int] = None) -> None:
+        """products: iterabile di (id, name, normalized_name)"""
+        ids: List[int] = []
+        names: List[str] = []
+        doc_parts: List[np.ndarray] = []
+        feature_parts: List[np.ndarray] = []
+        tf_parts: List[np.ndarray] = []
+
+        for product_id, name, normalized in products:
+            features, counts = _shingle_features(normalized)
+            doc = len(ids)
+            ids.append(product_id)
+            names.append(name)
+            if len(features):
+                doc_parts.append(np.full(len(features), doc, dtype=np.int32))
+                feature_parts.append(features)
+                tf_parts.append(counts)
+
+        n_docs = len(ids)
+        if doc_parts:
+            docs = np.concatenate(doc_parts)
+            features = np.concatenate(feature_parts)
+            tf = np.concatenate(tf_parts)
+        else:
+            docs = np.empty(0, dtype=np.int32)
+            features = np.empty(0, dtype=np.int64)
+            tf = np.empty(0, dtype=np.float32)
+
+        df = np.bincount(features, minlength=N_FEATURES).astype(np.float32)
+        idf = (np.log((n_docs + 1) / (df + 1)) + 1).astype(np.float32)
+
+        weights = (1 + np.log(tf)) * idf[features]
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=n_docs)).astype(np.float32)
+        if len(weights):
+            weights = weights / norms[docs]
+
+        # Indice invertito CSR ordinato per feature
+        order = np.argsort(features, kind="stable")
+        indptr = np.zeros(N_FEATURES + 1, dtype=np.int64)
+        np.cumsum(np.bincount(features, minlength=N_FEATURES), out=indptr[1:])
+
+        with self._lock:
+            self._ids = np.asarray(ids, dtype=np.int64)
+            self._names = names
+            self._idf = idf
+            self._indptr = indptr
+            self._postings_doc = docs[order]
+            self._postings_weight = weights[order].astype(np.float32)
+            self.version = version
+
+    def top_k(self, text: str, k: int = 5, min_score: float = 0.0) -> List[SimilarityHit]:
+        """I k prodotti più simili alla descrizione, in ordine di score decrescente"""
+        features, counts = _shingle_features(normalize_description(text))
+        with self._lock:
+            n_docs = len(self._names)
+            if not n_docs or not len(features) or k <= 0:
+                return []
+
+            query = (1 + np.log(counts)) * self._idf[features]
+            query_norm = math.sqrt(float(np.dot(query, query)))
+            if query_norm == 0:
+                return []
+            query /= query_norm
+
+            # Raccoglie tutte le posting list della query in un unico array di indici
+            starts = self._indptr[features]
+            lengths = self._indptr[features + 1] - starts
+            total = int(lengths.sum())
+            if total == 0:
+                return []
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+            scores = np.bincount(
+                self._postings_doc[offsets],
+                weights=self._postings_weight[offsets] * np.repeat(query, lengths),
+                minlength=n_docs,
+            )
+
+            k = min(k, n_docs)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [
+                SimilarityHit(int(self._ids[i]), self._names[i], round(float(scores[i]), 4))
+                for i in top
+                if scores[i] > 0 and scores[i] >= min_score
+            ]
@@ -0,0 +1,72 @@
+# app/services/upload_preprocessing.py
+import io
+import logging
+from typing import BinaryIO, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+
+
+def upload_extension(filename: str) -> str:
+    """Estensione dal nome file, es "fattura.pdf" -> "pdf" """
+    return (filename or "").split(".")[-1].lower()
+
+
+def prepare_image(fileobj: BinaryIO) -> bytes:
+    """
+    Foto/scansione pronta per il modello: orientamento EXIF applicato, lato lungo
+    al massimo IMAGE_MAX_SIDE (sufficiente per leggere il testo), ricompressa in JPEG
+    senza metadati. Pillow legge direttamente dal file temporaneo dell'upload,
+    l'originale non viene mai caricato in memoria come bytes.
+    """
+    from PIL import Image, ImageOps
+
+    max_side = settings.IMAGE_MAX_SIDE
+    with Image.open(fileobj) as original:
+        original.draft("RGB", (max_side, max_side))  # JPEG: decodifica già ridotta
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out = io.BytesIO()
+        # Nessun exif/icc passato a save: i metadati vengono rimossi
+        image.save(out, format="JPEG", quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+def prepare_upload(fileobj: BinaryIO, mime_ext: str) -> Tuple[bytes, str]:
+    """
+    Byte da inviare all'estrazione + estensione effettiva.
+    Le immagini vengono ridotte e ricompresse (-> "jpg"), gli altri file letti così come sono.
+    """
+    ext = mime_ext.lower()
+    if ext in IMAGE_EXTENSIONS and settings.IMAGE_PREPROCESSING_ENABLED:
+        try:
+            fileobj.seek(0)
+            return prepare_image(fileobj), "jpg"
+        except ImportError:
+            logger.warning("⚠️ Pillow not installed: images are sent without preprocessing")
+        except Exception as e:
+            logger.warning(f"⚠️ Image preprocessing failed, sending original: {e}")
+    fileobj.seek(0)
+    return fileobj.read(), ext
+
+
+async def read_upload(file: UploadFile) -> Tuple[bytes, str]:
+    """
+    Legge un UploadFile (già su file temporaneo spooled, su disco oltre 1 MB)
+    senza bloccare l'event loop, con il preprocessing delle immagini.
+    """
+    return await run_in_threadpool(prepare_upload, file.file, upload_extension(file.filename))
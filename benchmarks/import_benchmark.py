@@ -0,0 +1,247 @@
+"""
+Benchmark end-to-end di import + conferma fatture, senza chiamare OpenAI.
+
+Per ogni fattura: POST /api/invoices/import (estrazione con il backend finto,
+fornitore, matching) e POST /api/invoices/confirm con i prodotti proposti
+(prodotti nuovi, storico prezzi, alias, indici). Riporta p50/p95/p99 e throughput
+per endpoint, per trovare regressioni di matching e persistenza.
+
+Uso (dalla root del progetto):
+
+    # Fatture sintetiche, app in-process su un DB SQLite nuovo
+    python benchmarks/import_benchmark.py --invoices 200 --concurrency 8 --lines 10-60 --latency 0.5
+
+    # Risposte registrate (prima: import con EXTRACTION_BACKEND=record)
+    python benchmarks/import_benchmark.py --backend replay --files fatture/*.pdf --invoices 100
+
+    # Server già avviato (con EXTRACTION_BACKEND=synthetic o replay nel suo ambiente)
+    python benchmarks/import_benchmark.py --base-url http://localhost:8000 --invoices 100
+
+La cache delle estrazioni è disattivata (ogni import arriva al backend), salvo --cache.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark import + conferma fatture con backend AI finto")
+    parser.add_argument("--invoices", type=int, default=50, help="fatture da importare (default 50)")
+    parser.add_argument("--concurrency", type=int, default=4, help="fatture elaborate in parallelo (default 4)")
+    parser.add_argument("--backend", choices=["synthetic", "replay"], default="synthetic")
+    parser.add_argument("--files", nargs="*", default=[], help="documenti da importare (replay), usati a rotazione")
+    parser.add_argument("--recordings", default=None, help="cartella delle registrazioni (replay)")
+    parser.add_argument("--lines", default="5-40", help="righe per fattura sintetica, es. 20 oppure 10-200")
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza simulata del modello in secondi")
+    parser.add_argument("--jitter", type=float, default=0.0, help="variazione casuale della latenza in secondi")
+    parser.add_argument("--per-1k-tokens", type=float, default=0.0, help="secondi per 1000 token di output")
+    parser.add_argument("--replay-latency-scale", type=float, default=0.0, help="quota della latenza registrata (replay)")
+    parser.add_argument("--database", default=None, help="DATABASE_URL (default: SQLite nuovo in una cartella temporanea)")
+    parser.add_argument("--cache", action="store_true", help="lascia attiva la cache delle estrazioni")
+    parser.add_argument("--no-confirm", action="store_true", help="solo import, senza conferma")
+    parser.add_argument("--base-url", default=None, help="server già avviato invece dell'app in-process")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", default=None, help="salva i risultati in JSON")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    """Settings lette all'import di app.config: l'ambiente va preparato prima"""
+    min_lines, _, max_lines = args.lines.partition("-")
+    database = args.database or f"sqlite:///{Path(tempfile.mkdtemp(prefix='reorder-bench-')) / 'bench.db'}"
+    os.environ.update({
+        "DATABASE_URL": database,
+        "EXTRACTION_BACKEND": args.backend,
+        "EXTRACTION_FAKE_LATENCY_SECONDS": str(args.latency),
+        "EXTRACTION_FAKE_JITTER_SECONDS": str(args.jitter),
+        "EXTRACTION_FAKE_SECONDS_PER_1K_TOKENS": str(args.per_1k_tokens),
+        "EXTRACTION_REPLAY_LATENCY_SCALE": str(args.replay_latency_scale),
+        "SYNTHETIC_MIN_LINES": min_lines,
+        "SYNTHETIC_MAX_LINES": max_lines or min_lines,
+    })
+    if args.recordings:
+        os.environ["EXTRACTION_RECORDINGS_DIR"] = args.recordings
+    if not args.cache:
+        os.environ["EXTRACTION_CACHE_BACKEND"] = "none"
+    print(f"Database: {database}")
+
+
+def documents(args: argparse.Namespace) -> List[Tuple[str, bytes]]:
+    """Documenti da importare: i file indicati a rotazione, altrimenti immagini PNG tutte diverse"""
+    if args.files:
+        loaded = [(Path(path).name, Path(path).read_bytes()) for path in args.files]
+        return [loaded[i % len(loaded)] for i in range(args.invoices)]
+    if args.backend == "replay":
+        sys.exit("Il backend replay richiede --files con documenti già registrati")
+
+    from PIL import Image
+
+    rng = random.Random(args.seed)
+    generated = []
+    for i in range(args.invoices):
+        # Pixel casuali: ogni immagine ha un hash diverso, quindi una fattura sintetica diversa
+        image = Image.frombytes("RGB", (48, 48), bytes(rng.randrange(256) for _ in range(48 * 48 * 3)))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        generated.append((f"fattura-{i:05d}.png", buffer.getvalue()))
+    return generated
+
+
+def confirm_payload(imported: dict) -> dict:
+    """Conferma come farebbe l'utente accettando le proposte del matching"""
+    return {
+        "supplier_id": imported["supplier_id"],
+        "invoice_number": imported.get("invoice_number") or "SENZA-NUMERO",
+        "invoice_date": imported.get("invoice_date") or "2025-01-01",
+        "currency": imported.get("currency") or "EUR",
+        "layout_sample_id": imported.get("layout_sample_id"),
+        "lines": [
+            {
+                "raw_description": line["raw_description"],
+                "product_code": line.get("product_code"),
+                "quantity": line.get("quantity") or 1,
+                "unit_price": line.get("unit_price") or 0,
+                "total": line.get("total") or 0,
+                "vat_rate": line.get("vat_rate"),
+                "unit_measure": line.get("unit_measure"),
+                "product_id": line.get("deterministic_product_id"),
+            }
+            for line in imported["lines"]
+        ],
+    }
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {"import": [], "confirm": [], "total": []}
+        self.ok: Dict[str, int] = {"import": 0, "confirm": 0, "total": 0}
+        self.errors: Dict[str, Dict[str, int]] = {"import": {}, "confirm": {}, "total": {}}
+        self.lines = 0
+        self.matched = 0
+
+    def error(self, endpoint: str, reason: str) -> None:
+        self.errors[endpoint][reason] = self.errors[endpoint].get(reason, 0) + 1
+
+
+async def run_one(client: httpx.AsyncClient, name: str, content: bytes, confirm: bool, results: Results) -> None:
+    started = time.perf_counter()
+    response = await client.post("/api/invoices/import", files={"file": (name, content)})
+    results.latencies["import"].append(time.perf_counter() - started)
+    if response.status_code != 200:
+        results.error("import", str(response.status_code))
+        return
+    results.ok["import"] += 1
+    imported = response.json()
+    results.lines += len(imported["lines"])
+    results.matched += sum(1 for line in imported["lines"] if line.get("deterministic_product_id"))
+
+    if confirm:
+        confirm_started = time.perf_counter()
+        response = await client.post("/api/invoices/confirm", json=confirm_payload(imported))
+        results.latencies["confirm"].append(time.perf_counter() - confirm_started)
+        if response.status_code != 200:
+            results.error("confirm", str(response.status_code))
+            return
+        results.ok["confirm"] += 1
+    results.ok["total"] += 1
+    results.latencies["total"].append(time.perf_counter() - started)
+
+
+async def run(args: argparse.Namespace, docs: List[Tuple[str, bytes]]) -> Tuple[Results, float]:
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=600)
+    else:
+        from app.main import app
+
+        logging.getLogger().setLevel(logging.WARNING)  # il middleware logga ogni richiesta
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=600)
+
+    results = Results()
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+
+    async def bounded(name: str, content: bytes) -> None:
+        async with semaphore:
+            try:
+                await run_one(client, name, content, not args.no_confirm, results)
+            except Exception as e:
+                results.error("import", type(e).__name__)
+
+    async with client:
+        started = time.perf_counter()
+        await asyncio.gather(*[bounded(name, content) for name, content in docs])
+        wall = time.perf_counter() - started
+    return results, wall
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(results: Results, wall: float) -> dict:
+    summary = {"wall_seconds": round(wall, 3), "lines": results.lines, "lines_matched": results.matched, "endpoints": {}}
+    for endpoint, samples in results.latencies.items():
+        summary["endpoints"][endpoint] = {
+            "ok": results.ok[endpoint],
+            "errors": results.errors[endpoint],
+            **{
+                name: round(value * 1000, 1) if value is not None else None
+                for name, value in (
+                    ("p50_ms", percentile(samples, 0.50)),
+                    ("p95_ms", percentile(samples, 0.95)),
+                    ("p99_ms", percentile(samples, 0.99)),
+                    ("max_ms", max(samples) if samples else None),
+                )
+            },
+            "per_second": round(len(samples) / wall, 2) if wall else None,
+        }
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    print(f"\n{'endpoint':<10}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>9}")
+    for endpoint, stats in summary["endpoints"].items():
+        cells = [stats[key] if stats[key] is not None else "-" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(
+            f"{endpoint:<10}{stats['ok']:>6}{sum(stats['errors'].values()):>6}"
+            + "".join(f"{cell:>10}" for cell in cells)
+            + f"{stats['per_second'] if stats['per_second'] is not None else '-':>9}"
+        )
+        for reason, count in stats["errors"].items():
+            print(f"{'':<10}  errore {reason}: {count}")
+    wall = summary["wall_seconds"]
+    print(f"\nTempo totale {wall}s, righe {summary['lines']} ({summary['lines_matched']} già associate a un prodotto), "
+          f"{round(summary['lines'] / wall, 1) if wall else '-'} righe/s")
+
+
+def main() -> None:
+    args = parse_args()
+    if not args.base_url:
+        configure_environment(args)
+        sys.path.insert(0, str(ROOT))
+    docs = documents(args)
+    results, wall = asyncio.run(run(args, docs))
+    summary = summarize(results, wall)
+    print_summary(summary)
+    if args.json_path:
+        summary["args"] = {key: value for key, value in vars(args).items() if key != "files"}
+        Path(args.json_path).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Script di migrazione per la paginazione dell'elenco fatture (GET /api/invoices):
+- crea l'indice composito ix_invoices_date_id (invoice_date, id)
+- crea l'indice composito ix_invoices_supplier_date_id (supplier_id, invoice_date, id)
+
+Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+Esegui questo script una volta per aggiornare il database esistente.
+"""
+import sys
+
+from sqlalchemy import text
+
+from app.db.session import engine
+
+INDEXES = {
+    "ix_invoices_date_id": "invoices (invoice_date, id)",
+    "ix_invoices_supplier_date_id": "invoices (supplier_id, invoice_date, id)",
+}
+
+
+def main() -> bool:
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    try:
+        with engine.begin() as conn:
+            for name, target in INDEXES.items():
+                print(f"Creazione indice {name}...")
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+    except Exception as e:
+        print(f"✗ Errore durante la migrazione: {e}")
+        return False
+
+    print("✓ Migrazione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Script di migrazione per aggiungere la colonna normalizzata usata dal matching:
+- products.normalized_name
+
+La colonna viene popolata con normalize_description (stesse regole del matching)
+e indicizzata (btree text_pattern_ops su PostgreSQL) così i lookup esatti e a
+prefisso diventano seek sull'indice.
+
+Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+Esegui questo script una volta per aggiornare il database esistente.
+"""
+import sys
+
+from sqlalchemy import inspect, text
+
+from app.db.session import engine
+from app.services.normalization import normalize_description
+
+BATCH_SIZE = 1000
+
+# (tabella, colonna normalizzata, colonna sorgente, tipo SQL, nome indice)
+COLUMNS = [
+    ("products", "normalized_name", "name", "VARCHAR(255)", "ix_products_normalized_name"),
+]
+
+
+def add_column(conn, table: str, column: str, sql_type: str) -> bool:
+    columns = [c["name"] for c in inspect(conn).get_columns(table)]
+    if column in columns:
+        print(f"La colonna {column} esiste già nella tabella {table}.")
+        return False
+    print(f"Aggiunta colonna {column} alla tabella {table}...")
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}"))
+    return True
+
+
+def backfill(conn, table: str, column: str, source: str) -> int:
+    """Popola la colonna normalizzata a blocchi, solo per le righe ancora vuote"""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text(
+                f"SELECT id, {source} FROM {table} "
+                f"WHERE {column} IS NULL AND id > :last_id ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            text(f"UPDATE {table} SET {column} = :value WHERE id = :id"),
+            [{"id": row_id, "value": normalize_description(value or "")} for row_id, value in rows],
+        )
+        updated += len(rows)
+        last_id = rows[-1][0]
+    return updated
+
+
+def create_index(conn, table: str, column: str, index_name: str) -> None:
+    print(f"Creazione indice {index_name}...")
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({column} text_pattern_ops)"
+        ))
+    else:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({column})"))
+
+
+def main() -> bool:
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    try:
+        with engine.begin() as conn:
+            for table, column, source, sql_type, index_name in COLUMNS:
+                add_column(conn, table, column, sql_type)
+                updated = backfill(conn, table, column, source)
+                print(f"  - {updated} righe aggiornate in {table}.{column}")
+                create_index(conn, table, column, index_name)
+    except Exception as e:
+        print(f"✗ Errore durante la migrazione: {e}")
+        return False
+
+    print("✓ Migrazione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
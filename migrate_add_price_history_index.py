@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Script di migrazione per le statistiche prezzi dei prodotti:
+- crea l'indice composito ix_price_history_product_date_id (product_id, price_date, id),
+  usato dalla window function di price_stats.latest_prices (ultime due voci per
+  prodotto) nei ricalcoli di refresh_price_stats
+
+Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+Esegui questo script una volta per aggiornare il database esistente.
+"""
+import sys
+
+from sqlalchemy import text
+
+from app.db.session import engine
+
+
+def main() -> bool:
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    try:
+        with engine.begin() as conn:
+            print("Creazione indice ix_price_history_product_date_id...")
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_price_history_product_date_id "
+                "ON product_price_history (product_id, price_date, id)"
+            ))
+    except Exception as e:
+        print(f"✗ Errore durante la migrazione: {e}")
+        return False
+
+    print("✓ Migrazione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Script di migrazione per collegare i prodotti al fornitore:
+- aggiunge products.supplier_id
+- crea l'indice composito (supplier_id, product_code)
+- assegna il fornitore ai prodotti comprati da un solo fornitore
+
+Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+Esegui questo script una volta per aggiornare il database esistente.
+"""
+import sys
+
+from sqlalchemy import inspect, text
+
+from app.db.session import engine
+
+
+def main() -> bool:
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    try:
+        with engine.begin() as conn:
+            columns = [c["name"] for c in inspect(conn).get_columns("products")]
+            if "supplier_id" in columns:
+                print("La colonna supplier_id esiste già nella tabella products.")
+            else:
+                print("Aggiunta colonna supplier_id alla tabella products...")
+                conn.execute(text(
+                    "ALTER TABLE products ADD COLUMN supplier_id INTEGER REFERENCES suppliers(id)"
+                ))
+
+            print("Creazione indice ix_products_supplier_code...")
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_products_supplier_code "
+                "ON products (supplier_id, product_code)"
+            ))
+
+            # Backfill: solo i prodotti le cui righe fattura vengono tutte dallo stesso fornitore
+            print("Assegnazione fornitore ai prodotti esistenti...")
+            result = conn.execute(text("""
+                UPDATE products
+                SET supplier_id = (
+                    SELECT MIN(i.supplier_id)
+                    FROM invoice_lines l
+                    JOIN invoices i ON i.id = l.invoice_id
+                    WHERE l.product_id = products.id
+                )
+                WHERE supplier_id IS NULL
+                  AND (
+                    SELECT COUNT(DISTINCT i.supplier_id)
+                    FROM invoice_lines l
+                    JOIN invoices i ON i.id = l.invoice_id
+                    WHERE l.product_id = products.id
+                  ) = 1
+            """))
+            print(f"  - {result.rowcount} prodotti collegati al fornitore")
+    except Exception as e:
+        print(f"✗ Errore durante la migrazione: {e}")
+        return False
+
+    print("✓ Migrazione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Script di migrazione per la freschezza dell'indice di matching in memoria:
+- aggiunge products.updated_at (impostata a ogni insert/update via ORM)
+- crea l'indice ix_products_updated_at
+
+Le righe esistenti restano con updated_at NULL: vengono considerate solo le
+modifiche successive alla migrazione.
+
+Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+Esegui questo script una volta per aggiornare il database esistente.
+"""
+import sys
+
+from sqlalchemy import inspect, text
+
+from app.db.session import engine
+
+
+def main() -> bool:
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    try:
+        with engine.begin() as conn:
+            columns = [c["name"] for c in inspect(conn).get_columns("products")]
+            if "updated_at" in columns:
+                print("La colonna updated_at esiste già nella tabella products.")
+            else:
+                print("Aggiunta colonna updated_at alla tabella products...")
+                sql_type = "TIMESTAMP" if conn.dialect.name == "postgresql" else "DATETIME"
+                conn.execute(text(f"ALTER TABLE products ADD COLUMN updated_at {sql_type}"))
+
+            print("Creazione indice ix_products_updated_at...")
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_updated_at ON products (updated_at)"))
+    except Exception as e:
+        print(f"✗ Errore durante la migrazione: {e}")
+        return False
+
+    print("✓ Migrazione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Ricostruisce la tabella product_price_stats (prezzo corrente/precedente, min, max,
+media, numero di acquisti) dallo storico prezzi, e riallinea products.unit_price
+al prezzo corrente.
+
+Da eseguire una volta dopo l'aggiornamento (backfill) e ogni volta che lo storico
+viene modificato fuori dall'API. Funziona sia con SQLite sia con PostgreSQL (usa DATABASE_URL).
+
+Uso: python rebuild_price_stats.py [--batch-size 500]
+"""
+import argparse
+import sys
+
+from app.db.models import ProductPriceStats
+from app.db.session import SessionLocal, engine
+from app.services.price_stats import REBUILD_BATCH_SIZE, rebuild_price_stats
+
+
+def main() -> bool:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH_SIZE, help="prodotti per transazione")
+    args = parser.parse_args()
+
+    print(f"Connessione al database: {engine.url.render_as_string(hide_password=True)}")
+    db = SessionLocal()
+    try:
+        ProductPriceStats.__table__.create(bind=engine, checkfirst=True)
+        print("Ricostruzione statistiche prezzi...")
+        rebuilt = rebuild_price_stats(db, batch_size=max(1, args.batch_size))
+        print(f"  - {rebuilt} prodotti con storico prezzi")
+    except Exception as e:
+        db.rollback()
+        print(f"✗ Errore durante la ricostruzione: {e}")
+        return False
+    finally:
+        db.close()
+
+    print("✓ Ricostruzione completata con successo!")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)